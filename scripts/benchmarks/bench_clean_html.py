@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark for the Gemini HTML pre-cleaner.
+
+Compares the single-pass HTMLCleaner against the previous three regex
+passes (script/style/svg) on large course pages.
+
+Usage:
+    python benchmarks/bench_clean_html.py [saved_page.html ...]
+
+Without arguments a synthetic course page (~4 MB: a 1.2 MB inline script
+repeated three times, a stylesheet and 400 assignment rows) is generated.
+"""
+
+import os
+import re
+import sys
+import timeit
+
+SCRIPTS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SCRIPTS_DIR)
+
+# sync_gradescope logs to logs/sync.log relative to the working directory
+os.makedirs('logs', exist_ok=True)
+
+from sync_gradescope import clean_html, GEMINI_MAX_INPUT_CHARS  # noqa: E402
+
+ROW = """
+<tr role="row" class="odd">
+  <th class="table--primaryLink" role="rowheader" scope="row">
+    <a aria-label="View Homework {i}" href="/courses/123456/assignments/{i}/submissions/9{i}">Homework {i}</a>
+  </th>
+  <td class="submissionStatus submissionStatus-complete">
+    <svg class="submissionStatus--icon" viewBox="0 0 24 24" width="24" height="24"><path d="M9 16.2 4.8 12l-1.4 1.4L9 19 21 7l-1.4-1.4L9 16.2z"/><circle cx="12" cy="12" r="10"/></svg>
+    <div class="submissionStatus--score">{score} / 10.0</div>
+  </td>
+  <td class="submissionTimeChart">
+    <div class="progressBar--caption">
+      <span class="submissionTimeChart--releaseDate">Jan 10</span>
+      <time class="submissionTimeChart--dueDate" datetime="2024-01-20 23:59:00 -0800">Jan 20 at 11:59PM</time>
+    </div>
+  </td>
+</tr>
+"""
+
+
+def synthetic_page(rows: int = 400, script_kb: int = 1200) -> str:
+    """Build a course page padded with the kind of noise real pages carry"""
+    script = "<script>window.__data = {" + ",".join(
+        f'"k{i}": "{"x" * 40}"' for i in range(script_kb * 1024 // 50)
+    ) + "};</script>"
+    style = "<style>" + ".c{color:#000;margin:0 auto;padding:4px}\n" * 2000 + "</style>"
+    body = "".join(ROW.format(i=i, score=i % 11) for i in range(rows))
+    return (
+        f"<!DOCTYPE html><html><head><title>Course</title>{style}{script}</head>"
+        f"<body><!-- layout -->{script}<table id=\"assignments-student-table\"><tbody>"
+        f"{body}</tbody></table>{script}</body></html>"
+    )
+
+
+def regex_clean(html_content: str) -> str:
+    """The previous cleaning implementation, kept for comparison"""
+    cleaned = re.sub(r'<script\b[^>]*>[\s\S]*?</script>', '', html_content)
+    cleaned = re.sub(r'<style\b[^>]*>[\s\S]*?</style>', '', cleaned)
+    cleaned = re.sub(r'<svg\b[^>]*>[\s\S]*?</svg>', '', cleaned)
+    return cleaned[:GEMINI_MAX_INPUT_CHARS]
+
+
+def bench(name: str, html_content: str, number: int = 5):
+    old_time = min(timeit.repeat(lambda: regex_clean(html_content), number=1, repeat=number))
+    new_time = min(timeit.repeat(lambda: clean_html(html_content), number=1, repeat=number))
+    old_size = len(regex_clean(html_content))
+    new_size = len(clean_html(html_content))
+    print(f"{name}: {len(html_content) / 1024:.0f} KB input")
+    print(f"  regex x3:    {old_time * 1000:8.1f} ms  -> {old_size:7d} chars")
+    print(f"  HTMLCleaner: {new_time * 1000:8.1f} ms  -> {new_size:7d} chars")
+
+
+def main():
+    if len(sys.argv) > 1:
+        for path in sys.argv[1:]:
+            with open(path, encoding='utf-8') as f:
+                bench(os.path.basename(path), f.read())
+    else:
+        bench("synthetic", synthetic_page())
+
+
+if __name__ == '__main__':
+    main()
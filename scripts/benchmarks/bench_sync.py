@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+"""
+Offline end-to-end benchmark for the Gradescope sync.
+
+Runs the real GradescopeSyncer against in-process stand-ins: Appwrite
+Databases/Users services (benchmarks/fakes.py) and a local HTTP server
+serving Gradescope pages and the Gemini endpoint. Nothing leaves the
+machine, so runs are repeatable and can be compared across changes.
+With `--engine asyncio` the async engine reaches the same fakes through
+the Appwrite REST API on the local server.
+
+Usage:
+    python benchmarks/bench_sync.py [--users N] [--courses N] [--assignments N]
+                                    [--runs N] [--page-mode table|ai]
+                                    [--engine threads|asyncio] ...
+
+Each run reports throughput and the per-phase timings from the run
+report. Later runs reuse the sync state and parse cache, so `--runs 2`
+measures an incremental sync after a full one (pass --full to disable).
+"""
+
+import argparse
+import base64
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+
+SCRIPTS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SCRIPTS_DIR)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fakes import FakeDatabases, FakeUsers, Population, StubServer  # noqa: E402
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark the Gradescope sync offline")
+    parser.add_argument('--users', type=int, default=50, help="Connected users (default: 50)")
+    parser.add_argument('--courses', type=int, default=6, help="Gradescope courses per user (default: 6)")
+    parser.add_argument('--assignments', type=int, default=30, help="Assignments per course (default: 30)")
+    parser.add_argument('--manual', type=int, default=5, help="Manual assignments per user (default: 5)")
+    parser.add_argument('--runs', type=int, default=1, help="Consecutive sync runs (default: 1)")
+    parser.add_argument('--workers', type=int, default=4, help="User workers (default: 4)")
+    parser.add_argument('--course-workers', type=int, default=4, help="Course workers per user (default: 4)")
+    parser.add_argument('--write-workers', type=int, default=4, help="Writes in flight per user (default: 4)")
+    parser.add_argument('--engine', choices=['threads', 'asyncio'], default='threads',
+                        help="Sync engine to run (default: threads)")
+    parser.add_argument('--shards', type=int, default=1,
+                        help="Split each run into N shards run one after another, then merge (default: 1)")
+    parser.add_argument('--page-mode', choices=['table', 'ai'], default='table',
+                        help="Serve parseable tables, or pages that need Gemini (default: table)")
+    parser.add_argument('--courses-api', action='store_true',
+                        help="Serve a JSON courses endpoint (Gradescope has none; default: dashboard only)")
+    parser.add_argument('--appwrite-latency', type=float, default=0.0,
+                        help="Seconds added to every Appwrite call (default: 0)")
+    parser.add_argument('--gradescope-latency', type=float, default=0.0,
+                        help="Seconds added to every Gradescope request (default: 0)")
+    parser.add_argument('--gemini-latency', type=float, default=0.0,
+                        help="Seconds added to every Gemini request (default: 0)")
+    parser.add_argument('--rate-limits', action='store_true',
+                        help="Apply the production rate limits (off by default)")
+    parser.add_argument('--full', action='store_true', help="Disable incremental sync")
+    parser.add_argument('--report', help="Write all run reports to this JSON file")
+    parser.add_argument('--verbose', action='store_true', help="Show sync logs below ERROR")
+    return parser.parse_args()
+
+
+def print_run(number: int, report: dict, elapsed: float, users: int, databases: FakeDatabases,
+              users_service: FakeUsers, stub: StubServer):
+    stats = report['stats']
+    print(f"\nRun {number} ({report['mode']}): {elapsed:.2f}s, {users / elapsed:.1f} users/s")
+    print(f"  users processed {stats['users_processed']}, skipped {stats['users_skipped']}; "
+          f"assignments synced {stats['assignments_synced']}, unchanged {stats['assignments_unchanged']}; "
+          f"conflicts {stats['conflicts_created']}; errors {len(report['errors'])}; "
+          f"writes sent {stats['writes_sent']}, saved {stats['writes_saved']}; "
+          f"documents read {stats['documents_read']}, snapshot reloads {stats['snapshot_reloads']}")
+    print(f"  appwrite calls: {json.dumps(databases.calls, sort_keys=True)} users: {json.dumps(users_service.calls, sort_keys=True)}")
+    print(f"  http requests: {json.dumps(stub.requests.calls, sort_keys=True)}")
+    print(f"  {'phase':<18}{'count':>8}{'total s':>10}{'p50 ms':>10}{'p95 ms':>10}{'max ms':>10}")
+    for phase, timing in sorted(report['phases'].items()):
+        print(f"  {phase:<18}{timing['count']:>8}{timing['total']:>10.2f}"
+              f"{timing['p50'] * 1000:>10.1f}{timing['p95'] * 1000:>10.1f}{timing['max'] * 1000:>10.1f}")
+
+
+def main():
+    args = parse_args()
+    if args.report:
+        args.report = os.path.abspath(args.report)
+
+    population = Population(args.users, args.courses, args.assignments, args.manual)
+    stub = StubServer(population, args.page_mode, args.gradescope_latency, args.gemini_latency,
+                      courses_api=args.courses_api)
+    stub.start()
+
+    # sync_gradescope reads its configuration at import time and logs to
+    # logs/ under the working directory, so set both up first
+    workdir = tempfile.mkdtemp(prefix='bench-sync-')
+    os.chdir(workdir)
+    os.makedirs('logs', exist_ok=True)
+    key = os.urandom(32)
+    os.environ.update({
+        # Only the asyncio engine calls it (see StubServer.serve_appwrite)
+        'APPWRITE_ENDPOINT': stub.base_url + '/v1',
+        'APPWRITE_PROJECT_ID': 'bench',
+        'APPWRITE_API_KEY': 'bench',
+        'GRADESCOPE_ENCRYPTION_KEY': base64.b64encode(key).decode('ascii'),
+        'GRADESCOPE_BASE_URL': stub.base_url,
+        # Same server under another host name, so its requests are timed as 'gemini'
+        'GEMINI_API_BASE': stub.base_url.replace('127.0.0.1', 'localhost'),
+        'GEMINI_PARSE_CACHE': os.path.join(workdir, 'cache', 'parse_cache.sqlite'),
+        'SYNC_STATE_PATH': os.path.join(workdir, 'cache', 'sync_state.sqlite'),
+    })
+
+    import sync_gradescope
+    from sync_gradescope import (
+        ASSIGNMENTS_COLLECTION, COURSES_COLLECTION,
+        AsyncGradescopeSyncer, GradescopeSyncer, merge_run_reports,
+    )
+
+    if not args.verbose:
+        sync_gradescope.logger.setLevel(logging.ERROR)
+
+    databases = FakeDatabases(args.appwrite_latency)
+    users_service = FakeUsers(args.appwrite_latency)
+    population.seed(
+        databases, users_service, key,
+        ASSIGNMENTS_COLLECTION, COURSES_COLLECTION,
+        with_gemini_key=args.page_mode == 'ai'
+    )
+    if args.engine == 'asyncio':
+        stub.serve_appwrite(databases, users_service)
+    syncer_class = AsyncGradescopeSyncer if args.engine == 'asyncio' else GradescopeSyncer
+    print(f"Population: {args.users} users x {args.courses} courses x {args.assignments} assignments "
+          f"({args.users * args.courses * args.assignments} Gradescope assignments), pages: {args.page_mode}, "
+          f"engine: {args.engine}")
+    print(f"Working directory: {workdir}")
+
+    reports = []
+    try:
+        for number in range(1, args.runs + 1):
+            databases.reset()
+            users_service.reset()
+            stub.requests.reset()
+
+            shard_reports = []
+            started = time.perf_counter()
+            for index in range(args.shards):
+                syncer = syncer_class(
+                    workers=args.workers,
+                    course_workers=args.course_workers,
+                    incremental=not args.full,
+                    write_workers=args.write_workers,
+                    shard=(index, args.shards) if args.shards > 1 else None,
+                    databases=databases,
+                    users_service=users_service
+                )
+                if not args.rate_limits:
+                    syncer.rate_limiter.enabled = False
+                syncer.run()
+                with open(syncer.report_path) as f:
+                    shard_reports.append(json.load(f))
+            elapsed = time.perf_counter() - started
+
+            report = shard_reports[0] if args.shards == 1 else merge_run_reports(shard_reports)
+            report['benchmark'] = {
+                'run': number,
+                'elapsed_seconds': round(elapsed, 3),
+                'users_per_second': round(args.users / elapsed, 2),
+                'appwrite_calls': dict(databases.calls),
+                'users_calls': dict(users_service.calls),
+                'http_requests': dict(stub.requests.calls),
+            }
+            reports.append(report)
+            print_run(number, report, elapsed, args.users, databases, users_service, stub)
+    finally:
+        stub.stop()
+
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump({'args': vars(args), 'runs': reports}, f, indent=2)
+        print(f"\nWrote {args.report}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,646 @@
+"""
+In-process stand-ins for Appwrite and Gradescope/Gemini, used by the
+offline sync benchmark.
+
+- FakeDatabases / FakeUsers implement the subset of the Appwrite SDK the
+  sync script calls, evaluate its JSON queries, and sleep for a fixed
+  latency per call to approximate network round trips.
+- StubServer is a local HTTP server answering the Gradescope pages and the
+  Gemini generateContent endpoint, and optionally (serve_appwrite) the
+  Appwrite REST API backed by the fakes, for the asyncio engine. Faults
+  (error statuses, Retry-After, slow responses) can be queued with
+  `fail_next` to exercise the clients' retries and timeouts.
+- Population generates deterministic synthetic users, courses and
+  assignments and seeds the stand-ins with them.
+"""
+
+import base64
+import json
+import os
+import re
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional
+from urllib.parse import parse_qs, urlparse
+
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+
+def now_iso() -> str:
+    return datetime.now(timezone.utc).isoformat(timespec='milliseconds').replace('+00:00', 'Z')
+
+
+def encrypt_token(key: bytes, plaintext: str) -> str:
+    """Encrypt like the Node.js encryption module: iv:authTag:encryptedData (base64)"""
+    iv = os.urandom(12)
+    sealed = AESGCM(key).encrypt(iv, plaintext.encode('utf-8'), None)
+    ciphertext, auth_tag = sealed[:-16], sealed[-16:]
+    return ':'.join(base64.b64encode(part).decode('ascii') for part in (iv, auth_tag, ciphertext))
+
+
+class FakeAppwriteException(Exception):
+    def __init__(self, message: str, code: int):
+        super().__init__(message)
+        self.code = code
+
+
+class CallCounter:
+    """Thread-safe per-method call counts and simulated latency"""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def count(self, method: str):
+        with self._lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def reset(self):
+        with self._lock:
+            self.calls = {}
+
+
+def apply_queries(items: List[Dict], queries: Optional[List[str]], default_limit: int = 25):
+    """Evaluate Appwrite JSON queries against `items` (in insertion order)"""
+    limit = default_limit
+    offset = 0
+    cursor = None
+    select = None
+    order = None
+
+    for raw in queries or []:
+        query = json.loads(raw)
+        method = query['method']
+        attribute = query.get('attribute')
+        values = query.get('values') or []
+
+        if method == 'equal':
+            items = [item for item in items if item.get(attribute) in values]
+        elif method == 'notEqual':
+            items = [item for item in items if item.get(attribute) not in values]
+        elif method == 'greaterThan':
+            items = [item for item in items if item.get(attribute) is not None and item[attribute] > values[0]]
+        elif method == 'lessThan':
+            items = [item for item in items if item.get(attribute) is not None and item[attribute] < values[0]]
+        elif method == 'contains':
+            items = [
+                item for item in items
+                if any(value in (item.get(attribute) or []) for value in values)
+            ]
+        elif method == 'limit':
+            limit = values[0]
+        elif method == 'offset':
+            offset = values[0]
+        elif method == 'cursorAfter':
+            cursor = values[0]
+        elif method == 'select':
+            select = values
+        elif method in ('orderAsc', 'orderDesc'):
+            order = (attribute, method == 'orderDesc')
+        else:
+            raise FakeAppwriteException(f"Unsupported query method: {method}", 400)
+
+    if order:
+        items = sorted(items, key=lambda item: item.get(order[0]) or '', reverse=order[1])
+
+    total = len(items)
+    if cursor is not None:
+        ids = [item['$id'] for item in items]
+        if cursor not in ids:
+            raise FakeAppwriteException(f"Cursor document not found: {cursor}", 400)
+        items = items[ids.index(cursor) + 1:]
+
+    page = items[offset:offset + limit]
+    if select:
+        keep = set(select) | {'$id'}
+        page = [{key: value for key, value in item.items() if key in keep} for item in page]
+    else:
+        page = [dict(item) for item in page]
+    return total, page
+
+
+class FakeDatabases(CallCounter):
+    """Appwrite Databases service backed by in-memory collections"""
+
+    # Attribute indexed for list queries, as on the real collections
+    INDEXED_ATTRIBUTE = 'userId'
+
+    def __init__(self, latency: float = 0.0):
+        super().__init__(latency)
+        self.collections: Dict[str, Dict[str, Dict]] = {}
+        self._by_owner: Dict[str, Dict[str, List[str]]] = {}
+        self._data_lock = threading.Lock()
+        self._sequence = 0
+
+    def seed(self, collection_id: str, document_id: str, data: Dict, timestamp: Optional[str] = None) -> Dict:
+        """Insert a document directly (not counted as a call)"""
+        with self._data_lock:
+            self._sequence += 1
+            timestamp = timestamp or now_iso()
+            document = {
+                **data,
+                '$id': document_id,
+                '$collectionId': collection_id,
+                '$sequence': self._sequence,
+                '$createdAt': timestamp,
+                '$updatedAt': timestamp,
+            }
+            collection = self.collections.setdefault(collection_id, {})
+            if document_id in collection:
+                raise FakeAppwriteException(f"Document already exists: {document_id}", 409)
+            collection[document_id] = document
+            owner = data.get(self.INDEXED_ATTRIBUTE)
+            if owner is not None:
+                self._by_owner.setdefault(collection_id, {}).setdefault(owner, []).append(document_id)
+            return dict(document)
+
+    def _candidates(self, collection_id: str, queries: Optional[List[str]]) -> List[Dict]:
+        collection = self.collections.get(collection_id, {})
+        for raw in queries or []:
+            query = json.loads(raw)
+            if query['method'] == 'equal' and query.get('attribute') == self.INDEXED_ATTRIBUTE:
+                owners = self._by_owner.get(collection_id, {})
+                ids = [doc_id for owner in query['values'] for doc_id in owners.get(owner, [])]
+                return [collection[doc_id] for doc_id in ids if doc_id in collection]
+        return list(collection.values())
+
+    def list_documents(self, database_id: str, collection_id: str, queries: Optional[List[str]] = None):
+        self.count('list_documents')
+        with self._data_lock:
+            candidates = self._candidates(collection_id, queries)
+        total, documents = apply_queries(candidates, queries)
+        return {'total': total, 'documents': documents}
+
+    def get_document(self, database_id: str, collection_id: str, document_id: str, queries=None):
+        self.count('get_document')
+        with self._data_lock:
+            document = self.collections.get(collection_id, {}).get(document_id)
+            if document is None:
+                raise FakeAppwriteException(f"Document not found: {document_id}", 404)
+            return dict(document)
+
+    def create_document(self, database_id: str, collection_id: str, document_id: str, data: Dict, permissions=None):
+        self.count('create_document')
+        return self.seed(collection_id, document_id, data)
+
+    def update_document(self, database_id: str, collection_id: str, document_id: str, data=None, permissions=None):
+        self.count('update_document')
+        with self._data_lock:
+            document = self.collections.get(collection_id, {}).get(document_id)
+            if document is None:
+                raise FakeAppwriteException(f"Document not found: {document_id}", 404)
+            document.update(data or {})
+            document['$updatedAt'] = now_iso()
+            return dict(document)
+
+    def delete_document(self, database_id: str, collection_id: str, document_id: str):
+        self.count('delete_document')
+        with self._data_lock:
+            if self.collections.get(collection_id, {}).pop(document_id, None) is None:
+                raise FakeAppwriteException(f"Document not found: {document_id}", 404)
+        return {}
+
+
+class FakeUsers(CallCounter):
+    """Appwrite Users service backed by an in-memory user list"""
+
+    def __init__(self, latency: float = 0.0):
+        super().__init__(latency)
+        self.users: Dict[str, Dict] = {}
+        self._data_lock = threading.Lock()
+
+    def seed(self, user_id: str, email: str, prefs: Dict, labels: List[str]):
+        self.users[user_id] = {
+            '$id': user_id,
+            'email': email,
+            'prefs': dict(prefs),
+            'labels': list(labels),
+            '$updatedAt': now_iso(),
+        }
+
+    def list(self, queries: Optional[List[str]] = None, search: Optional[str] = None):
+        self.count('list')
+        with self._data_lock:
+            candidates = list(self.users.values())
+        total, users = apply_queries(candidates, queries)
+        return {'total': total, 'users': users}
+
+    def get(self, user_id: str):
+        self.count('get')
+        with self._data_lock:
+            return dict(self._user(user_id))
+
+    def get_prefs(self, user_id: str):
+        self.count('get_prefs')
+        with self._data_lock:
+            return dict(self._user(user_id)['prefs'])
+
+    def update_prefs(self, user_id: str, prefs: Dict):
+        # Like Appwrite, the prefs object is replaced, not merged
+        self.count('update_prefs')
+        with self._data_lock:
+            user = self._user(user_id)
+            user['prefs'] = dict(prefs)
+            user['$updatedAt'] = now_iso()
+            return dict(user['prefs'])
+
+    def update_labels(self, user_id: str, labels: List[str]):
+        self.count('update_labels')
+        with self._data_lock:
+            user = self._user(user_id)
+            user['labels'] = list(labels)
+            user['$updatedAt'] = now_iso()
+            return dict(user)
+
+    def _user(self, user_id: str) -> Dict:
+        user = self.users.get(user_id)
+        if user is None:
+            raise FakeAppwriteException(f"User not found: {user_id}", 404)
+        return user
+
+
+class Population:
+    """
+    Deterministic synthetic data set.
+
+    Each user has `courses` Gradescope courses of `assignments` assignments
+    whose deadlines span two months either side of creation time. Every
+    other course has a matching internal course, and each user has
+    `manual` manually entered assignments that resemble Gradescope ones
+    (so matching and conflict handling are exercised).
+    """
+
+    def __init__(self, users: int, courses: int, assignments: int, manual: int = 5):
+        self.user_count = users
+        self.course_count = courses
+        self.assignment_count = assignments
+        self.manual_count = manual
+        self.created = datetime.now(timezone.utc).replace(microsecond=0)
+
+    def user_id(self, index: int) -> str:
+        return f"user{index:06d}"
+
+    def session_token(self, user_id: str) -> str:
+        return f"session-{user_id}"
+
+    def user_for_token(self, token: str) -> Optional[int]:
+        match = re.fullmatch(r'session-user(\d+)', token or '')
+        return int(match.group(1)) if match else None
+
+    def courses_for(self, user_index: int) -> List[Dict]:
+        return [
+            {
+                'id': user_index * 1000 + course,
+                'name': f"Course {course} Topics",
+                'shortname': f"CS {100 + course}",
+            }
+            for course in range(self.course_count)
+        ]
+
+    def deadline(self, index: int) -> datetime:
+        span = timedelta(days=120) / max(self.assignment_count, 1)
+        return self.created - timedelta(days=60) + span * index
+
+    def assignments_for(self, course_id: int) -> List[Dict]:
+        assignments = []
+        for index in range(self.assignment_count):
+            deadline = self.deadline(index)
+            graded = deadline < self.created
+            assignments.append({
+                'id': str(course_id * 1000 + index),
+                'title': f"Homework {index}",
+                'due_date': deadline.isoformat(),
+                'score': float(index % 10) if graded else None,
+                'total_points': 10.0 if graded else None,
+                'status': 'Graded' if graded else 'No Submission',
+            })
+        return assignments
+
+    def seed(self, databases: FakeDatabases, users: FakeUsers, key: bytes,
+             assignments_collection: str, courses_collection: str, with_gemini_key: bool):
+        # Pre-existing documents were last touched an hour apart, before the first run
+        def seeded_at(hours_ago: int) -> str:
+            return (self.created - timedelta(hours=hours_ago)).isoformat(timespec='milliseconds').replace('+00:00', 'Z')
+        for user_index in range(self.user_count):
+            user_id = self.user_id(user_index)
+            prefs = {
+                'gradescopeConnected': True,
+                'gradescopeEmail': f"{user_id}@example.edu",
+                'gradescopeSessionToken': encrypt_token(key, self.session_token(user_id)),
+                'gradescopeTokenExpiry': (self.created + timedelta(days=30)).isoformat(),
+            }
+            if with_gemini_key:
+                prefs['geminiApiKey'] = encrypt_token(key, f"gemini-{user_id}")
+            users.seed(user_id, prefs['gradescopeEmail'], prefs, ['gradescope'])
+
+            for position, course in enumerate(self.courses_for(user_index)[::2]):
+                databases.seed(courses_collection, f"{user_id}-c{course['id']}", {
+                    'userId': user_id,
+                    'code': course['shortname'],
+                    'name': course['name'],
+                    'gradedItems': None,
+                    'gradeWeights': None,
+                }, seeded_at(self.manual_count + position + 1))
+
+            for index in range(self.manual_count):
+                # Same title and deadline as a Gradescope assignment in the first course
+                deadline = self.deadline(index) + timedelta(hours=3)
+                databases.seed(assignments_collection, f"{user_id}-m{index}", {
+                    'userId': user_id,
+                    'title': f"homework {index}",
+                    'deadline': deadline.isoformat(),
+                    'courseId': '',
+                    'source': 'manual',
+                    'gradescopeId': None,
+                }, seeded_at(index + 1))
+
+
+class StubServer:
+    """
+    Local HTTP server answering Gradescope and Gemini requests for a Population.
+
+    `page_mode` 'table' serves the assignment table the structured parser
+    reads; 'ai' serves pages without it so parsing falls through to Gemini.
+    The JSON courses endpoint only exists with `courses_api` (Gradescope
+    itself has none); otherwise courses come from the dashboard page.
+    After `serve_appwrite`, paths under /v1/ are Appwrite REST calls,
+    answered by the fake services (and counted there, not here).
+    Gradescope and Gemini requests first take the next queued fault, if any.
+    """
+
+    def __init__(self, population: Population, page_mode: str = 'table',
+                 gradescope_latency: float = 0.0, gemini_latency: float = 0.0,
+                 courses_api: bool = False):
+        self.population = population
+        self.page_mode = page_mode
+        self.courses_api = courses_api
+        self.gradescope_latency = gradescope_latency
+        self.gemini_latency = gemini_latency
+        self.requests = CallCounter()
+        self.databases: Optional[FakeDatabases] = None
+        self.users: Optional[FakeUsers] = None
+        self.faults: List[Dict[str, Any]] = []
+        self._faults_lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self.server.daemon_threads = True
+        self.server.request_queue_size = 256
+        self.thread = threading.Thread(target=self.server.serve_forever, name='stub-server', daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def serve_appwrite(self, databases: FakeDatabases, users: FakeUsers):
+        self.databases = databases
+        self.users = users
+
+    def fail_next(self, status: Optional[int], count: int = 1,
+                  retry_after: Optional[str] = None, delay: float = 0.0):
+        """
+        Queue a fault for the next `count` Gradescope/Gemini requests: wait
+        `delay` seconds, then answer `status` (with a Retry-After header if
+        given). A None status only delays the regular response.
+        """
+        with self._faults_lock:
+            self.faults.extend({'status': status, 'retry_after': retry_after, 'delay': delay} for _ in range(count))
+
+    def next_fault(self) -> Optional[Dict[str, Any]]:
+        with self._faults_lock:
+            return self.faults.pop(0) if self.faults else None
+
+    def appwrite_call(self, method: str, path: str, query: Dict[str, List[str]], body: Dict) -> Any:
+        """Route an Appwrite REST call (path without /v1) to the fake services"""
+        queries = [
+            values[0] for key, values in sorted(
+                ((key, values) for key, values in query.items() if key.startswith('queries[')),
+                key=lambda item: int(item[0][len('queries['):-1])
+            )
+        ]
+        parts = path.strip('/').split('/')
+
+        if parts == ['users'] and method == 'GET':
+            return self.users.list(queries=queries)
+        if len(parts) == 3 and parts[0] == 'users':
+            user_id, resource = parts[1], parts[2]
+            if resource == 'prefs' and method == 'GET':
+                return self.users.get_prefs(user_id)
+            if resource == 'prefs' and method == 'PATCH':
+                return self.users.update_prefs(user_id, body['prefs'])
+            if resource == 'labels' and method == 'PUT':
+                return self.users.update_labels(user_id, body['labels'])
+
+        if len(parts) in (5, 6) and parts[0] == 'databases' and parts[2] == 'collections' \
+                and parts[4] == 'documents':
+            database_id, collection_id = parts[1], parts[3]
+            if len(parts) == 5 and method == 'GET':
+                return self.databases.list_documents(database_id, collection_id, queries=queries)
+            if len(parts) == 5 and method == 'POST':
+                return self.databases.create_document(
+                    database_id, collection_id, body['documentId'], body['data'], body.get('permissions')
+                )
+            if len(parts) == 6 and method == 'GET':
+                return self.databases.get_document(database_id, collection_id, parts[5])
+            if len(parts) == 6 and method == 'PATCH':
+                return self.databases.update_document(database_id, collection_id, parts[5], body.get('data'))
+
+        raise FakeAppwriteException(f"Route not found: {method} {path}", 404)
+
+    def render_course(self, course_id: int) -> str:
+        assignments = self.population.assignments_for(course_id)
+        if self.page_mode == 'ai':
+            items = ''.join(
+                f'<li data-assignment-id="{a["id"]}">{a["title"]} due {a["due_date"]}</li>'
+                for a in assignments
+            )
+            return f'<html><body><div id="course-{course_id}"><ul>{items}</ul></div></body></html>'
+
+        rows = []
+        for a in assignments:
+            score = (
+                f'<div class="submissionStatus--score">{a["score"]} / {a["total_points"]}</div>'
+                if a['score'] is not None
+                else '<div class="submissionStatus--text">No Submission</div>'
+            )
+            rows.append(
+                '<tr role="row">'
+                f'<th class="table--primaryLink" scope="row">'
+                f'<a href="/courses/{course_id}/assignments/{a["id"]}/submissions">{a["title"]}</a></th>'
+                f'<td class="submissionStatus">{score}</td>'
+                '<td class="submissionTimeChart">'
+                f'<time class="submissionTimeChart--dueDate" datetime="{a["due_date"]}">due</time>'
+                '</td></tr>'
+            )
+        return (
+            '<html><head><script>window.csrf = "x";</script></head><body>'
+            '<table id="assignments-student-table"><tbody>'
+            + ''.join(rows) +
+            '</tbody></table></body></html>'
+        )
+
+    def gemini_reply(self, body: Dict) -> Dict:
+        parts = [
+            part.get('text', '')
+            for content in body.get('contents', [])
+            for part in content.get('parts', [])
+        ]
+        if 'responseSchema' in body.get('generationConfig', {}):
+            # Batched extraction: one entry per "=== Course <id> ===" part
+            courses = []
+            for text in parts:
+                label = re.match(r'=== Course (\S+) ===', text)
+                page = re.search(r'id="course-(\d+)"', text)
+                if label and page:
+                    courses.append({
+                        'course_id': label.group(1),
+                        'assignments': self.population.assignments_for(int(page.group(1))),
+                    })
+            reply = json.dumps({'courses': courses})
+        else:
+            match = re.search(r'id="course-(\d+)"', ''.join(parts))
+            assignments = self.population.assignments_for(int(match.group(1))) if match else []
+            reply = '```json\n' + json.dumps({'assignments': assignments}) + '\n```'
+        return {'candidates': [{'content': {'parts': [{'text': reply}]}}]}
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Headers and body go out as separate writes; with Nagle on, the
+            # body waits for the client's delayed ACK (~40 ms per request)
+            disable_nagle_algorithm = True
+
+            def log_message(self, format, *args):
+                pass
+
+            def send_body(self, status: int, body: str, content_type: str = 'text/html'):
+                data = body.encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def user_index(self) -> Optional[int]:
+                match = re.search(r'_gradescope_session=([^;]+)', self.headers.get('Cookie', ''))
+                return stub.population.user_for_token(match.group(1)) if match else None
+
+            def is_appwrite(self) -> bool:
+                return stub.users is not None and self.path.startswith('/v1/')
+
+            def appwrite(self, method: str):
+                url = urlparse(self.path)
+                length = int(self.headers.get('Content-Length') or 0)
+                body = json.loads(self.rfile.read(length) or b'{}')
+                try:
+                    result = stub.appwrite_call(method, url.path[len('/v1'):], parse_qs(url.query), body)
+                except FakeAppwriteException as e:
+                    error = {'message': str(e), 'code': e.code, 'type': 'fake_appwrite_exception'}
+                    self.send_body(e.code, json.dumps(error), 'application/json')
+                    return
+                self.send_body(201 if method == 'POST' else 200, json.dumps(result), 'application/json')
+
+            def fault(self) -> bool:
+                """Apply the next queued fault; True if it answered the request"""
+                fault = stub.next_fault()
+                if fault is None:
+                    return False
+                if fault['delay']:
+                    time.sleep(fault['delay'])
+                if fault['status'] is None:
+                    return False
+                # Drain any request body so the kept-alive connection stays usable
+                self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                data = json.dumps({'error': {'code': fault['status']}}).encode('utf-8')
+                self.send_response(fault['status'])
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                if fault['retry_after'] is not None:
+                    self.send_header('Retry-After', fault['retry_after'])
+                self.end_headers()
+                self.wfile.write(data)
+                return True
+
+            def do_PATCH(self):
+                self.appwrite('PATCH')
+
+            def do_PUT(self):
+                self.appwrite('PUT')
+
+            def do_GET(self):
+                if self.is_appwrite():
+                    self.appwrite('GET')
+                    return
+                stub.requests.count('gradescope')
+                if self.fault():
+                    return
+                if stub.gradescope_latency:
+                    time.sleep(stub.gradescope_latency)
+
+                path = urlparse(self.path).path
+                user_index = self.user_index()
+                if user_index is None:
+                    self.send_response(302)
+                    self.send_header('Location', '/login')
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+
+                courses = stub.population.courses_for(user_index)
+                if path == '/account':
+                    boxes = ''.join(
+                        f'<a class="courseBox" href="/courses/{c["id"]}">'
+                        f'<h3 class="courseBox--shortname">{c["shortname"]}</h3>'
+                        f'<div class="courseBox--name">{c["name"]}</div></a>'
+                        for c in courses
+                    )
+                    self.send_body(
+                        200,
+                        '<html><body><div class="courseList">'
+                        '<div class="courseList--term">Fall 2026</div>'
+                        f'<div class="courseList--coursesForTerm">{boxes}</div>'
+                        '</div></body></html>'
+                    )
+                elif path == '/api/v1/courses' and stub.courses_api:
+                    self.send_body(200, json.dumps({'courses': courses}), 'application/json')
+                elif path.startswith('/courses/'):
+                    course_id = int(path.rstrip('/').rsplit('/', 1)[-1])
+                    if course_id not in {c['id'] for c in courses}:
+                        self.send_body(404, 'Not found')
+                    else:
+                        self.send_body(200, stub.render_course(course_id))
+                else:
+                    self.send_body(404, 'Not found')
+
+            def do_POST(self):
+                if self.is_appwrite():
+                    self.appwrite('POST')
+                    return
+                stub.requests.count('gemini')
+                if self.fault():
+                    return
+                # Like Gemini, the key is read from its header; one in the
+                # URL would leak into logs, so it is refused here
+                if not self.headers.get('x-goog-api-key') or 'key=' in self.path:
+                    self.send_body(401, json.dumps({'error': {'message': 'API key missing'}}), 'application/json')
+                    return
+                if stub.gemini_latency:
+                    time.sleep(stub.gemini_latency)
+                length = int(self.headers.get('Content-Length') or 0)
+                body = json.loads(self.rfile.read(length) or b'{}')
+                self.send_body(200, json.dumps(stub.gemini_reply(body)), 'application/json')
+
+        return Handler
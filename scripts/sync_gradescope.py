@@ -6,13 +6,27 @@ This script runs as a GitHub Action to sync Gradescope assignments
 for all connected users to the Appwrite database.
 
 Usage:
-    python sync_gradescope.py
+    python sync_gradescope.py [--workers N] [--course-workers N] [--write-workers N] [--full] [--backfill-labels]
+    python sync_gradescope.py --plan plan.jsonl     # compute changes without writing them
+    python sync_gradescope.py --replay plan.jsonl   # apply a saved plan
+    python sync_gradescope.py --shard 0/4           # one of 4 runners, see --merge-reports
+    python sync_gradescope.py --engine asyncio      # one event loop instead of worker threads
 
 Environment variables required:
     APPWRITE_ENDPOINT - Appwrite API endpoint
     APPWRITE_PROJECT_ID - Appwrite project ID
     APPWRITE_API_KEY - Appwrite API key with users and database permissions
     GRADESCOPE_ENCRYPTION_KEY - Base64-encoded 32-byte encryption key
+
+Optional environment variables:
+    SYNC_WORKERS - Number of users to sync concurrently (default: 4)
+    SYNC_COURSE_WORKERS - Number of courses fetched concurrently per user (default: 4)
+    SYNC_WRITE_WORKERS - Number of database writes sent concurrently per user (default: 4)
+    SYNC_SHARD - Default for --shard (i/N)
+    SYNC_ENGINE - Default for --engine: threads or asyncio (needs aiohttp)
+    GEMINI_PARSE_CACHE - Path of the Gemini parse cache (default: cache/parse_cache.sqlite)
+    SYNC_STATE_PATH - Path of the incremental sync state and Appwrite snapshot (default: cache/sync_state.sqlite)
+    GRADESCOPE_BASE_URL / GEMINI_API_BASE - Override the Gradescope / Gemini hosts (e.g. local stubs)
 """
 
 import os
@@ -20,9 +34,26 @@ import sys
 import json
 import logging
 import base64
+import argparse
+import asyncio
+import threading
+import hashlib
+import sqlite3
+import time
+import re
+import bisect
+import math
+import random
+import string
+import itertools
+from html.parser import HTMLParser
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from typing import List, Dict, Optional, Any
-from dataclasses import dataclass
+from urllib.parse import urlparse
+from typing import List, Dict, Optional, Any, Tuple, Union, Generator, Callable, Sequence
+from dataclasses import dataclass, field, asdict
 from difflib import SequenceMatcher
 
 from cryptography.hazmat.primitives.ciphers.aead import AESGCM
@@ -33,8 +64,18 @@ from appwrite.query import Query
 from appwrite.id import ID
 from appwrite.permission import Permission
 from appwrite.role import Role
+from appwrite.exception import AppwriteException
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    # Only needed by the asyncio engine (--engine asyncio)
+    import aiohttp
+    from yarl import URL
+except ImportError:
+    aiohttp = None
 
 # Configuration
 DATABASE_ID = "6971d0970008b1d89c01"
@@ -42,13 +83,153 @@ ASSIGNMENTS_COLLECTION = "assignment"
 COURSES_COLLECTION = "courses"
 CONFLICTS_COLLECTION = "conflicts"
 
-# Gradescope URLs
-GRADESCOPE_BASE_URL = "https://www.gradescope.com"
+# Page size for Appwrite list queries
+DOCUMENT_PAGE_SIZE = 500
+
+# Attributes needed for matching; everything else (notes, attachments, ...) is not fetched
+ASSIGNMENT_MATCH_FIELDS = ['$id', 'title', 'deadline', 'source', 'gradescopeId', 'courseId']
+COURSE_MATCH_FIELDS = ['$id', 'code', 'name', 'gradedItems', 'gradeWeights']
+
+# Appwrite user label marking users with Gradescope connected
+GRADESCOPE_USER_LABEL = "gradescope"
+
+# Gradescope URLs (overridable to point at a local stub server)
+GRADESCOPE_BASE_URL = os.environ.get('GRADESCOPE_BASE_URL', "https://www.gradescope.com")
+
+# Gemini
+GEMINI_API_BASE = os.environ.get('GEMINI_API_BASE', "https://generativelanguage.googleapis.com")
+GEMINI_MODEL = "gemini-2.0-flash"
+# Bump whenever the extraction prompt changes so cached parses are not reused
+GEMINI_PROMPT_VERSION = 1
+# Maximum characters of cleaned page HTML sent to Gemini
+GEMINI_MAX_INPUT_CHARS = 100000
+# Course pages that need Gemini are sent together, up to this many per
+# request (and GEMINI_MAX_INPUT_CHARS in total)
+GEMINI_BATCH_MAX_COURSES = 8
+# Per-page extraction rules; also the parse cache key's prompt, so cached
+# parses stay valid whichever batch a page was parsed in
+GEMINI_EXTRACTION_PROMPT = """
+        Extract assignments from this Gradescope course page HTML.
+        Return a JSON object with a key "assignments" containing a list.
+        Include ALL assignments, whether pending, submitted, or graded.
+        
+        Each item must have:
+        - id: string (assignment ID)
+        - title: string
+        - due_date: ISO 8601 string (Assume year {year} if missing. If completely missing but status is "Graded", estimate 1 month ago)
+        - score: number or null (Look for "X / Y" patterns)
+        - total_points: number or null
+        - status: string ("Submitted", "Graded", "No Submission", etc)
+        """
+GEMINI_BATCH_PROMPT = """
+        Each part after this one is a Gradescope course page, starting with a
+        line "=== Course <id> ===". For every course, return its id as course_id
+        and the assignments on its page, extracted as follows.
+        """
+# Structured output schema for batched extraction; the API guarantees a
+# response matching it, so no text scraping is needed
+GEMINI_ASSIGNMENT_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "id": {"type": "STRING"},
+        "title": {"type": "STRING"},
+        "due_date": {"type": "STRING", "nullable": True},
+        "score": {"type": "NUMBER", "nullable": True},
+        "total_points": {"type": "NUMBER", "nullable": True},
+        "status": {"type": "STRING"},
+    },
+    "required": ["id", "title", "due_date", "status"],
+}
+GEMINI_BATCH_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "courses": {
+            "type": "ARRAY",
+            "items": {
+                "type": "OBJECT",
+                "properties": {
+                    "course_id": {"type": "STRING"},
+                    "assignments": {"type": "ARRAY", "items": GEMINI_ASSIGNMENT_SCHEMA},
+                },
+                "required": ["course_id", "assignments"],
+            },
+        },
+    },
+    "required": ["courses"],
+}
+
+# Parse cache (kept between Actions runs via actions/cache)
+PARSE_CACHE_PATH = os.environ.get('GEMINI_PARSE_CACHE', 'cache/parse_cache.sqlite')
+PARSE_CACHE_TTL_DAYS = 14
+PARSE_CACHE_MAX_ENTRIES = 20000
+
+# Incremental sync state (kept between Actions runs via actions/cache)
+SYNC_STATE_PATH = os.environ.get('SYNC_STATE_PATH', 'cache/sync_state.sqlite')
+# Snapshot reads also re-fetch documents updated this long before the
+# watermark, covering writes committed out of order around it
+SNAPSHOT_OVERLAP_SECONDS = 300
+# A course whose latest deadline is this old is treated as a finished term...
+FINISHED_COURSE_AGE_DAYS = 30
+# ...and is only re-fetched this often
+FINISHED_COURSE_RECHECK_DAYS = 7
+
+# Matching
+TITLE_SIMILARITY_THRESHOLD = 0.8
+DEADLINE_MATCH_WINDOW_SECONDS = 48 * 60 * 60
+
+# Outbound HTTP: (connect, read) timeouts per host, and retry policy for 429/5xx
+HTTP_TIMEOUTS = {
+    urlparse(GRADESCOPE_BASE_URL).hostname: (5, 30),
+    urlparse(GEMINI_API_BASE).hostname: (5, 120),
+}
+HTTP_DEFAULT_TIMEOUT = (5, 30)
+HTTP_MAX_RETRIES = 3
+HTTP_BACKOFF_FACTOR = 1.0
+HTTP_RETRY_STATUSES = (429, 500, 502, 503, 504)
+# Longest wait between retries, including a server's Retry-After
+HTTP_BACKOFF_MAX = 120
+# Run report phase names for outbound HTTP
+HTTP_TRACE_PHASES = {
+    urlparse(GRADESCOPE_BASE_URL).hostname: 'gradescope_http',
+    urlparse(GEMINI_API_BASE).hostname: 'gemini',
+}
+
+# Machine-readable run report, uploaded with sync.log by the workflow
+RUN_REPORT_PATH = 'logs/sync_report.json'
+# Plan mode counts the writes it would send under these stats instead
+PLANNED_STATS = {
+    'assignments_synced': 'planned_assignments',
+    'conflicts_created': 'planned_conflicts',
+    'writes_sent': 'planned_writes',
+}
+
+# Outbound rate limits as (requests per second, burst), per host and per Gemini API key.
+# The host limits are for the whole run: with --shard i/N each shard gets 1/N of them
+RATE_LIMITS = {
+    urlparse(GRADESCOPE_BASE_URL).hostname: (5.0, 10),
+    urlparse(GEMINI_API_BASE).hostname: (10.0, 20),
+}
+# Gemini free tier allows 15 requests per minute per key
+GEMINI_KEY_RATE_LIMIT = (15 / 60, 5)
+
+# Concurrency
+DEFAULT_SYNC_WORKERS = 4
+DEFAULT_COURSE_WORKERS = 4
+DEFAULT_WRITE_WORKERS = 4
+# Users are listed and decrypted in pages of this size
+USER_PAGE_SIZE = 100
+# Users handed to the pool per worker before enumeration waits
+USER_QUEUE_DEPTH = 2
+
+# asyncio engine (--engine asyncio): connections open at once across all
+# users, and how long planning one user may take before it is cancelled
+ASYNC_MAX_CONNECTIONS = 256
+ASYNC_USER_PLAN_TIMEOUT = 300
 
 # Setup logging
 logging.basicConfig(
     level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    format='%(asctime)s - %(name)s - %(threadName)s - %(levelname)s - %(message)s',
     handlers=[
         logging.FileHandler('logs/sync.log'),
         logging.StreamHandler(sys.stdout)
@@ -57,7 +238,7 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class GradescopeAssignment:
     """Represents an assignment from Gradescope"""
     id: str
@@ -68,9 +249,16 @@ class GradescopeAssignment:
     points_possible: Optional[float] = None
     score: Optional[float] = None
     submission_status: Optional[str] = None
+    # Match keys computed once: lowercased title, deadline in epoch seconds
+    title_key: str = field(init=False, repr=False, compare=False)
+    deadline_ts: float = field(init=False, repr=False, compare=False)
 
+    def __post_init__(self):
+        object.__setattr__(self, 'title_key', self.title.lower())
+        object.__setattr__(self, 'deadline_ts', self.deadline.timestamp())
 
-@dataclass
+
+@dataclass(frozen=True, slots=True)
 class ConnectedUser:
     """Represents a user with Gradescope connected"""
     id: str
@@ -78,771 +266,4258 @@ class ConnectedUser:
     encrypted_token: str
     token_expiry: Optional[datetime] = None
     encrypted_gemini_key: Optional[str] = None
+    # A tuple, so the frozen instance stays hashable
+    labels: Tuple[str, ...] = ()
+    last_sync: Optional[str] = None
 
 
-class TokenDecryption:
-    """Handles decryption of Gradescope session tokens"""
+@dataclass
+class UserSecrets:
+    """Decrypted credentials for one user, held only for the length of a run"""
+    session_token: Optional[str] = field(default=None, repr=False)
+    gemini_key: Optional[str] = field(default=None, repr=False)
+    error: Optional[str] = None
 
-    def __init__(self, encryption_key: str):
-        # Key is base64-encoded 32-byte key
-        self.key = base64.b64decode(encryption_key)
-        if len(self.key) != 32:
-            raise ValueError("Encryption key must be 32 bytes")
 
-    def decrypt(self, encrypted_data: str) -> str:
-        """
-        Decrypt data encrypted by the Node.js encryption module.
-        Format: iv:authTag:encryptedData (all base64)
-        """
-        parts = encrypted_data.split(':')
-        if len(parts) != 3:
-            raise ValueError("Invalid encrypted data format")
+@dataclass
+class CourseState:
+    """What the last successful sync saw for one Gradescope course"""
+    fingerprint: str
+    assignments: List[Dict]
+    # Fingerprints of assignments that were applied to the database
+    processed: List[str]
+    checked_at: float
+    latest_deadline: Optional[float] = None
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
 
-        iv = base64.b64decode(parts[0])
-        auth_tag = base64.b64decode(parts[1])
-        ciphertext = base64.b64decode(parts[2])
+    def is_finished(self, now: float) -> bool:
+        """True if every assignment is long past due (e.g. a past term)"""
+        return (
+            self.latest_deadline is not None
+            and self.latest_deadline < now - FINISHED_COURSE_AGE_DAYS * 24 * 60 * 60
+        )
 
-        # AES-GCM: ciphertext + auth_tag
-        aesgcm = AESGCM(self.key)
-        plaintext = aesgcm.decrypt(iv, ciphertext + auth_tag, None)
+    def recently_checked(self, now: float) -> bool:
+        return now - self.checked_at < FINISHED_COURSE_RECHECK_DAYS * 24 * 60 * 60
 
-        return plaintext.decode('utf-8')
 
+@dataclass
+class CourseFetch:
+    """Result of fetching one course page"""
+    assignments: List[Dict]
+    fingerprint: Optional[str] = None
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+    # Page matches the previous sync (fingerprint, ETag or not re-fetched)
+    unchanged: bool = False
+    # Page was not requested at all (finished course checked recently)
+    skipped: bool = False
+    # Fetch or parse failed; nothing should be recorded for this course
+    failed: bool = False
+    # Page that needs Gemini, waiting to be parsed with the user's other such pages
+    pending_page: Optional[str] = field(default=None, repr=False)
 
-class GradescopeClient:
-    """Client for interacting with Gradescope"""
 
-    def __init__(self, session_token: str):
-        self.session = requests.Session()
-        self.session.cookies.set('_gradescope_session', session_token, domain='www.gradescope.com')
+@dataclass
+class PlannedWrite:
+    """One document create or update in a user's write plan"""
+    collection_id: str
+    data: Dict[str, Any]
+    # None creates a new document
+    document_id: Optional[str] = None
+    permissions: Optional[List[str]] = None
+    # Stats counter incremented when the write succeeds
+    stat: Optional[str] = None
+    description: str = ''
+    # (course id, assignment fingerprint) pairs that are only processed once this write succeeds
+    dependents: List[Tuple[str, str]] = field(default_factory=list)
 
-    def get_courses(self) -> List[Dict]:
-        """Fetch all courses for the user"""
-        try:
-            # Gradescope dashboard page contains course info
-            response = self.session.get(f"{GRADESCOPE_BASE_URL}/account")
-            if response.status_code != 200:
-                logger.error(f"Failed to fetch courses: {response.status_code}")
-                return []
 
-            # Parse courses from HTML or try API endpoint
-            # Note: Gradescope doesn't have a public API, so we may need to scrape
-            # For now, try the courses API endpoint that some implementations use
+@dataclass
+class AppwriteCall:
+    """
+    One Appwrite request. The sync steps both engines share (GradescopeSyncer's
+    `*_steps` generators) yield these and are sent the response back; each
+    engine makes the request on its own client (see GradescopeSyncer.perform).
+    """
+    # 'databases' or 'users'
+    service: str
+    method: str
+    args: Tuple = ()
+    kwargs: Dict[str, Any] = field(default_factory=dict)
 
-            response = self.session.get(f"{GRADESCOPE_BASE_URL}/api/v1/courses")
-            if response.status_code == 200:
-                data = response.json()
-                return data.get('courses', [])
+    @classmethod
+    def databases(cls, method: str, *args, **kwargs) -> 'AppwriteCall':
+        return cls('databases', method, args, kwargs)
 
-            # Fallback: return empty if API not available
-            logger.warning("Gradescope API not available, returning empty courses")
-            return []
+    @classmethod
+    def users(cls, method: str, *args, **kwargs) -> 'AppwriteCall':
+        return cls('users', method, args, kwargs)
 
-        except Exception as e:
-            logger.error(f"Error fetching courses: {e}")
-            return []
 
-    def get_assignments(self, course_id: str, gemini_key: Optional[str] = None) -> List[Dict]:
-        """Fetch assignments for a specific course"""
-        try:
-            # Gradescope assignment page
-            response = self.session.get(
-                f"{GRADESCOPE_BASE_URL}/courses/{course_id}"
-            )
-            
-            if response.status_code != 200:
-                logger.error(f"Failed to fetch course page: {response.status_code}")
-                return []
+@dataclass
+class LocalCall:
+    """
+    Blocking local work (the SQLite caches) yielded by sync steps, so the
+    asyncio engine can run it on a worker thread instead of the event loop
+    """
+    function: Callable
+    args: Tuple = ()
 
-            # Prioritize AI Parsing
-            if gemini_key:
-                logger.info(f"Using Gemini AI to parse assignments for course {course_id}")
-                assignments = self.parse_with_ai(response.text, gemini_key)
-                if assignments:
-                    return assignments
-                logger.warning("AI parsing yielded no results, falling back to standard parsing")
 
-            # Try to parse as JSON (if API exists)
-            try:
-                data = response.json()
-                return data.get('assignments', [])
-            except:
-                pass
-                
-            logger.warning(f"No Gemini Key or parsing failed - Skipping assignment parsing for {course_id}")
-            return []
-            
-        except Exception as e:
-            logger.error(f"Error fetching assignments for course {course_id}: {e}")
-            return []
+# A generator of AppwriteCalls and LocalCalls returning a result, run by
+# perform or perform_async
+SyncSteps = Generator[Union[AppwriteCall, LocalCall], Any, Any]
 
-    def parse_with_ai(self, html_content: str, api_key: str) -> List[Dict]:
-        """Parse HTML using Gemini"""
-        import re
-        
-        # Clean HTML
-        clean_html = re.sub(r'<script\b[^>]*>[\s\S]*?</script>', '', html_content)
-        clean_html = re.sub(r'<style\b[^>]*>[\s\S]*?</style>', '', clean_html)
-        clean_html = re.sub(r'<svg\b[^>]*>[\s\S]*?</svg>', '', clean_html)
-        
-        prompt = """
-        Extract assignments from this Gradescope course page HTML.
-        Return a JSON object with a key "assignments" containing a list.
-        Include ALL assignments, whether pending, submitted, or graded.
-        
-        Each item must have:
-        - id: string (assignment ID)
-        - title: string
-        - due_date: ISO 8601 string (Assume year {year} if missing. If completely missing but status is "Graded", estimate 1 month ago)
-        - score: number or null (Look for "X / Y" patterns)
-        - total_points: number or null
-        - status: string ("Submitted", "Graded", "No Submission", etc)
-        """
-        
-        api_url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash:generateContent?key={api_key}"
-        
-        current_year = datetime.now().year
-        final_prompt = prompt.format(year=current_year)
-        
-        payload = {
-            "contents": [{
-                "parts": [{"text": final_prompt}, {"text": clean_html[:100000]}] 
-            }]
-        }
-        
-        try:
-            res = requests.post(api_url, json=payload, headers={'Content-Type': 'application/json'})
-            if res.status_code != 200:
-                logger.error(f"Gemini API Error: {res.text}")
-                return []
-                
-            result = res.json()
-            if 'candidates' not in result or not result['candidates']:
-                return []
-                
-            text = result['candidates'][0]['content']['parts'][0]['text']
-            
-            # Extract JSON
-            match = re.search(r'```json\s*({.*})\s*```', text, re.DOTALL)
-            if match:
-                json_str = match.group(1)
-            else:
-                start = text.find('{')
-                end = text.rfind('}') + 1
-                json_str = text[start:end] if start != -1 else "{}"
-            
-            data = json.loads(json_str)
-            return data.get('assignments', [])
-            
-        except Exception as e:
-            logger.error(f"AI Parse Error: {e}")
-            return []
 
-    def verify_session(self) -> bool:
-        """Verify the session is still valid"""
+@dataclass(frozen=True, slots=True)
+class ExistingAssignment:
+    """The fields of an existing assignment document that matching needs"""
+    id: str
+    title: str
+    deadline: Optional[str]
+    source: Optional[str] = None
+    gradescope_id: Optional[str] = None
+    course_id: Optional[str] = None
+    # Match keys computed once: lowercased title, deadline in epoch seconds
+    # (None if missing or unparseable)
+    title_key: str = field(default='', repr=False, compare=False)
+    deadline_ts: Optional[float] = field(default=None, repr=False, compare=False)
+
+    @classmethod
+    def from_document(cls, document: Dict) -> 'ExistingAssignment':
+        title = document.get('title') or ''
+        deadline = document.get('deadline')
         try:
-            response = self.session.get(f"{GRADESCOPE_BASE_URL}/account", allow_redirects=False)
-            # If redirected to login, session is invalid
-            return response.status_code == 200
-        except Exception as e:
-            logger.error(f"Error verifying session: {e}")
-            return False
+            deadline_ts = parse_iso_datetime(deadline).timestamp()
+        except (TypeError, ValueError, AttributeError):
+            deadline_ts = None
+        return cls(
+            id=document['$id'],
+            title=title,
+            deadline=deadline,
+            source=document.get('source'),
+            gradescope_id=document.get('gradescopeId'),
+            course_id=document.get('courseId'),
+            title_key=title.lower(),
+            deadline_ts=deadline_ts
+        )
 
 
-class GradescopeSyncer:
-    """Main sync orchestrator"""
+@dataclass(frozen=True, slots=True)
+class InternalCourse:
+    """An internal course with its code and name normalized for matching"""
+    id: str
+    code_key: str
+    name_key: str
+    # The course document as read (gradedItems etc.), for grade merging
+    document: Dict[str, Any] = field(repr=False, compare=False)
 
-    def __init__(self):
-        # Initialize Appwrite client
-        self.client = Client()
-        self.client.set_endpoint(os.environ['APPWRITE_ENDPOINT'])
-        self.client.set_project(os.environ['APPWRITE_PROJECT_ID'])
-        self.client.set_key(os.environ['APPWRITE_API_KEY'])
+    @classmethod
+    def from_document(cls, document: Dict) -> 'InternalCourse':
+        return cls(
+            id=document['$id'],
+            code_key=normalize_key(document.get('code')),
+            name_key=normalize_key(document.get('name')),
+            document=document
+        )
 
-        self.databases = Databases(self.client)
-        self.users_service = Users(self.client)
 
-        # Initialize token decryption
-        self.decryptor = TokenDecryption(os.environ['GRADESCOPE_ENCRYPTION_KEY'])
+def normalize_key(text: Optional[str]) -> str:
+    """Lowercased alphanumerics only; the form course codes and names are compared in"""
+    return ''.join(c for c in (text or '').lower() if c.isalnum())
 
-        # Stats
-        self.stats = {
-            'users_processed': 0,
-            'users_skipped': 0,
-            'assignments_synced': 0,
-            'conflicts_created': 0,
-            'errors': []
-        }
 
-    def get_connected_users(self) -> List[ConnectedUser]:
-        """Fetch all users with Gradescope connected"""
-        connected_users = []
+def parse_iso_datetime(value: str) -> datetime:
+    """Parse an ISO 8601 string as stored by Appwrite (accepts a trailing Z)"""
+    return datetime.fromisoformat(value.replace('Z', '+00:00'))
 
-        try:
-            # List all users (paginated)
-            offset = 0
-            limit = 100
 
-            while True:
-                response = self.users_service.list(
-                    queries=[Query.limit(limit), Query.offset(offset)]
-                )
+def newest_update(documents) -> str:
+    """Latest `$updatedAt` among documents, as Appwrite formatted it ('' if none)"""
+    return max(
+        (document['$updatedAt'] for document in documents if document.get('$updatedAt')),
+        key=parse_iso_datetime,
+        default=''
+    )
 
-                for user in response['users']:
-                    prefs = user.get('prefs', {})
-
-                    # Check if Gradescope is connected
-                    if prefs.get('gradescopeConnected') and prefs.get('gradescopeSessionToken'):
-                        # Check if token is not expired
-                        token_expiry = None
-                        if prefs.get('gradescopeTokenExpiry'):
-                            token_expiry = datetime.fromisoformat(
-                                prefs['gradescopeTokenExpiry'].replace('Z', '+00:00')
-                            )
-                            if token_expiry < datetime.now(token_expiry.tzinfo):
-                                logger.info(f"Token expired for user {user['$id']}")
-                                self.mark_token_expired(user['$id'])
-                                continue
-
-                        connected_users.append(ConnectedUser(
-                            id=user['$id'],
-                            email=prefs.get('gradescopeEmail', 'unknown'),
-                            encrypted_token=prefs['gradescopeSessionToken'],
-                            token_expiry=token_expiry,
-                            encrypted_gemini_key=prefs.get('geminiApiKey')
-                        ))
-
-                # Check if there are more users
-                if len(response['users']) < limit:
-                    break
-                offset += limit
 
-        except Exception as e:
-            logger.error(f"Error fetching connected users: {e}")
-            self.stats['errors'].append(f"Failed to fetch users: {e}")
+def assignment_fingerprint(assignment_data: Dict, internal_course_id: str) -> str:
+    """Stable hash of a parsed assignment and the internal course it maps to"""
+    payload = json.dumps(assignment_data, sort_keys=True, default=str) + '\0' + internal_course_id
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:32]
 
-        return connected_users
 
-    def mark_token_expired(self, user_id: str):
-        """Mark a user's token as expired"""
+def latest_deadline(assignments: List[Dict]) -> Optional[float]:
+    """Latest due date (epoch seconds) among parsed assignments"""
+    latest = None
+    for assignment_data in assignments:
+        deadline_str = assignment_data.get('due_date') or assignment_data.get('due_at')
+        if not deadline_str:
+            continue
         try:
-            self.users_service.update_prefs(user_id, {
-                'gradescopeConnected': False
-            })
-            logger.info(f"Marked token as expired for user {user_id}")
-        except Exception as e:
-            logger.error(f"Failed to mark token expired for user {user_id}: {e}")
+            deadline = parse_iso_datetime(deadline_str).timestamp()
+        except (TypeError, ValueError, AttributeError):
+            continue
+        if latest is None or deadline > latest:
+            latest = deadline
+    return latest
 
-    def get_user_courses(self, user_id: str) -> List[Dict]:
-        """Get existing courses for a user"""
-        try:
-            courses = []
-            offset = 0
-            limit = 100
 
-            while True:
-                response = self.databases.list_documents(
-                    DATABASE_ID,
-                    COURSES_COLLECTION,
-                    queries=[
-                        Query.equal('userId', user_id),
-                        Query.limit(limit),
-                        Query.offset(offset)
-                    ]
-                )
+class SyncTracer:
+    """
+    Lightweight timing of sync phases.
 
-                courses.extend(response['documents'])
+    Records every timed call per phase (Gradescope HTTP, Gemini, Appwrite
+    reads/writes, ...) plus per-user and per-course durations, and
+    summarises them as latency histograms for the run report.
+    """
 
-                if len(response['documents']) < limit:
-                    break
-                offset += limit
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._samples: Dict[str, List[float]] = {}
+        self._users: Dict[str, float] = {}
+        self._courses: List[Tuple[float, str, str]] = []
 
-            return courses
-        except Exception as e:
-            logger.error(f"Error fetching courses for user {user_id}: {e}")
-            return []
+    def record(self, phase: str, seconds: float):
+        with self._lock:
+            self._samples.setdefault(phase, []).append(seconds)
 
-    def get_user_assignments(self, user_id: str) -> List[Dict]:
-        """Get existing assignments for a user"""
+    @contextmanager
+    def phase(self, name: str):
+        """Time the enclosed block as one call of `name`"""
+        started = time.perf_counter()
         try:
-            assignments = []
-            offset = 0
-            limit = 100
+            yield
+        finally:
+            self.record(name, time.perf_counter() - started)
 
-            while True:
-                response = self.databases.list_documents(
-                    DATABASE_ID,
-                    ASSIGNMENTS_COLLECTION,
-                    queries=[
-                        Query.equal('userId', user_id),
-                        Query.limit(limit),
-                        Query.offset(offset)
-                    ]
-                )
+    def record_user(self, user_id: str, seconds: float):
+        self.record('user', seconds)
+        with self._lock:
+            self._users[user_id] = seconds
 
-                assignments.extend(response['documents'])
+    def record_course(self, user_id: str, course_id: str, seconds: float):
+        self.record('course', seconds)
+        with self._lock:
+            self._courses.append((seconds, user_id, course_id))
 
-                if len(response['documents']) < limit:
-                    break
-                offset += limit
+    @staticmethod
+    def percentile(ordered: List[float], fraction: float) -> float:
+        """Nearest-rank percentile of an already sorted list"""
+        if not ordered:
+            return 0.0
+        rank = max(1, math.ceil(fraction * len(ordered)))
+        return ordered[rank - 1]
 
-            return assignments
+    def summary(self, slowest: int = 10) -> Dict[str, Any]:
+        with self._lock:
+            samples = {name: sorted(values) for name, values in self._samples.items()}
+            users = sorted(self._users.items(), key=lambda item: item[1], reverse=True)[:slowest]
+            courses = sorted(self._courses, reverse=True)[:slowest]
 
-        except Exception as e:
-            logger.error(f"Error fetching assignments for user {user_id}: {e}")
-            return []
+        return {
+            'phases': {
+                name: {
+                    'count': len(values),
+                    'total': round(sum(values), 4),
+                    'p50': round(self.percentile(values, 0.50), 4),
+                    'p95': round(self.percentile(values, 0.95), 4),
+                    'max': round(values[-1], 4) if values else 0.0,
+                }
+                for name, values in samples.items()
+            },
+            'slowest_users': [
+                {'user_id': user_id, 'seconds': round(seconds, 4)} for user_id, seconds in users
+            ],
+            'slowest_courses': [
+                {'user_id': user_id, 'course_id': course_id, 'seconds': round(seconds, 4)}
+                for seconds, user_id, course_id in courses
+            ],
+        }
 
-    def find_similar_assignment(
-        self,
-        existing: List[Dict],
-        gs_assignment: GradescopeAssignment
-    ) -> Optional[Dict]:
-        """
-        Find a potentially matching manual assignment.
 
-        Matching criteria:
-        1. Title similarity > 80%
-        2. Deadline within 48 hours
-        """
-        for assignment in existing:
-            # Skip if already from Gradescope
-            if assignment.get('source') == 'gradescope':
+class TracedService:
+    """
+    Proxy around an Appwrite service that times every call, filed under
+    `<prefix>_read` (get/list) or `<prefix>_write` (everything else).
+    """
+
+    READ_PREFIXES = ('get', 'list')
+
+    def __init__(self, service: Any, tracer: SyncTracer, prefix: str = 'appwrite'):
+        self._service = service
+        self._tracer = tracer
+        self._prefix = prefix
+
+    def __getattr__(self, name: str):
+        attribute = getattr(self._service, name)
+        if not callable(attribute):
+            return attribute
+
+        kind = 'read' if name.startswith(self.READ_PREFIXES) else 'write'
+        phase = f"{self._prefix}_{kind}"
+
+        def traced(*args, **kwargs):
+            with self._tracer.phase(phase):
+                return attribute(*args, **kwargs)
+
+        return traced
+
+
+class AssignmentIndex:
+    """
+    Lookup structures over a user's existing assignments, built once per user.
+
+    Documents are reduced to compact ExistingAssignment records, so the
+    full document list can be released once the index is built.
+
+    - `by_gradescope_id`: gradescopeId -> record
+    - manual (non-Gradescope) assignments sorted by their precomputed
+      deadline, so similarity checks only score candidates inside the
+      deadline window.
+    """
+
+    def __init__(self, assignments: List[Dict]):
+        self.by_gradescope_id: Dict[str, ExistingAssignment] = {}
+        manual = []
+
+        for position, document in enumerate(assignments):
+            assignment = ExistingAssignment.from_document(document)
+            gradescope_id = assignment.gradescope_id
+            if gradescope_id and gradescope_id not in self.by_gradescope_id:
+                self.by_gradescope_id[gradescope_id] = assignment
+
+            if assignment.source == 'gradescope' or assignment.deadline_ts is None:
                 continue
+            manual.append((assignment.deadline_ts, position, assignment))
+
+        manual.sort(key=lambda entry: (entry[0], entry[1]))
+        self._manual = manual
+        self._manual_deadlines = [entry[0] for entry in manual]
 
-            # Check title similarity
-            title_similarity = SequenceMatcher(
-                None,
-                assignment['title'].lower(),
-                gs_assignment.title.lower()
-            ).ratio()
+    def find_by_gradescope_id(self, gradescope_id: str) -> Optional[ExistingAssignment]:
+        return self.by_gradescope_id.get(gradescope_id)
 
-            if title_similarity < 0.8:
+    def find_similar(self, title_key: str, deadline_ts: float) -> Optional[ExistingAssignment]:
+        """
+        Return the first (in original document order) manual assignment whose
+        deadline is within the match window and whose title is similar enough.
+        Takes the lowercased title and the deadline in epoch seconds.
+        """
+        target = deadline_ts
+        lo = bisect.bisect_left(self._manual_deadlines, target - DEADLINE_MATCH_WINDOW_SECONDS)
+        hi = bisect.bisect_right(self._manual_deadlines, target + DEADLINE_MATCH_WINDOW_SECONDS)
+        if lo >= hi:
+            return None
+
+        title = title_key
+        matcher = SequenceMatcher(None, b=title)
+        best = None
+
+        for _, position, assignment in self._manual[lo:hi]:
+            if best is not None and position > best[0]:
+                continue
+            candidate_title = assignment.title_key
+            # ratio() can never exceed 2*min(len)/sum(len); skip before scoring
+            total = len(candidate_title) + len(title)
+            if total and 2.0 * min(len(candidate_title), len(title)) / total < TITLE_SIMILARITY_THRESHOLD:
+                continue
+            matcher.set_seq1(candidate_title)
+            if matcher.real_quick_ratio() < TITLE_SIMILARITY_THRESHOLD:
+                continue
+            if matcher.quick_ratio() < TITLE_SIMILARITY_THRESHOLD:
                 continue
+            if matcher.ratio() < TITLE_SIMILARITY_THRESHOLD:
+                continue
+            best = (position, assignment)
 
-            # Check deadline proximity (within 48 hours)
-            existing_deadline = datetime.fromisoformat(
-                assignment['deadline'].replace('Z', '+00:00')
-            )
-            deadline_diff = abs((existing_deadline - gs_assignment.deadline).total_seconds())
+        return best[1] if best else None
 
-            if deadline_diff <= 48 * 60 * 60:  # 48 hours in seconds
-                return assignment
 
-        return None
+class CourseResolver:
+    """
+    Resolves a user's Gradescope courses to their internal courses, built
+    once per user.
 
-    def find_by_gradescope_id(
-        self,
-        existing: List[Dict],
-        gradescope_id: str
-    ) -> Optional[Dict]:
-        """Find an assignment by its Gradescope ID"""
-        for assignment in existing:
-            if assignment.get('gradescopeId') == gradescope_id:
-                return assignment
-        return None
+    Candidates come from exact-match dicts (normalized code, normalized
+    name) and a substring index over codes, and the best one wins:
+    exact code > exact name > code containment (either way round, longer
+    overlap first), ties broken by course id, so the result does not
+    depend on document order. Links remembered from earlier runs
+    (`cached_links`) are reused without a search while the internal course
+    still matches the Gradescope course and no other course is a better
+    exact match; after a rename the link is dropped and resolved afresh.
+    """
 
-    def create_assignment(
-        self,
-        user_id: str,
-        gs_assignment: GradescopeAssignment
-    ) -> Optional[str]:
-        """Create a new assignment from Gradescope data"""
-        try:
-            doc = self.databases.create_document(
-                DATABASE_ID,
-                ASSIGNMENTS_COLLECTION,
-                ID.unique(),
-                {
-                    'title': gs_assignment.title,
-                    'courseId': '',  # Will need to be mapped manually
-                    'deadline': gs_assignment.deadline.isoformat(),
-                    'status': 'not_started',
-                    'category': 'assignment',
-                    'userId': user_id,
-                    'source': 'gradescope',
-                    'gradescopeId': gs_assignment.id,
-                    'gradescopeCourseId': gs_assignment.course_id,
-                    'gradescopeCourseName': gs_assignment.course_name,
-                    'tags': [],
-                    'notes': f'Imported from Gradescope ({gs_assignment.course_name})',
-                    'attachmentFileId': None,
-                    'attachmentFileName': None,
-                    'completedAt': None,
-                    'googleCalendarEventId': None,
-                    'calendarSynced': False
-                },
-                [
-                    Permission.read(Role.user(user_id)),
-                    Permission.update(Role.user(user_id)),
-                    Permission.delete(Role.user(user_id))
-                ]
-            )
-            return doc['$id']
-        except Exception as e:
-            logger.error(f"Error creating assignment: {e}")
+    def __init__(self, internal_courses: List[InternalCourse], cached_links: Optional[Dict[str, str]] = None):
+        self.by_id: Dict[str, InternalCourse] = {}
+        self.by_code: Dict[str, List[InternalCourse]] = {}
+        self.by_name: Dict[str, List[InternalCourse]] = {}
+        # Every substring of every code -> courses whose code contains it
+        self._code_substrings: Dict[str, List[InternalCourse]] = {}
+
+        for course in internal_courses:
+            self.by_id[course.id] = course
+            if course.name_key:
+                self.by_name.setdefault(course.name_key, []).append(course)
+            if course.code_key:
+                self.by_code.setdefault(course.code_key, []).append(course)
+                code = course.code_key
+                substrings = {code[i:j] for i in range(len(code)) for j in range(i + 1, len(code) + 1)}
+                for substring in substrings:
+                    self._code_substrings.setdefault(substring, []).append(course)
+
+        self._cached_links = cached_links or {}
+        # Gradescope course id -> internal course id resolved this run
+        self.links: Dict[str, str] = {}
+
+    def resolve(self, gradescope_course_id: str, name: str, shortname: str) -> str:
+        """Internal course id for a Gradescope course, or '' if none matches"""
+        name_key = normalize_key(name)
+        short_key = normalize_key(shortname)
+
+        cached = self.by_id.get(self._cached_links.get(gradescope_course_id, ''))
+        if cached is not None and self.link_holds(cached, name_key, short_key):
+            self.links[gradescope_course_id] = cached.id
+            return cached.id
+
+        course = self.best_match(name_key, short_key)
+        if course is None:
+            return ''
+        self.links[gradescope_course_id] = course.id
+        return course.id
+
+    @staticmethod
+    def match_tier(course: InternalCourse, name_key: str, short_key: str) -> int:
+        """3 exact code, 2 exact name, 1 code containment, 0 no match (as in best_match)"""
+        if short_key and course.code_key == short_key:
+            return 3
+        if name_key and course.name_key == name_key:
+            return 2
+        if short_key and course.code_key and (short_key in course.code_key or course.code_key in short_key):
+            return 1
+        return 0
+
+    def link_holds(self, course: InternalCourse, name_key: str, short_key: str) -> bool:
+        """Whether a remembered link to `course` is still the right one"""
+        tier = self.match_tier(course, name_key, short_key)
+        if tier == 0:
+            return False
+        # Another course matching exactly, and better than the linked one, wins
+        if tier < 3 and any(other.id != course.id for other in self.by_code.get(short_key, [])):
+            return False
+        if tier < 2 and any(other.id != course.id for other in self.by_name.get(name_key, [])):
+            return False
+        return True
+
+    def best_match(self, name_key: str, short_key: str) -> Optional[InternalCourse]:
+        # (tier, overlap) per candidate; higher is better
+        scores: Dict[str, Tuple[int, float]] = {}
+
+        def consider(course: InternalCourse, score: Tuple[int, float]):
+            if score > scores.get(course.id, (0, 0.0)):
+                scores[course.id] = score
+
+        if short_key:
+            for course in self.by_code.get(short_key, []):
+                consider(course, (3, 1.0))
+            # Gradescope short name contained in a code
+            for course in self._code_substrings.get(short_key, []):
+                consider(course, (1, len(short_key) / len(course.code_key)))
+            # A code contained in the Gradescope short name
+            for i in range(len(short_key)):
+                for j in range(i + 1, len(short_key) + 1):
+                    for course in self.by_code.get(short_key[i:j], []):
+                        consider(course, (1, (j - i) / len(short_key)))
+        if name_key:
+            for course in self.by_name.get(name_key, []):
+                consider(course, (2, 1.0))
+
+        if not scores:
             return None
+        best_id = min(scores, key=lambda course_id: (-scores[course_id][0], -scores[course_id][1], course_id))
+        return self.by_id[best_id]
 
-    def update_assignment(self, assignment_id: str, updates: Dict):
-        """Update an existing assignment"""
-        try:
-            self.databases.update_document(
-                DATABASE_ID,
-                ASSIGNMENTS_COLLECTION,
-                assignment_id,
-                updates
-            )
-        except Exception as e:
-            logger.error(f"Error updating assignment {assignment_id}: {e}")
 
-    def update_course_grades(
+class WritePlan:
+    """
+    The database writes one user's sync needs, collected before any is sent.
+
+    Writes are keyed so each document gets at most one request: a repeated
+    create (the same Gradescope assignment listed twice) is merged into the
+    first, and updates to one document are merged into a single request
+    carrying only the changed fields. `naive_writes` counts the requests
+    sending every change separately would have taken.
+    """
+
+    def __init__(self):
+        self.writes: Dict[Tuple[str, ...], PlannedWrite] = {}
+        self.naive_writes = 0
+
+    def __len__(self) -> int:
+        return len(self.writes)
+
+    def create(
         self,
-        course_id: str,
-        title: str,
-        score: float,
-        total: float
+        key: Tuple[str, ...],
+        collection_id: str,
+        data: Dict[str, Any],
+        permissions: List[str],
+        dependent: Tuple[str, str],
+        stat: Optional[str] = None,
+        description: str = '',
+        naive_writes: int = 1
     ):
-        """Update existing course grades"""
-        try:
-            # Re-fetch course to get latest gradedItems
-            course = self.databases.get_document(
-                DATABASE_ID,
-                COURSES_COLLECTION,
-                course_id
+        self.naive_writes += naive_writes
+        write = self.writes.get(key)
+        if write is None:
+            write = self.writes[key] = PlannedWrite(
+                collection_id, {}, None, permissions, stat, description
             )
-            
-            graded_items = []
-            if course.get('gradedItems'):
+        write.data.update(data)
+        write.dependents.append(dependent)
+
+    def update(
+        self,
+        collection_id: str,
+        document_id: str,
+        changes: Dict[str, Any],
+        dependent: Tuple[str, str],
+        description: str = ''
+    ):
+        self.naive_writes += 1
+        key = ('update', collection_id, document_id)
+        write = self.writes.get(key)
+        if write is None:
+            write = self.writes[key] = PlannedWrite(
+                collection_id, {}, document_id, description=description
+            )
+        write.data.update(changes)
+        write.dependents.append(dependent)
+
+    def to_json(self) -> List[Dict]:
+        return [
+            {
+                'op': 'create' if write.document_id is None else 'update',
+                **asdict(write),
+            }
+            for write in self.writes.values()
+        ]
+
+    @classmethod
+    def from_json(cls, writes: List[Dict], naive_writes: int = 0) -> 'WritePlan':
+        plan = cls()
+        for position, data in enumerate(writes):
+            data = {key: value for key, value in data.items() if key != 'op'}
+            data['dependents'] = [tuple(dependent) for dependent in data.get('dependents', [])]
+            plan.writes[('planned', str(position))] = PlannedWrite(**data)
+        plan.naive_writes = naive_writes or len(plan.writes)
+        return plan
+
+
+@dataclass
+class UserPlan:
+    """Everything one user's sync changes, computed before anything is written"""
+    user_id: str
+    # gradescopeLastSync when the plan was made; a replay skips users synced since
+    last_sync: Optional[str] = None
+    writes: WritePlan = field(default_factory=WritePlan)
+    # internal course id -> {title: (score, total)}
+    grades: Dict[str, Dict[str, Tuple[float, float]]] = field(default_factory=dict)
+    # internal course id -> Gradescope course ids whose grades it receives
+    grade_courses: Dict[str, List[str]] = field(default_factory=dict)
+    # Course state to record once the plan is applied; a plan file keeps
+    # it in the sidecar store (plan_states_path), not on the user's line
+    states: Dict[str, CourseState] = field(default_factory=dict)
+    # Gradescope course id -> internal course id, remembered for later runs
+    course_links: Dict[str, str] = field(default_factory=dict)
+    # Internal course documents read while planning (not serialized)
+    known_courses: Dict[str, Dict] = field(default_factory=dict, repr=False)
+
+    def to_json(self) -> Dict:
+        """One line of a plan file"""
+        return {
+            'user_id': self.user_id,
+            'last_sync': self.last_sync,
+            'writes': self.writes.to_json(),
+            'naive_writes': self.writes.naive_writes,
+            'grades': self.grades,
+            'grade_courses': self.grade_courses,
+            'course_links': self.course_links,
+        }
+
+    @classmethod
+    def from_json(cls, data: Dict) -> 'UserPlan':
+        return cls(
+            user_id=data['user_id'],
+            last_sync=data.get('last_sync'),
+            writes=WritePlan.from_json(data.get('writes', []), data.get('naive_writes', 0)),
+            grades={
+                course_id: {title: tuple(grade) for title, grade in grades.items()}
+                for course_id, grades in data.get('grades', {}).items()
+            },
+            grade_courses=data.get('grade_courses', {}),
+            course_links=data.get('course_links', {}),
+        )
+
+
+def plan_states_path(plan_path: str) -> str:
+    """
+    The sidecar of a plan file: a SyncStateStore holding each planned
+    user's course states, which are the bulk of a plan but only needed
+    once it is applied
+    """
+    root, _ = os.path.splitext(plan_path)
+    return f"{root}.states.sqlite"
+
+
+class TokenDecryption:
+    """Handles decryption of Gradescope session tokens"""
+
+    def __init__(self, encryption_key: str):
+        # Key is base64-encoded 32-byte key
+        self.key = base64.b64decode(encryption_key)
+        if len(self.key) != 32:
+            raise ValueError("Encryption key must be 32 bytes")
+        # One cipher for the whole run; AESGCM is stateless and thread-safe
+        self.cipher = AESGCM(self.key)
+
+    def decrypt(self, encrypted_data: str) -> str:
+        """
+        Decrypt data encrypted by the Node.js encryption module.
+        Format: iv:authTag:encryptedData (all base64)
+        """
+        parts = encrypted_data.split(':')
+        if len(parts) != 3:
+            raise ValueError("Invalid encrypted data format")
+
+        iv = base64.b64decode(parts[0])
+        auth_tag = base64.b64decode(parts[1])
+        ciphertext = base64.b64decode(parts[2])
+
+        # AES-GCM: ciphertext + auth_tag
+        plaintext = self.cipher.decrypt(iv, ciphertext + auth_tag, None)
+
+        return plaintext.decode('utf-8')
+
+    def decrypt_many(self, encrypted_values: List[Optional[str]]) -> List[Any]:
+        """
+        Decrypt a batch of values. Each result is the plaintext, None for a
+        None input, or the exception raised for that value.
+        """
+        results = []
+        for encrypted_data in encrypted_values:
+            if encrypted_data is None:
+                results.append(None)
+                continue
+            try:
+                results.append(self.decrypt(encrypted_data))
+            except Exception as e:
+                results.append(e)
+        return results
+
+
+class CourseDashboardParser(HTMLParser):
+    """
+    Streaming parser for the assignment table on a Gradescope course page.
+
+    Looks for `table#assignments-student-table` and collects one dict per
+    row in the same shape the Gemini prompt asks for (id, title, due_date,
+    score, total_points, status).
+    """
+
+    TABLE_ID = 'assignments-student-table'
+    ASSIGNMENT_ID_RE = re.compile(r'/assignments/(\d+)')
+    SCORE_RE = re.compile(r'(-?\d+(?:\.\d+)?)\s*/\s*(\d+(?:\.\d+)?)')
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.found_table = False
+        self.malformed = False
+        self.assignments: List[Dict] = []
+        self._in_table = False
+        self._row: Optional[Dict] = None
+        # Field currently collecting text, and the tag that closes it
+        self._capture: Optional[str] = None
+        self._capture_tag: Optional[str] = None
+        self._text: List[str] = []
+
+    def handle_starttag(self, tag: str, attrs):
+        attributes = dict(attrs)
+        classes = (attributes.get('class') or '').split()
+
+        if tag == 'table' and attributes.get('id') == self.TABLE_ID:
+            self.found_table = True
+            self._in_table = True
+            return
+        if not self._in_table:
+            return
+
+        if tag == 'tr':
+            self._row = {}
+            return
+        if self._row is None:
+            return
+
+        if tag in ('th', 'td') and 'table--primaryLink' in classes:
+            self._start_capture('title', tag)
+        elif tag == 'a' and attributes.get('href'):
+            match = self.ASSIGNMENT_ID_RE.search(attributes['href'])
+            if match:
+                self._row.setdefault('id', match.group(1))
+        elif tag == 'button' and attributes.get('data-assignment-id'):
+            self._row.setdefault('id', attributes['data-assignment-id'])
+        elif tag == 'div' and 'submissionStatus--score' in classes:
+            self._start_capture('score_text', tag)
+        elif tag == 'div' and 'submissionStatus--text' in classes:
+            self._start_capture('status', tag)
+        elif tag == 'time' and 'submissionTimeChart--dueDate' in classes:
+            # The first due date is the regular one; a second is the late due date
+            if 'due_date' not in self._row and attributes.get('datetime'):
+                self._row['due_date'] = self._parse_datetime(attributes['datetime'])
+
+    def handle_endtag(self, tag: str):
+        if not self._in_table:
+            return
+
+        if self._capture and tag == self._capture_tag:
+            text = ' '.join(''.join(self._text).split())
+            if text and self._row is not None:
+                self._row[self._capture] = text
+            self._capture = None
+            self._capture_tag = None
+            self._text = []
+
+        if tag == 'tr' and self._row is not None:
+            self._finish_row(self._row)
+            self._row = None
+        elif tag == 'table':
+            self._in_table = False
+
+    def handle_data(self, data: str):
+        if self._capture:
+            self._text.append(data)
+
+    def _start_capture(self, field: str, tag: str):
+        self._capture = field
+        self._capture_tag = tag
+        self._text = []
+
+    def _finish_row(self, row: Dict):
+        # Header rows have no primaryLink cell
+        if 'title' not in row:
+            if 'id' in row:
+                self.malformed = True
+            return
+        if 'id' not in row:
+            # Closed assignments without a submission have no link or id
+            logger.debug(f"Skipping assignment without id: {row['title']}")
+            return
+
+        score = None
+        total_points = None
+        match = self.SCORE_RE.search(row.get('score_text', ''))
+        if match:
+            score = float(match.group(1))
+            total_points = float(match.group(2))
+
+        status = row.get('status')
+        if not status:
+            status = 'Graded' if score is not None else 'Submitted'
+
+        self.assignments.append({
+            'id': row['id'],
+            'title': row['title'],
+            'due_date': row.get('due_date'),
+            'score': score,
+            'total_points': total_points,
+            'status': status
+        })
+
+    def _parse_datetime(self, value: str) -> Optional[str]:
+        """Convert Gradescope's '2024-01-20 23:59:00 -0800' to ISO 8601"""
+        for fmt in ('%Y-%m-%d %H:%M:%S %z', '%Y-%m-%dT%H:%M:%S%z'):
+            try:
+                return datetime.strptime(value.strip(), fmt).isoformat()
+            except ValueError:
+                continue
+        self.malformed = True
+        return None
+
+
+class AccountCoursesParser(HTMLParser):
+    """
+    Parser for the course list on the Gradescope account (dashboard) page.
+
+    Each course is an `a.courseBox` linking to /courses/<id>, holding a
+    `.courseBox--shortname` and a `.courseBox--name`; courses are grouped
+    under `.courseList--term` headings. Collects dicts shaped like the
+    JSON courses endpoint (id, name, shortname) plus the term.
+    """
+
+    COURSE_ID_RE = re.compile(r'^/courses/(\d+)/?$')
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.courses: List[Dict] = []
+        self._term: Optional[str] = None
+        self._course: Optional[Dict] = None
+        self._capture: Optional[str] = None
+        self._capture_tag: Optional[str] = None
+        self._text: List[str] = []
+
+    def handle_starttag(self, tag: str, attrs):
+        attributes = dict(attrs)
+        classes = (attributes.get('class') or '').split()
+
+        if 'courseList--term' in classes:
+            self._start_capture('term', tag)
+        elif tag == 'a' and 'courseBox' in classes:
+            match = self.COURSE_ID_RE.match(attributes.get('href') or '')
+            if match:
+                self._course = {'id': int(match.group(1)), 'term': self._term}
+        elif self._course is not None:
+            if 'courseBox--shortname' in classes:
+                self._start_capture('shortname', tag)
+            elif 'courseBox--name' in classes:
+                self._start_capture('name', tag)
+
+    def handle_endtag(self, tag: str):
+        if self._capture and tag == self._capture_tag:
+            text = ' '.join(''.join(self._text).split())
+            if self._capture == 'term':
+                self._term = text or None
+            elif self._course is not None and text:
+                self._course[self._capture] = text
+            self._capture = None
+            self._capture_tag = None
+            self._text = []
+        elif tag == 'a' and self._course is not None:
+            self._course.setdefault('shortname', '')
+            self._course.setdefault('name', self._course['shortname'])
+            self.courses.append(self._course)
+            self._course = None
+
+    def handle_data(self, data: str):
+        if self._capture:
+            self._text.append(data)
+
+    def _start_capture(self, name: str, tag: str):
+        self._capture = name
+        self._capture_tag = tag
+        self._text = []
+
+
+class HTMLCleaner:
+    """
+    Single-pass reducer for course page HTML before it is sent to Gemini.
+
+    Walks the page once from left to right, dropping script/style/svg (and
+    similar) elements with their content, comments, doctypes and attributes
+    that carry no assignment data, and collapsing whitespace. Stops as soon
+    as `max_chars` of output have been produced.
+
+    A `>` inside a quoted attribute value does not end the tag. A tag with
+    a stray quote (one not opening a value) is read up to its first `>`,
+    as before.
+    """
+
+    DROP_CONTENT_TAGS = {'script', 'style', 'svg', 'noscript', 'template', 'iframe', 'head'}
+    KEEP_ATTRIBUTES = {'id', 'href', 'datetime', 'data-assignment-id', 'aria-label'}
+    # Attribute text is plain characters or quoted values, so `>` in a value is kept
+    TAG_RE = re.compile(r'''<(/?)([a-zA-Z][\w:-]*)((?:[^>"'=]|=\s*(?:"[^"]*"|'[^']*')|=)*)>''')
+    UNQUOTED_TAG_RE = re.compile(r'<(/?)([a-zA-Z][\w:-]*)([^>]*)>')
+    ATTR_RE = re.compile(r'([\w:-]+)\s*=\s*(?:"([^"]*)"|\'([^\']*)\'|([^\s"\'>]+))')
+    WHITESPACE_RE = re.compile(r'\s+')
+
+    def __init__(self, max_chars: int):
+        self.max_chars = max_chars
+        self._parts: List[str] = []
+        self._length = 0
+        self._close_res: Dict[str, re.Pattern] = {
+            tag: re.compile(rf'</{tag}\s*>', re.IGNORECASE) for tag in self.DROP_CONTENT_TAGS
+        }
+
+    def clean(self, html_content: str) -> str:
+        pos = 0
+        end = len(html_content)
+
+        while pos < end and self._length < self.max_chars:
+            lt = html_content.find('<', pos)
+            if lt == -1:
+                self._emit_text(html_content[pos:])
+                break
+            if lt > pos:
+                self._emit_text(html_content[pos:lt])
+
+            if html_content.startswith('<!--', lt):
+                close = html_content.find('-->', lt + 4)
+                pos = end if close == -1 else close + 3
+                continue
+            if html_content.startswith('<!', lt) or html_content.startswith('<?', lt):
+                close = html_content.find('>', lt)
+                pos = end if close == -1 else close + 1
+                continue
+
+            match = self.TAG_RE.match(html_content, lt) or self.UNQUOTED_TAG_RE.match(html_content, lt)
+            if not match:
+                self._emit_text('<')
+                pos = lt + 1
+                continue
+
+            closing, tag, attrs = match.group(1), match.group(2).lower(), match.group(3)
+            pos = match.end()
+
+            if tag in self.DROP_CONTENT_TAGS:
+                if not closing and not attrs.rstrip().endswith('/'):
+                    close_match = self._close_res[tag].search(html_content, pos)
+                    pos = end if close_match is None else close_match.end()
+                continue
+
+            if closing:
+                self._emit(f"</{tag}>")
+            else:
+                self._emit(self._format_tag(tag, attrs))
+
+        return ''.join(self._parts)
+
+    def _format_tag(self, tag: str, attrs: str) -> str:
+        kept = []
+        for name, double, single, bare in self.ATTR_RE.findall(attrs):
+            name = name.lower()
+            value = (double or single or bare).replace('"', '&quot;')
+            if name in self.KEEP_ATTRIBUTES and value:
+                kept.append(f' {name}="{value}"')
+        slash = '/' if attrs.rstrip().endswith('/') else ''
+        return f"<{tag}{''.join(kept)}{slash}>"
+
+    def _emit_text(self, text: str):
+        text = self.WHITESPACE_RE.sub(' ', text)
+        if text == ' ':
+            # Whitespace between elements can separate words ("Due</span>
+            # <span>Jan 5"): keep one space, unless one was just emitted
+            if self._parts and not self._parts[-1].endswith(' '):
+                self._emit(text)
+        elif text:
+            self._emit(text)
+
+    def _emit(self, piece: str):
+        remaining = self.max_chars - self._length
+        if len(piece) > remaining:
+            piece = piece[:remaining]
+        self._parts.append(piece)
+        self._length += len(piece)
+
+
+def clean_html(html_content: str, max_chars: int = GEMINI_MAX_INPUT_CHARS) -> str:
+    """Reduce a course page to the markup relevant for assignment extraction"""
+    return HTMLCleaner(max_chars).clean(html_content)
+
+
+class ParseCache:
+    """
+    Persistent cache of Gemini parse results.
+
+    Entries are keyed on a hash of the prompt version, the prompt and the
+    cleaned page HTML, so an unchanged course page never hits Gemini twice.
+    Backed by SQLite; safe to share between worker threads.
+    """
+
+    def __init__(
+        self,
+        path: str = PARSE_CACHE_PATH,
+        ttl_days: int = PARSE_CACHE_TTL_DAYS,
+        max_entries: int = PARSE_CACHE_MAX_ENTRIES
+    ):
+        self.path = path
+        self.ttl_seconds = ttl_days * 24 * 60 * 60
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS parse_cache (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                last_used REAL NOT NULL
+            )
+            """
+        )
+        self._conn.commit()
+
+    @staticmethod
+    def make_key(prompt: str, content: str) -> str:
+        """Hash the prompt version, prompt and page content into a cache key"""
+        digest = hashlib.sha256()
+        digest.update(f"{GEMINI_MODEL}:{GEMINI_PROMPT_VERSION}\0".encode('utf-8'))
+        digest.update(prompt.encode('utf-8'))
+        digest.update(b"\0")
+        digest.update(content.encode('utf-8'))
+        return digest.hexdigest()
+
+    def get(self, key: str) -> Optional[List[Dict]]:
+        """Return the cached assignments for a key, or None on miss/expiry"""
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, created_at FROM parse_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or now - row[1] > self.ttl_seconds:
+                self.misses += 1
+                return None
+            self._conn.execute(
+                "UPDATE parse_cache SET last_used = ? WHERE key = ?", (now, key)
+            )
+            self._conn.commit()
+            self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, key: str, assignments: List[Dict]):
+        """Store parsed assignments for a key"""
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO parse_cache (key, value, created_at, last_used) "
+                "VALUES (?, ?, ?, ?)",
+                (key, json.dumps(assignments), now, now)
+            )
+            self._conn.commit()
+
+    def prune(self):
+        """Evict expired entries, then the least recently used beyond max_entries"""
+        with self._lock:
+            self._conn.execute(
+                "DELETE FROM parse_cache WHERE created_at < ?",
+                (time.time() - self.ttl_seconds,)
+            )
+            self._conn.execute(
+                "DELETE FROM parse_cache WHERE key NOT IN "
+                "(SELECT key FROM parse_cache ORDER BY last_used DESC LIMIT ?)",
+                (self.max_entries,)
+            )
+            self._conn.commit()
+
+    def close(self):
+        self.prune()
+        with self._lock:
+            self._conn.close()
+
+
+class SyncStateStore:
+    """
+    Persistent per-user, per-course state for incremental syncs.
+
+    State for a user is only trusted when it was saved together with the
+    user's current `gradescopeLastSync` pref; otherwise (first run, lost
+    cache, a sync from elsewhere) the user gets a full sync.
+    """
+
+    def __init__(self, path: str = SYNC_STATE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS user_state (
+                user_id TEXT PRIMARY KEY,
+                last_sync TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS course_state (
+                user_id TEXT NOT NULL,
+                course_id TEXT NOT NULL,
+                data TEXT NOT NULL,
+                PRIMARY KEY (user_id, course_id)
+            );
+            CREATE TABLE IF NOT EXISTS document_snapshot (
+                user_id TEXT NOT NULL,
+                collection_id TEXT NOT NULL,
+                document_id TEXT NOT NULL,
+                data TEXT NOT NULL,
+                PRIMARY KEY (user_id, collection_id, document_id)
+            );
+            CREATE TABLE IF NOT EXISTS snapshot_watermark (
+                user_id TEXT NOT NULL,
+                collection_id TEXT NOT NULL,
+                watermark TEXT NOT NULL,
+                PRIMARY KEY (user_id, collection_id)
+            );
+            CREATE TABLE IF NOT EXISTS course_link (
+                user_id TEXT NOT NULL,
+                course_id TEXT NOT NULL,
+                internal_course_id TEXT NOT NULL,
+                PRIMARY KEY (user_id, course_id)
+            );
+            """
+        )
+        self._conn.commit()
+
+    def load_user(self, user_id: str, last_sync: Optional[str]) -> Dict[str, CourseState]:
+        """Return course states for a user, or {} if they are missing or stale"""
+        if not last_sync:
+            return {}
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT last_sync FROM user_state WHERE user_id = ?", (user_id,)
+            ).fetchone()
+            if row is None or row[0] != last_sync:
+                return {}
+        return self.load_states(user_id)
+
+    def load_states(self, user_id: str) -> Dict[str, CourseState]:
+        """Course states stored for a user, whichever sync they were saved with"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT course_id, data FROM course_state WHERE user_id = ?", (user_id,)
+            ).fetchall()
+        return {course_id: CourseState(**json.loads(data)) for course_id, data in rows}
+
+    def save_user(self, user_id: str, last_sync: str, states: Dict[str, CourseState]):
+        """Replace all stored course states for a user"""
+        with self._lock:
+            with self._conn:
+                self._conn.execute("DELETE FROM course_state WHERE user_id = ?", (user_id,))
+                self._conn.executemany(
+                    "INSERT INTO course_state (user_id, course_id, data) VALUES (?, ?, ?)",
+                    [
+                        (user_id, course_id, json.dumps(asdict(state)))
+                        for course_id, state in states.items()
+                    ]
+                )
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO user_state (user_id, last_sync) VALUES (?, ?)",
+                    (user_id, last_sync)
+                )
+
+    def load_links(self, user_id: str) -> Dict[str, str]:
+        """
+        Gradescope course id -> internal course id resolved in earlier runs.
+        Unlike course state these do not depend on `gradescopeLastSync`.
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT course_id, internal_course_id FROM course_link WHERE user_id = ?", (user_id,)
+            ).fetchall()
+        return dict(rows)
+
+    def save_links(self, user_id: str, links: Dict[str, str]):
+        """Remember (or refresh) resolved course links for a user"""
+        if not links:
+            return
+        with self._lock:
+            with self._conn:
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO course_link (user_id, course_id, internal_course_id) VALUES (?, ?, ?)",
+                    [(user_id, course_id, internal_id) for course_id, internal_id in links.items()]
+                )
+
+    def load_snapshot(self, user_id: str, collection_id: str) -> Tuple[Optional[str], Dict[str, Dict]]:
+        """
+        The matching fields of a user's documents as of the last read, keyed
+        by `$id`, and the newest `$updatedAt` among them ('' if the user had
+        none). Returns (None, {}) when there is no snapshot.
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT watermark FROM snapshot_watermark WHERE user_id = ? AND collection_id = ?",
+                (user_id, collection_id)
+            ).fetchone()
+            if row is None:
+                return None, {}
+            rows = self._conn.execute(
+                "SELECT document_id, data FROM document_snapshot WHERE user_id = ? AND collection_id = ?",
+                (user_id, collection_id)
+            ).fetchall()
+        return row[0], {document_id: json.loads(data) for document_id, data in rows}
+
+    def save_snapshot(
+        self,
+        user_id: str,
+        collection_id: str,
+        watermark: str,
+        documents: List[Dict],
+        replace: bool = False
+    ):
+        """Store (or, with `replace`, store only) `documents` and move the watermark"""
+        with self._lock:
+            with self._conn:
+                if replace:
+                    self._conn.execute(
+                        "DELETE FROM document_snapshot WHERE user_id = ? AND collection_id = ?",
+                        (user_id, collection_id)
+                    )
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO document_snapshot (user_id, collection_id, document_id, data) "
+                    "VALUES (?, ?, ?, ?)",
+                    [
+                        (user_id, collection_id, document['$id'], json.dumps(document, separators=(',', ':')))
+                        for document in documents
+                    ]
+                )
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO snapshot_watermark (user_id, collection_id, watermark) VALUES (?, ?, ?)",
+                    (user_id, collection_id, watermark)
+                )
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class JitteredRetry(Retry):
+    """urllib3 Retry with full jitter on the exponential backoff"""
+
+    def get_backoff_time(self) -> float:
+        return random.uniform(0, super().get_backoff_time())
+
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter that applies a per-host default timeout"""
+
+    def __init__(
+        self,
+        *args,
+        timeouts: Optional[Dict[str, Tuple[float, float]]] = None,
+        tracer: Optional[SyncTracer] = None,
+        **kwargs
+    ):
+        self.timeouts = timeouts or {}
+        self.tracer = tracer
+        super().__init__(*args, **kwargs)
+
+    def send(self, request, **kwargs):
+        host = urlparse(request.url).hostname
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeouts.get(host, HTTP_DEFAULT_TIMEOUT)
+        if not self.tracer:
+            return super().send(request, **kwargs)
+        with self.tracer.phase(HTTP_TRACE_PHASES.get(host, f"http:{host}")):
+            return super().send(request, **kwargs)
+
+
+class HttpPool:
+    """
+    Connection pool shared by all outbound HTTP (Gradescope and Gemini).
+
+    One adapter (keep-alive pool, timeouts, retries) is mounted on every
+    session handed out, so per-user sessions keep their own cookies while
+    reusing connections. Sessions from `new_session` must not be closed
+    individually, as that would close the shared adapter; call `close`.
+    """
+
+    def __init__(
+        self,
+        pool_size: int = 10,
+        timeouts: Optional[Dict[str, Tuple[float, float]]] = None,
+        max_retries: int = HTTP_MAX_RETRIES,
+        backoff_factor: float = HTTP_BACKOFF_FACTOR,
+        tracer: Optional[SyncTracer] = None
+    ):
+        retry = JitteredRetry(
+            total=max_retries,
+            connect=max_retries,
+            read=max_retries,
+            status=max_retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=HTTP_RETRY_STATUSES,
+            # Gemini generateContent is safe to repeat
+            allowed_methods=frozenset({'GET', 'HEAD', 'POST'}),
+            respect_retry_after_header=True,
+            raise_on_status=False
+        )
+        self.adapter = TimeoutHTTPAdapter(
+            pool_connections=max(len(HTTP_TIMEOUTS), 1),
+            pool_maxsize=max(pool_size, 1),
+            max_retries=retry,
+            timeouts=timeouts if timeouts is not None else HTTP_TIMEOUTS,
+            tracer=tracer
+        )
+        # Cookie-less session for API calls (Gemini)
+        self.session = self.new_session()
+
+    def new_session(self) -> requests.Session:
+        """A fresh session (own cookie jar) on the shared connection pool"""
+        session = requests.Session()
+        session.mount('https://', self.adapter)
+        session.mount('http://', self.adapter)
+        return session
+
+    def close(self):
+        self.adapter.close()
+
+
+@dataclass
+class AsyncResponse:
+    """The parts of a requests.Response the sync reads, from an aiohttp response"""
+    status_code: int
+    headers: Any
+    text: str
+
+    def json(self) -> Any:
+        return json.loads(self.text)
+
+
+class AsyncHttpPool:
+    """
+    aiohttp counterpart of HttpPool, for the asyncio engine.
+
+    One connector (keep-alive pool of at most `limit` connections) is
+    shared by every session handed out, so per-user sessions keep their own
+    cookies while reusing connections. Timeouts, retries and tracing follow
+    HttpPool. Must be created inside the running event loop; sessions from
+    `new_session` are closed by their owner, the connector by `close`.
+    """
+
+    def __init__(
+        self,
+        limit: int = ASYNC_MAX_CONNECTIONS,
+        timeouts: Optional[Dict[str, Tuple[float, float]]] = None,
+        max_retries: int = HTTP_MAX_RETRIES,
+        backoff_factor: float = HTTP_BACKOFF_FACTOR,
+        tracer: Optional[SyncTracer] = None
+    ):
+        self.connector = aiohttp.TCPConnector(limit=max(limit, 1), limit_per_host=0)
+        self.timeouts = timeouts if timeouts is not None else HTTP_TIMEOUTS
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.tracer = tracer
+        # Cookie-less session for API calls (Gemini, Appwrite)
+        self.session = self.new_session(cookies=False)
+
+    def new_session(self, cookies: bool = True) -> 'aiohttp.ClientSession':
+        """A fresh session (own cookie jar) on the shared connector"""
+        return aiohttp.ClientSession(
+            connector=self.connector,
+            connector_owner=False,
+            # unsafe: also keep cookies for IP hosts (local stubs)
+            cookie_jar=aiohttp.CookieJar(unsafe=True) if cookies else aiohttp.DummyCookieJar()
+        )
+
+    async def request(
+        self,
+        session: 'aiohttp.ClientSession',
+        method: str,
+        url: str,
+        retries: Optional[int] = None,
+        phase: Optional[str] = None,
+        **kwargs
+    ) -> AsyncResponse:
+        """
+        Send a request on `session` and read the whole body. Connection
+        errors and HTTP_RETRY_STATUSES are retried with jittered backoff
+        (or the server's Retry-After); after the last retry the response is
+        returned whatever its status. The call is timed as one `phase`.
+        """
+        host = urlparse(url).hostname
+        if kwargs.get('timeout') is None:
+            connect, read = self.timeouts.get(host, HTTP_DEFAULT_TIMEOUT)
+            kwargs['timeout'] = aiohttp.ClientTimeout(sock_connect=connect, sock_read=read)
+        retries = self.max_retries if retries is None else retries
+
+        started = time.perf_counter()
+        try:
+            for attempt in itertools.count():
                 try:
-                    graded_items = json.loads(course['gradedItems'])
-                except:
-                    graded_items = []
-            
-            if not isinstance(graded_items, list):
+                    async with session.request(method, url, **kwargs) as response:
+                        result = AsyncResponse(
+                            status_code=response.status,
+                            headers=response.headers,
+                            text=await response.text(errors='replace')
+                        )
+                except (aiohttp.ClientError, asyncio.TimeoutError):
+                    if attempt >= retries:
+                        raise
+                    retry_after = None
+                else:
+                    if result.status_code not in HTTP_RETRY_STATUSES or attempt >= retries:
+                        return result
+                    retry_after = result.headers.get('Retry-After')
+                await asyncio.sleep(self.backoff(attempt, retry_after))
+        finally:
+            if self.tracer:
+                self.tracer.record(phase or HTTP_TRACE_PHASES.get(host, f"http:{host}"), time.perf_counter() - started)
+
+    def backoff(self, attempt: int, retry_after: Optional[str] = None) -> float:
+        """Seconds to wait before retry number `attempt` + 1"""
+        if retry_after:
+            try:
+                return min(max(float(retry_after), 0.0), HTTP_BACKOFF_MAX)
+            except ValueError:
+                pass
+        return random.uniform(0, min(self.backoff_factor * 2 ** attempt, HTTP_BACKOFF_MAX))
+
+    async def close(self):
+        await self.session.close()
+        await self.connector.close()
+
+
+class AsyncAppwriteClient:
+    """
+    Minimal asyncio client for the Appwrite REST API, for the asyncio engine.
+
+    Sends the headers of the SDK client it is given and raises
+    AppwriteException like the SDK. Like the SDK, calls are not retried;
+    they are timed as appwrite_read (GET) or appwrite_write.
+    """
+
+    def __init__(self, endpoint: str, client: Client, http_pool: AsyncHttpPool):
+        self.endpoint = endpoint.rstrip('/')
+        self.headers = {**client.get_headers(), 'content-type': 'application/json'}
+        self.http_pool = http_pool
+
+    async def call(self, method: str, path: str, params: Optional[Dict[str, Any]] = None) -> Any:
+        params = params or {}
+        if method == 'GET':
+            body = {'params': self.query_params(params)}
+        else:
+            body = {'data': json.dumps(params)}
+
+        try:
+            response = await self.http_pool.request(
+                self.http_pool.session,
+                method,
+                self.endpoint + path,
+                retries=0,
+                phase='appwrite_read' if method == 'GET' else 'appwrite_write',
+                headers=self.headers,
+                **body
+            )
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise AppwriteException(str(e) or type(e).__name__) from e
+
+        if response.status_code >= 400:
+            try:
+                error = response.json()
+            except ValueError:
+                raise AppwriteException(response.text, response.status_code, None, response.text)
+            raise AppwriteException(
+                error.get('message', response.text), response.status_code, error.get('type'), response.text
+            )
+        return response.json() if response.text else {}
+
+    @staticmethod
+    def query_params(params: Dict[str, Any]) -> Dict[str, str]:
+        """Flatten GET parameters the way the SDK does: queries[0]=...&queries[1]=..."""
+        flat = {}
+        for key, value in params.items():
+            if isinstance(value, list):
+                flat.update((f"{key}[{index}]", item) for index, item in enumerate(value))
+            elif isinstance(value, bool):
+                flat[key] = 'true' if value else 'false'
+            else:
+                flat[key] = value
+        return flat
+
+
+class AsyncDatabases:
+    """The Databases calls the sync makes, over AsyncAppwriteClient"""
+
+    def __init__(self, client: AsyncAppwriteClient):
+        self.client = client
+
+    @staticmethod
+    def documents_path(database_id: str, collection_id: str) -> str:
+        return f"/databases/{database_id}/collections/{collection_id}/documents"
+
+    async def list_documents(self, database_id: str, collection_id: str, queries: Optional[List[str]] = None) -> Dict:
+        return await self.client.call(
+            'GET', self.documents_path(database_id, collection_id), {'queries': queries or []}
+        )
+
+    async def get_document(self, database_id: str, collection_id: str, document_id: str) -> Dict:
+        return await self.client.call('GET', f"{self.documents_path(database_id, collection_id)}/{document_id}")
+
+    async def create_document(
+        self,
+        database_id: str,
+        collection_id: str,
+        document_id: str,
+        data: Dict,
+        permissions: Optional[List[str]] = None
+    ) -> Dict:
+        params = {'documentId': document_id, 'data': data}
+        if permissions is not None:
+            params['permissions'] = permissions
+        return await self.client.call('POST', self.documents_path(database_id, collection_id), params)
+
+    async def update_document(self, database_id: str, collection_id: str, document_id: str, data: Dict) -> Dict:
+        return await self.client.call(
+            'PATCH', f"{self.documents_path(database_id, collection_id)}/{document_id}", {'data': data}
+        )
+
+
+class AsyncUsers:
+    """The Users calls the sync makes, over AsyncAppwriteClient"""
+
+    def __init__(self, client: AsyncAppwriteClient):
+        self.client = client
+
+    async def list(self, queries: Optional[List[str]] = None) -> Dict:
+        return await self.client.call('GET', '/users', {'queries': queries or []})
+
+    async def get_prefs(self, user_id: str) -> Dict:
+        return await self.client.call('GET', f"/users/{user_id}/prefs")
+
+    async def update_prefs(self, user_id: str, prefs: Dict) -> Dict:
+        return await self.client.call('PATCH', f"/users/{user_id}/prefs", {'prefs': prefs})
+
+    async def update_labels(self, user_id: str, labels: List[str]) -> Dict:
+        return await self.client.call('PUT', f"/users/{user_id}/labels", {'labels': labels})
+
+
+class TokenBucket:
+    """Token bucket state for one rate-limited key (guarded by RateLimiter's lock)"""
+
+    def __init__(self, rate: float, burst: int, now: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = now
+        # client id -> tickets waiting, in round-robin order
+        self.waiting: 'OrderedDict[str, deque]' = OrderedDict()
+        self.queue_depth = 0
+        # Metrics
+        self.granted = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.max_queue_depth = 0
+
+    def refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+
+class RateLimiter:
+    """
+    Token-bucket admission control for outbound requests.
+
+    Each key (a host, or a Gemini API key) has its own bucket. Waiting
+    requests are served round-robin across clients (users), so one user
+    with many courses cannot starve the others. Keys without a configured
+    limit, and every key when `enabled` is False, are not throttled.
+    Time is read from `clock` (seconds, monotonic), replaceable in tests.
+    """
+
+    def __init__(
+        self,
+        limits: Optional[Dict[str, Tuple[float, int]]] = None,
+        enabled: bool = True,
+        clock: Callable[[], float] = time.monotonic
+    ):
+        self.limits = limits if limits is not None else RATE_LIMITS
+        self.enabled = enabled
+        self.clock = clock
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._cond = threading.Condition()
+
+    def acquire(
+        self,
+        key: str,
+        client_id: str,
+        limit: Optional[Tuple[float, int]] = None
+    ) -> float:
+        """Block until `client_id` may send one request for `key`; returns seconds waited"""
+        limit = limit or self.limits.get(key)
+        if not (self.enabled and limit):
+            return 0.0
+
+        started = self.clock()
+        ticket = object()
+
+        with self._cond:
+            bucket = self._enqueue(key, client_id, limit, ticket)
+            while True:
+                waited, timeout = self._try_grant(bucket, client_id, ticket, started)
+                if waited is not None:
+                    self._cond.notify_all()
+                    return waited
+                self._cond.wait(timeout)
+
+    def _enqueue(self, key: str, client_id: str, limit: Tuple[float, int], ticket: object) -> TokenBucket:
+        """Queue `ticket` for `client_id` on the key's bucket"""
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(*limit, self.clock())
+
+        bucket.waiting.setdefault(client_id, deque()).append(ticket)
+        bucket.queue_depth += 1
+        bucket.max_queue_depth = max(bucket.max_queue_depth, bucket.queue_depth)
+        return bucket
+
+    def _try_grant(
+        self,
+        bucket: TokenBucket,
+        client_id: str,
+        ticket: object,
+        started: float
+    ) -> Tuple[Optional[float], Optional[float]]:
+        """
+        Grant `ticket` if it is its turn and a token is available. Returns
+        (seconds waited, None) when granted, else (None, seconds until a
+        token is due, or None to wait for another request to be granted).
+        """
+        now = self.clock()
+        bucket.refill(now)
+        head_client, head_tickets = next(iter(bucket.waiting.items()))
+        my_turn = head_client == client_id and head_tickets[0] is ticket
+
+        if my_turn and bucket.tokens >= 1:
+            bucket.tokens -= 1
+            head_tickets.popleft()
+            if head_tickets:
+                # Let other clients go before this one's next request
+                bucket.waiting.move_to_end(client_id)
+            else:
+                del bucket.waiting[client_id]
+            bucket.queue_depth -= 1
+
+            waited = now - started
+            bucket.granted += 1
+            bucket.total_wait += waited
+            bucket.max_wait = max(bucket.max_wait, waited)
+            return waited, None
+
+        return None, ((1 - bucket.tokens) / bucket.rate if my_turn else None)
+
+    def _withdraw(self, bucket: TokenBucket, client_id: str, ticket: object):
+        """Remove a ticket that will not be used (its request was cancelled)"""
+        tickets = bucket.waiting.get(client_id)
+        if tickets and ticket in tickets:
+            tickets.remove(ticket)
+            if not tickets:
+                del bucket.waiting[client_id]
+            bucket.queue_depth -= 1
+
+    def metrics(self) -> Dict[str, Dict[str, float]]:
+        """Per-key request counts, wait times and queue depths"""
+        with self._cond:
+            return {
+                key: {
+                    'requests': bucket.granted,
+                    'avg_wait': bucket.total_wait / bucket.granted if bucket.granted else 0.0,
+                    'max_wait': bucket.max_wait,
+                    'queue_depth': bucket.queue_depth,
+                    'max_queue_depth': bucket.max_queue_depth,
+                }
+                for key, bucket in self._buckets.items()
+            }
+
+
+class AsyncRateLimiter(RateLimiter):
+    """
+    RateLimiter for the asyncio engine: the same buckets and round-robin
+    order, with `acquire` waiting on the event loop instead of a thread.
+    """
+
+    def __init__(
+        self,
+        limits: Optional[Dict[str, Tuple[float, int]]] = None,
+        enabled: bool = True,
+        clock: Callable[[], float] = time.monotonic
+    ):
+        super().__init__(limits, enabled, clock)
+        self._waiters = asyncio.Condition()
+
+    async def acquire(
+        self,
+        key: str,
+        client_id: str,
+        limit: Optional[Tuple[float, int]] = None
+    ) -> float:
+        """Wait until `client_id` may send one request for `key`; returns seconds waited"""
+        limit = limit or self.limits.get(key)
+        if not (self.enabled and limit):
+            return 0.0
+
+        started = self.clock()
+        ticket = object()
+
+        async with self._waiters:
+            bucket = self._enqueue(key, client_id, limit, ticket)
+            try:
+                while True:
+                    waited, timeout = self._try_grant(bucket, client_id, ticket, started)
+                    if waited is not None:
+                        self._waiters.notify_all()
+                        return waited
+                    try:
+                        await asyncio.wait_for(self._waiters.wait(), timeout)
+                    except TimeoutError:
+                        pass
+            except asyncio.CancelledError:
+                # Do not hold up the clients queued behind a cancelled request
+                self._withdraw(bucket, client_id, ticket)
+                self._waiters.notify_all()
+                raise
+
+
+class CoursesApiProbe:
+    """
+    Run-wide record of whether Gradescope serves the JSON courses endpoint,
+    shared by every user's client so only the first one has to ask.
+    """
+
+    def __init__(self):
+        # None until the first user's request tells us
+        self.available: Optional[bool] = None
+
+
+class BaseGradescopeClient:
+    """
+    The request-free part of a Gradescope client: reading responses,
+    parsing pages and preparing Gemini batches. GradescopeClient (threads)
+    and AsyncGradescopeClient (asyncio) add the requests.
+    """
+
+    def __init__(
+        self,
+        session_token: str,
+        parse_cache: Optional[ParseCache],
+        http_pool: Union[HttpPool, AsyncHttpPool],
+        rate_limiter: Optional[RateLimiter],
+        client_id: str,
+        courses_api: Optional[CoursesApiProbe]
+    ):
+        self.parse_cache = parse_cache
+        self.http_pool = http_pool
+        self.rate_limiter = rate_limiter
+        # Identifies this client (user) for fair scheduling in the rate limiter
+        self.client_id = client_id
+        self.session = self.open_session(session_token)
+        self.session_token = session_token
+        self.courses_api = courses_api or CoursesApiProbe()
+        # Account page captured by verify_session, reused by get_courses
+        self._account_html: Optional[str] = None
+
+    def read_account(self, response) -> bool:
+        """Record the outcome of a GET /account"""
+        # If redirected to login, session is invalid
+        valid = response.status_code == 200
+        self._account_html = response.text if valid else None
+        return valid
+
+    def read_courses_api(self, response) -> Optional[List[Dict]]:
+        """Courses from a JSON courses endpoint response; None to fall back to the dashboard"""
+        if response.status_code == 200:
+            try:
+                data = response.json()
+            except ValueError:
+                data = None
+            if isinstance(data, dict):
+                self.courses_api.available = True
+                return data.get('courses', [])
+        if response.status_code in (200, 404, 410):
+            # Missing (or an HTML page in its place): stop asking for this run
+            logger.info("Gradescope courses API not available, reading the dashboard instead")
+            self.courses_api.available = False
+        return None
+
+    def parse_account_courses(self, html_content: str) -> List[Dict]:
+        """Parse the course list out of the account (dashboard) page"""
+        parser = AccountCoursesParser()
+        try:
+            parser.feed(html_content)
+            parser.close()
+        except Exception as e:
+            logger.warning(f"Could not parse courses from the dashboard: {e}")
+            return []
+        return parser.courses
+
+    @staticmethod
+    def conditional_headers(previous: Optional[CourseState]) -> Dict[str, str]:
+        """If-None-Match / If-Modified-Since headers from a previous fetch"""
+        headers = {}
+        if previous:
+            if previous.etag:
+                headers['If-None-Match'] = previous.etag
+            if previous.last_modified:
+                headers['If-Modified-Since'] = previous.last_modified
+        return headers
+
+    def read_course_page(
+        self,
+        course_id: str,
+        response,
+        gemini_key: Optional[str],
+        previous: Optional[CourseState]
+    ) -> CourseFetch:
+        """
+        Turn a course page response into a CourseFetch (see fetch_course).
+        Never calls Gemini: a page that needs it is returned in `pending_page`.
+        """
+        if response.status_code == 304 and previous:
+            return CourseFetch(
+                assignments=previous.assignments,
+                fingerprint=previous.fingerprint,
+                etag=previous.etag,
+                last_modified=previous.last_modified,
+                unchanged=True
+            )
+        
+        if response.status_code != 200:
+            logger.error(f"Failed to fetch course page: {response.status_code}")
+            return CourseFetch(assignments=[], failed=True)
+
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+
+        # Fingerprint the cleaned page so per-request noise (CSRF tokens in
+        # <head> and attributes) does not count as a change
+        fingerprint = hashlib.sha256(
+            clean_html(response.text, max_chars=len(response.text)).encode('utf-8')
+        ).hexdigest()
+        if previous and fingerprint == previous.fingerprint:
+            logger.info(f"Course page {course_id} unchanged since last sync")
+            return CourseFetch(
+                assignments=previous.assignments,
+                fingerprint=fingerprint,
+                etag=etag,
+                last_modified=last_modified,
+                unchanged=True
+            )
+
+        # Fast path: read the assignment table directly
+        assignments = self.parse_html(response.text)
+        if assignments is not None:
+            logger.info(f"Parsed {len(assignments)} assignments from course page {course_id}")
+        elif gemini_key:
+            return CourseFetch(
+                assignments=[],
+                fingerprint=fingerprint,
+                etag=etag,
+                last_modified=last_modified,
+                pending_page=response.text
+            )
+        else:
+            assignments = self.fallback_assignments(course_id, response.text, None, None)
+            if assignments is None:
+                return CourseFetch(assignments=[], failed=True)
+
+        return CourseFetch(
+            assignments=assignments,
+            fingerprint=fingerprint,
+            etag=etag,
+            last_modified=last_modified
+        )
+
+    def complete_fetch(
+        self,
+        course_id: str,
+        result: CourseFetch,
+        ai_assignments: Optional[List[Dict]],
+        gemini_key: Optional[str]
+    ):
+        """Fill in a fetch left pending for Gemini from its parse (None if that failed)"""
+        assignments = self.fallback_assignments(course_id, result.pending_page, ai_assignments, gemini_key)
+        result.pending_page = None
+        if assignments is None:
+            result.failed = True
+        else:
+            result.assignments = assignments
+
+    def fallback_assignments(
+        self,
+        course_id: str,
+        page: str,
+        ai_assignments: Optional[List[Dict]],
+        gemini_key: Optional[str]
+    ) -> Optional[List[Dict]]:
+        """
+        Assignments of a page the table parser could not read: Gemini's
+        result if there is one, else the page as JSON; None if neither
+        """
+        if ai_assignments is not None:
+            return ai_assignments
+        if gemini_key:
+            logger.warning("AI parsing yielded no results, falling back to standard parsing")
+
+        # Try to parse as JSON (if API exists)
+        try:
+            return json.loads(page).get('assignments', [])
+        except Exception:
+            pass
+
+        logger.warning(f"No Gemini Key or parsing failed - Skipping assignment parsing for {course_id}")
+        return None
+
+    def parse_html(self, html_content: str) -> Optional[List[Dict]]:
+        """
+        Parse the course page assignment table without Gemini.
+        Returns None if the table is missing or could not be read.
+        """
+        parser = CourseDashboardParser()
+        try:
+            parser.feed(html_content)
+            parser.close()
+        except Exception as e:
+            logger.warning(f"HTML parse error: {e}")
+            return None
+
+        if not parser.found_table or parser.malformed:
+            return None
+        return parser.assignments
+
+    def cached_ai_parses(
+        self,
+        pages: Dict[str, str]
+    ) -> Tuple[str, Dict[str, Optional[List[Dict]]], Dict[str, str]]:
+        """
+        Clean pages and look them up in the parse cache. Returns the
+        per-page prompt, the cached parses, and the cleaned pages still to
+        send (course id -> content).
+        """
+        course_prompt = GEMINI_EXTRACTION_PROMPT.format(year=datetime.now().year)
+        results: Dict[str, Optional[List[Dict]]] = {}
+        pending: Dict[str, str] = {}
+
+        for course_id, html_content in pages.items():
+            page_content = clean_html(html_content)
+            if self.parse_cache:
+                cached = self.parse_cache.get(ParseCache.make_key(course_prompt, page_content))
+                if cached is not None:
+                    logger.info(f"Using cached Gemini parse for course {course_id} (page unchanged)")
+                    results[course_id] = cached
+                    continue
+            pending[course_id] = page_content
+
+        return course_prompt, results, pending
+
+    def store_ai_parses(
+        self,
+        batch: Dict[str, str],
+        parsed: Dict[str, List[Dict]],
+        course_prompt: str,
+        results: Dict[str, Optional[List[Dict]]]
+    ):
+        """Record a batch's parses in `results` and cache the successful ones"""
+        for course_id, page_content in batch.items():
+            assignments = parsed.get(course_id)
+            results[course_id] = assignments
+            if self.parse_cache and assignments is not None:
+                self.parse_cache.put(ParseCache.make_key(course_prompt, page_content), assignments)
+
+    @staticmethod
+    def pack_ai_batches(pages: Dict[str, str]) -> List[Dict[str, str]]:
+        """Group cleaned pages, in order, into requests within the batch limits"""
+        batches: List[Dict[str, str]] = []
+        size = 0
+        for course_id, page_content in pages.items():
+            if (
+                not batches
+                or len(batches[-1]) >= GEMINI_BATCH_MAX_COURSES
+                or size + len(page_content) > GEMINI_MAX_INPUT_CHARS
+            ):
+                batches.append({})
+                size = 0
+            batches[-1][course_id] = page_content
+            size += len(page_content)
+        return batches
+
+    @staticmethod
+    def gemini_url() -> str:
+        # Key-free: request exceptions quote the URL, and they end up in sync.log
+        return f"{GEMINI_API_BASE}/v1beta/models/{GEMINI_MODEL}:generateContent"
+
+    @staticmethod
+    def gemini_headers(api_key: str) -> Dict[str, str]:
+        """Request headers for Gemini; the API key goes in a header, never the URL"""
+        return {'Content-Type': 'application/json', 'x-goog-api-key': api_key}
+
+    def gemini_rate_keys(self, api_key: str) -> List[Tuple[str, Optional[Tuple[float, int]]]]:
+        """Rate limiter keys (and limits) a Gemini request is admitted under"""
+        if not self.rate_limiter:
+            return []
+        key_id = hashlib.sha256(api_key.encode('utf-8')).hexdigest()[:12]
+        return [
+            (f"gemini-key:{key_id}", GEMINI_KEY_RATE_LIMIT),
+            (urlparse(GEMINI_API_BASE).hostname, None),
+        ]
+
+    @staticmethod
+    def ai_batch_payload(pages: Dict[str, str], course_prompt: str) -> Dict:
+        """generateContent request body for a batch of cleaned pages"""
+        parts = [{"text": GEMINI_BATCH_PROMPT}, {"text": course_prompt}]
+        for course_id, page_content in pages.items():
+            parts.append({"text": f"=== Course {course_id} ===\n{page_content}"})
+        return {
+            "contents": [{"parts": parts}],
+            "generationConfig": {
+                "responseMimeType": "application/json",
+                "responseSchema": GEMINI_BATCH_SCHEMA
+            }
+        }
+
+    def read_ai_batch(self, pages: Dict[str, str], res) -> Dict[str, List[Dict]]:
+        """Assignments per course from a batched Gemini response"""
+        if res.status_code != 200:
+            logger.error(f"Gemini API Error: {res.text}")
+            return {}
+
+        try:
+            result = res.json()
+            if 'candidates' not in result or not result['candidates']:
+                logger.error(f"Gemini returned no candidates for courses {', '.join(pages)}")
+                return {}
+            data = json.loads(result['candidates'][0]['content']['parts'][0]['text'])
+        except Exception as e:
+            logger.error(f"AI Parse Error: {e}")
+            return {}
+
+        parsed = {}
+        for course in data.get('courses', []):
+            course_id = str(course.get('course_id', ''))
+            if course_id in pages and isinstance(course.get('assignments'), list):
+                parsed[course_id] = course['assignments']
+        missing = [course_id for course_id in pages if course_id not in parsed]
+        if missing:
+            logger.warning(f"Gemini response has no assignments for courses {', '.join(missing)}")
+        logger.info(f"Parsed {len(parsed)} course pages in one Gemini request")
+        return parsed
+
+
+class GradescopeClient(BaseGradescopeClient):
+    """Client for interacting with Gradescope"""
+
+    def __init__(
+        self,
+        session_token: str,
+        parse_cache: Optional[ParseCache] = None,
+        http_pool: Optional[HttpPool] = None,
+        rate_limiter: Optional[RateLimiter] = None,
+        client_id: str = '',
+        courses_api: Optional[CoursesApiProbe] = None
+    ):
+        super().__init__(session_token, parse_cache, http_pool or HttpPool(), rate_limiter, client_id, courses_api)
+
+    def open_session(self, session_token: str) -> requests.Session:
+        """A session on the shared pool carrying the user's Gradescope cookie"""
+        session = self.http_pool.new_session()
+        session.cookies.set(
+            '_gradescope_session',
+            session_token,
+            domain=urlparse(GRADESCOPE_BASE_URL).hostname
+        )
+        return session
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        """GET on the user's session, admitted by the rate limiter"""
+        if self.rate_limiter:
+            self.rate_limiter.acquire(urlparse(url).hostname, self.client_id)
+        return self.session.get(url, **kwargs)
+
+    def fetch_account(self) -> bool:
+        """
+        GET /account, keeping the page if the session is valid so
+        get_courses does not fetch it again
+        """
+        response = self.get(f"{GRADESCOPE_BASE_URL}/account", allow_redirects=False)
+        return self.read_account(response)
+
+    def verify_session(self) -> bool:
+        """Verify the session is still valid"""
+        try:
+            return self.fetch_account()
+        except Exception as e:
+            logger.error(f"Error verifying session: {e}")
+            return False
+
+    def get_courses(self) -> List[Dict]:
+        """Fetch all courses for the user"""
+        try:
+            # Gradescope doesn't have a public API; prefer the JSON courses
+            # endpoint when it exists, otherwise read the dashboard page
+            # captured by verify_session
+            if self.courses_api.available is not False:
+                courses = self.read_courses_api(self.get(f"{GRADESCOPE_BASE_URL}/api/v1/courses"))
+                if courses is not None:
+                    return courses
+
+            if self._account_html is None and not self.fetch_account():
+                logger.error("Failed to fetch courses: session is not valid")
+                return []
+
+            return self.parse_account_courses(self._account_html or '')
+
+        except Exception as e:
+            logger.error(f"Error fetching courses: {e}")
+            return []
+        finally:
+            # The dashboard is only needed once
+            self._account_html = None
+
+    def get_assignments(self, course_id: str, gemini_key: Optional[str] = None) -> List[Dict]:
+        """Fetch assignments for a specific course"""
+        return self.fetch_course(course_id, gemini_key).assignments
+
+    def fetch_course(
+        self,
+        course_id: str,
+        gemini_key: Optional[str] = None,
+        previous: Optional[CourseState] = None,
+        defer_ai: bool = False
+    ) -> CourseFetch:
+        """
+        Fetch and parse a course page.
+
+        With a `previous` state the request is conditional (ETag /
+        Last-Modified), and a page whose content fingerprint is unchanged
+        reuses the previously parsed assignments instead of parsing again.
+        With `defer_ai`, a page that needs Gemini is returned unparsed in
+        `pending_page` so it can be batched (see parse_pages_with_ai).
+        """
+        try:
+            # Gradescope assignment page
+            response = self.get(
+                f"{GRADESCOPE_BASE_URL}/courses/{course_id}",
+                headers=self.conditional_headers(previous)
+            )
+            result = self.read_course_page(course_id, response, gemini_key, previous)
+            if result.pending_page is not None and not defer_ai:
+                logger.info(f"Using Gemini AI to parse assignments for course {course_id}")
+                ai_assignments = self.parse_with_ai(result.pending_page, gemini_key, course_id)
+                self.complete_fetch(course_id, result, ai_assignments, gemini_key)
+            return result
+
+        except Exception as e:
+            logger.error(f"Error fetching assignments for course {course_id}: {e}")
+            return CourseFetch(assignments=[], failed=True)
+
+    def parse_with_ai(self, html_content: str, api_key: str, course_id: str = 'page') -> Optional[List[Dict]]:
+        """Parse one course page using Gemini; None if it could not be parsed"""
+        return self.parse_pages_with_ai({course_id: html_content}, api_key).get(course_id)
+
+    def parse_pages_with_ai(self, pages: Dict[str, str], api_key: str) -> Dict[str, Optional[List[Dict]]]:
+        """
+        Parse course pages (course id -> HTML) using Gemini, several pages
+        per request. Parses are cached per page; a course maps to None if
+        its page could not be parsed.
+        """
+        course_prompt, results, pending = self.cached_ai_parses(pages)
+        for batch in self.pack_ai_batches(pending):
+            parsed = self.request_ai_batch(batch, api_key, course_prompt)
+            self.store_ai_parses(batch, parsed, course_prompt, results)
+        return results
+
+    def request_ai_batch(self, pages: Dict[str, str], api_key: str, course_prompt: str) -> Dict[str, List[Dict]]:
+        """
+        One schema-constrained Gemini request for cleaned pages (course id ->
+        content). Returns the assignments of every course in the response.
+        """
+        try:
+            for key, limit in self.gemini_rate_keys(api_key):
+                self.rate_limiter.acquire(key, self.client_id, limit)
+            res = self.http_pool.session.post(
+                self.gemini_url(),
+                json=self.ai_batch_payload(pages, course_prompt),
+                headers=self.gemini_headers(api_key)
+            )
+        except Exception as e:
+            logger.error(f"AI Parse Error: {e}")
+            return {}
+        return self.read_ai_batch(pages, res)
+
+
+class AsyncGradescopeClient(BaseGradescopeClient):
+    """
+    Gradescope client for the asyncio engine: GradescopeClient's requests as
+    coroutines, over an AsyncHttpPool (and an AsyncRateLimiter, if any).
+    Call `close` when done.
+    """
+
+    def open_session(self, session_token: str) -> 'aiohttp.ClientSession':
+        session = self.http_pool.new_session()
+        session.cookie_jar.update_cookies({'_gradescope_session': session_token}, URL(GRADESCOPE_BASE_URL))
+        return session
+
+    async def get(self, url: str, **kwargs) -> AsyncResponse:
+        """GET on the user's session, admitted by the rate limiter"""
+        if self.rate_limiter:
+            await self.rate_limiter.acquire(urlparse(url).hostname, self.client_id)
+        return await self.http_pool.request(self.session, 'GET', url, **kwargs)
+
+    async def fetch_account(self) -> bool:
+        response = await self.get(f"{GRADESCOPE_BASE_URL}/account", allow_redirects=False)
+        return self.read_account(response)
+
+    async def verify_session(self) -> bool:
+        try:
+            return await self.fetch_account()
+        except Exception as e:
+            logger.error(f"Error verifying session: {e}")
+            return False
+
+    async def get_courses(self) -> List[Dict]:
+        try:
+            if self.courses_api.available is not False:
+                courses = self.read_courses_api(await self.get(f"{GRADESCOPE_BASE_URL}/api/v1/courses"))
+                if courses is not None:
+                    return courses
+
+            if self._account_html is None and not await self.fetch_account():
+                logger.error("Failed to fetch courses: session is not valid")
+                return []
+
+            return await asyncio.to_thread(self.parse_account_courses, self._account_html or '')
+
+        except Exception as e:
+            logger.error(f"Error fetching courses: {e}")
+            return []
+        finally:
+            self._account_html = None
+
+    async def get_assignments(self, course_id: str, gemini_key: Optional[str] = None) -> List[Dict]:
+        return (await self.fetch_course(course_id, gemini_key)).assignments
+
+    async def fetch_course(
+        self,
+        course_id: str,
+        gemini_key: Optional[str] = None,
+        previous: Optional[CourseState] = None,
+        defer_ai: bool = False
+    ) -> CourseFetch:
+        try:
+            response = await self.get(
+                f"{GRADESCOPE_BASE_URL}/courses/{course_id}",
+                headers=self.conditional_headers(previous)
+            )
+            # Fingerprinting and parsing a page is CPU-bound
+            result = await asyncio.to_thread(self.read_course_page, course_id, response, gemini_key, previous)
+        except Exception as e:
+            logger.error(f"Error fetching assignments for course {course_id}: {e}")
+            return CourseFetch(assignments=[], failed=True)
+
+        if result.pending_page is not None and not defer_ai:
+            logger.info(f"Using Gemini AI to parse assignments for course {course_id}")
+            ai_assignments = await self.parse_with_ai(result.pending_page, gemini_key, course_id)
+            self.complete_fetch(course_id, result, ai_assignments, gemini_key)
+        return result
+
+    async def parse_with_ai(self, html_content: str, api_key: str, course_id: str = 'page') -> Optional[List[Dict]]:
+        return (await self.parse_pages_with_ai({course_id: html_content}, api_key)).get(course_id)
+
+    async def parse_pages_with_ai(self, pages: Dict[str, str], api_key: str) -> Dict[str, Optional[List[Dict]]]:
+        """Like GradescopeClient.parse_pages_with_ai, with the batches sent concurrently"""
+        # Cleaning pages and the parse cache's SQLite block, so they run on a worker thread
+        course_prompt, results, pending = await asyncio.to_thread(self.cached_ai_parses, pages)
+        batches = self.pack_ai_batches(pending)
+        responses = await asyncio.gather(*(
+            self.request_ai_batch(batch, api_key, course_prompt) for batch in batches
+        ))
+        for batch, parsed in zip(batches, responses):
+            await asyncio.to_thread(self.store_ai_parses, batch, parsed, course_prompt, results)
+        return results
+
+    async def request_ai_batch(self, pages: Dict[str, str], api_key: str, course_prompt: str) -> Dict[str, List[Dict]]:
+        try:
+            for key, limit in self.gemini_rate_keys(api_key):
+                await self.rate_limiter.acquire(key, self.client_id, limit)
+            res = await self.http_pool.request(
+                self.http_pool.session,
+                'POST',
+                self.gemini_url(),
+                json=self.ai_batch_payload(pages, course_prompt),
+                headers=self.gemini_headers(api_key)
+            )
+        except Exception as e:
+            logger.error(f"AI Parse Error: {e}")
+            return {}
+        return self.read_ai_batch(pages, res)
+
+    async def close(self):
+        await self.session.close()
+
+
+class GradescopeSyncer:
+    """Main sync orchestrator"""
+
+    # Concurrency model, recorded in the run report
+    engine = 'threads'
+
+    def __init__(
+        self,
+        workers: int = DEFAULT_SYNC_WORKERS,
+        course_workers: int = DEFAULT_COURSE_WORKERS,
+        incremental: bool = True,
+        write_workers: int = DEFAULT_WRITE_WORKERS,
+        plan_path: Optional[str] = None,
+        shard: Optional[Tuple[int, int]] = None,
+        databases: Optional[Any] = None,
+        users_service: Optional[Any] = None
+    ):
+        # Initialize Appwrite client
+        self.client = Client()
+        self.client.set_endpoint(os.environ['APPWRITE_ENDPOINT'])
+        self.client.set_project(os.environ['APPWRITE_PROJECT_ID'])
+        self.client.set_key(os.environ['APPWRITE_API_KEY'])
+
+        # Timing of every phase, written to the run report
+        self.tracer = SyncTracer()
+
+        # Services can be injected (e.g. in-process stand-ins for benchmarks)
+        self.databases = TracedService(databases or Databases(self.client), self.tracer)
+        self.users_service = TracedService(users_service or Users(self.client), self.tracer)
+
+        # Initialize token decryption
+        self.decryptor = TokenDecryption(os.environ['GRADESCOPE_ENCRYPTION_KEY'])
+        # user id -> decrypted secrets, cleared at the end of each run
+        self._secrets: Dict[str, UserSecrets] = {}
+
+        # Gemini parse cache shared by all users
+        self.parse_cache = ParseCache()
+
+        # Per-course state for incremental syncs; a full sync ignores but still refreshes it
+        self.incremental = incremental
+        self.state_store = SyncStateStore()
+
+        # Maximum number of users synced at the same time
+        self.workers = max(1, workers)
+        # Maximum number of courses fetched at the same time for one user
+        self.course_workers = max(1, course_workers)
+        # Maximum number of database writes in flight for one user
+        self.write_workers = max(1, write_workers)
+
+        # (index, count): only sync users whose id hashes to this shard
+        self.shard = shard
+
+        # Plan mode: write each user's planned changes to `plan_path` (JSONL)
+        # instead of applying them; nothing is written to Appwrite
+        self.plan_path = plan_path
+        self.dry_run = plan_path is not None
+        self._plan_file = None
+        self._plan_states: Optional[SyncStateStore] = None
+        self._plan_lock = threading.Lock()
+
+        # Keep-alive pool sized for every user and course worker in flight
+        self.http_pool = HttpPool(
+            pool_size=self.workers * (self.course_workers + 1),
+            tracer=self.tracer
+        )
+        # Per-host / per-key admission control, fair across users
+        self.rate_limiter = RateLimiter(shard_rate_limits(shard))
+        # Whether Gradescope has a JSON courses endpoint, learned once per run
+        self.courses_api = CoursesApiProbe()
+
+        # Stats (shared across worker threads, guarded by _stats_lock)
+        self.stats = {
+            'users_processed': 0,
+            'users_skipped': 0,
+            'assignments_synced': 0,
+            'conflicts_created': 0,
+            'courses_unchanged': 0,
+            'assignments_unchanged': 0,
+            'writes_sent': 0,
+            'writes_saved': 0,
+            'planned_assignments': 0,
+            'planned_conflicts': 0,
+            'planned_writes': 0,
+            'documents_read': 0,
+            'snapshot_reloads': 0,
+            'errors': []
+        }
+        self._stats_lock = threading.Lock()
+
+    def increment_stat(self, key: str, amount: int = 1):
+        """Thread-safe increment of a stats counter"""
+        with self._stats_lock:
+            self.stats[key] += amount
+
+    def record_error(self, message: str):
+        """Thread-safe append to the stats error list"""
+        with self._stats_lock:
+            self.stats['errors'].append(message)
+
+    def in_shard(self, user_id: str) -> bool:
+        """Whether this run (or shard of a run) owns the user"""
+        return self.shard is None or shard_of(user_id, self.shard[1]) == self.shard[0]
+
+    def iter_user_batches(self):
+        """
+        Yield users with Gradescope connected, a page at a time, decrypting
+        each page's secrets as it is listed.
+
+        Only users carrying the GRADESCOPE_USER_LABEL label are listed, so
+        the cost is proportional to the number of connected users. The web
+        app adds the label on connect and removes it on disconnect.
+        """
+        cursor = None
+        try:
+            while True:
+                with self.tracer.phase('enumerate_users'):
+                    batch, cursor = self.perform(self.connected_users_page_steps(cursor))
+                if batch:
+                    with self.tracer.phase('decrypt'):
+                        self.decrypt_secrets(batch)
+                    yield batch
+                if cursor is None:
+                    return
+
+        except Exception as e:
+            logger.error(f"Error fetching connected users: {e}")
+            self.record_error(f"Failed to fetch users: {e}")
+
+    def connected_users_page_steps(self, cursor: Optional[str]) -> SyncSteps:
+        """
+        List one page of labelled users. Returns this shard's connected
+        users and the cursor of the next page (None after the last one).
+        """
+        users = (yield AppwriteCall.users('list', queries=self.page_queries(
+            [Query.contains('labels', [GRADESCOPE_USER_LABEL])], USER_PAGE_SIZE, cursor
+        )))['users']
+
+        batch = []
+        for user in users:
+            if not self.in_shard(user['$id']):
+                continue
+            connected_user = yield from self.to_connected_user_steps(user)
+            if connected_user:
+                batch.append(connected_user)
+        return batch, self.next_cursor(users, USER_PAGE_SIZE)
+
+    def iter_users(self, queries: Optional[List[str]] = None):
+        """Yield users matching `queries`, paging with a cursor"""
+        cursor = None
+        while True:
+            response = self.users_service.list(queries=self.page_queries(queries or [], USER_PAGE_SIZE, cursor))
+            users = response['users']
+            yield from users
+
+            cursor = self.next_cursor(users, USER_PAGE_SIZE)
+            if cursor is None:
+                return
+
+    @staticmethod
+    def page_queries(queries: List[str], page_size: int, cursor: Optional[str]) -> List[str]:
+        """`queries` for one page of a listing paged with a cursor"""
+        page_queries = list(queries) + [Query.limit(page_size)]
+        if cursor:
+            page_queries.append(Query.cursor_after(cursor))
+        return page_queries
+
+    @staticmethod
+    def next_cursor(page: List[Dict], page_size: int) -> Optional[str]:
+        """Cursor of the page after `page`, or None if it was the last"""
+        if len(page) < page_size:
+            return None
+        return page[-1]['$id']
+
+    def perform(self, steps: SyncSteps) -> Any:
+        """
+        Run sync steps on the Appwrite SDK: make each AppwriteCall they
+        yield (or run each LocalCall) and send back its response, or raise
+        its error into them. Returns what the steps return.
+        """
+        services = {'databases': self.databases, 'users': self.users_service}
+        response, error = None, None
+        while True:
+            try:
+                call = steps.send(response) if error is None else steps.throw(error)
+            except StopIteration as done:
+                return done.value
+            try:
+                if isinstance(call, LocalCall):
+                    response = call.function(*call.args)
+                else:
+                    response = getattr(services[call.service], call.method)(*call.args, **call.kwargs)
+                error = None
+            except Exception as e:
+                response, error = None, e
+
+    def to_connected_user_steps(self, user: Dict) -> SyncSteps:
+        """Build a ConnectedUser if the user's prefs hold a usable Gradescope session"""
+        connected_user, follow_up = self.check_connection(user)
+        if follow_up == 'unlabel':
+            yield from self.set_connected_label_steps(user['$id'], user.get('labels', []), False)
+        elif follow_up == 'expire':
+            yield from self.mark_token_expired_steps(user['$id'], user.get('labels', []))
+        return connected_user
+
+    def check_connection(self, user: Dict) -> Tuple[Optional[ConnectedUser], Optional[str]]:
+        """
+        Classify a listed user: (ConnectedUser, None) if their prefs hold a
+        usable Gradescope session, else (None, follow-up), the follow-up
+        being 'unlabel' (stale label), 'expire' (token expired) or None.
+        """
+        prefs = user.get('prefs', {})
+        labels = user.get('labels', [])
+
+        # Check if Gradescope is connected
+        if not (prefs.get('gradescopeConnected') and prefs.get('gradescopeSessionToken')):
+            if GRADESCOPE_USER_LABEL in labels:
+                # Label is stale (e.g. disconnected before labels existed)
+                return None, 'unlabel'
+            return None, None
+
+        # Check if token is not expired
+        token_expiry = None
+        if prefs.get('gradescopeTokenExpiry'):
+            token_expiry = parse_iso_datetime(prefs['gradescopeTokenExpiry'])
+            if token_expiry < datetime.now(token_expiry.tzinfo):
+                logger.info(f"Token expired for user {user['$id']}")
+                return None, 'expire'
+
+        return ConnectedUser(
+            id=user['$id'],
+            email=prefs.get('gradescopeEmail', 'unknown'),
+            encrypted_token=prefs['gradescopeSessionToken'],
+            token_expiry=token_expiry,
+            encrypted_gemini_key=prefs.get('geminiApiKey'),
+            labels=tuple(labels),
+            last_sync=prefs.get('gradescopeLastSync')
+        ), None
+
+    def backfill_connected_labels(self):
+        """
+        One-off migration: scan every user (of this shard) and add
+        GRADESCOPE_USER_LABEL to those connected before the label existed.
+        """
+        labelled = 0
+        try:
+            for user in self.iter_users():
+                if not self.in_shard(user['$id']):
+                    continue
+                prefs = user.get('prefs', {})
+                labels = user.get('labels', [])
+                if prefs.get('gradescopeConnected') and prefs.get('gradescopeSessionToken') \
+                        and GRADESCOPE_USER_LABEL not in labels:
+                    self.perform(self.set_connected_label_steps(user['$id'], labels, True))
+                    labelled += 1
+        except Exception as e:
+            logger.error(f"Error backfilling user labels: {e}")
+            self.record_error(f"Failed to backfill labels: {e}")
+        logger.info(f"Labelled {labelled} connected users")
+
+    def set_connected_label_steps(self, user_id: str, labels: Sequence[str], connected: bool) -> SyncSteps:
+        """Add or remove the Gradescope label used to discover connected users"""
+        if self.dry_run:
+            logger.info(f"Plan mode: not {'adding' if connected else 'removing'} label for user {user_id}")
+            return
+        try:
+            yield AppwriteCall.users('update_labels', user_id, self.connected_labels(labels, connected))
+        except Exception as e:
+            logger.error(f"Failed to update labels for user {user_id}: {e}")
+
+    @staticmethod
+    def connected_labels(labels: Sequence[str], connected: bool) -> List[str]:
+        """A user's labels with GRADESCOPE_USER_LABEL added or removed"""
+        if connected:
+            return list(labels) + [GRADESCOPE_USER_LABEL]
+        return [label for label in labels if label != GRADESCOPE_USER_LABEL]
+
+    def update_user_prefs_steps(self, user_id: str, updates: Dict[str, Any]) -> SyncSteps:
+        """
+        Merge `updates` into a user's prefs.
+
+        Appwrite replaces the whole prefs object on update, so the current
+        prefs are written back alongside the changes. They are read right
+        before the update: prefs from when the user was listed may be
+        minutes old, and writing them back would undo whatever the web app
+        changed in between (a disconnect, a new Gemini key, settings).
+        """
+        current = yield AppwriteCall.users('get_prefs', user_id)
+        yield AppwriteCall.users('update_prefs', user_id, {**current, **updates})
+
+    def mark_token_expired_steps(
+        self,
+        user_id: str,
+        labels: Optional[Sequence[str]] = None
+    ) -> SyncSteps:
+        """Mark a user's token as expired"""
+        if self.dry_run:
+            logger.info(f"Plan mode: not marking token expired for user {user_id}")
+            return
+        try:
+            yield from self.update_user_prefs_steps(user_id, {
+                'gradescopeConnected': False
+            })
+            logger.info(f"Marked token as expired for user {user_id}")
+        except Exception as e:
+            logger.error(f"Failed to mark token expired for user {user_id}: {e}")
+            return
+        yield from self.set_connected_label_steps(user_id, labels or [GRADESCOPE_USER_LABEL], False)
+
+    def list_all_documents_steps(
+        self,
+        collection_id: str,
+        queries: List[str],
+        select: Optional[List[str]] = None,
+        page_size: int = DOCUMENT_PAGE_SIZE
+    ) -> SyncSteps:
+        """
+        Fetch every document in a collection matching `queries`.
+
+        Pages with a cursor (stable and cheap at any depth) and, when
+        `select` is given, only transfers those attributes.
+        """
+        documents = []
+        base_queries = list(queries)
+        if select:
+            base_queries.append(Query.select(select))
+        cursor = None
+
+        while True:
+            response = yield AppwriteCall.databases(
+                'list_documents',
+                DATABASE_ID,
+                collection_id,
+                queries=self.page_queries(base_queries, page_size, cursor)
+            )
+
+            page = response['documents']
+            documents.extend(page)
+
+            cursor = self.next_cursor(page, page_size)
+            if cursor is None:
+                return documents
+
+    def count_documents_steps(self, collection_id: str, queries: List[str]) -> SyncSteps:
+        """Number of documents matching `queries`, without transferring them"""
+        response = yield AppwriteCall.databases(
+            'list_documents',
+            DATABASE_ID,
+            collection_id,
+            queries=list(queries) + [Query.select(['$id']), Query.limit(1)]
+        )
+        return response['total']
+
+    def load_user_documents_steps(self, user_id: str, collection_id: str, fields: List[str]) -> SyncSteps:
+        """
+        A user's documents in a collection, read through the local snapshot.
+
+        With a snapshot, only documents updated since its watermark are
+        fetched and merged in, then a count query checks the result: a
+        document deleted (or missed) since the last read shows up as a
+        mismatch, and the user's documents are read in full instead. A full
+        sync always reads everything.
+        """
+        user_query = Query.equal('userId', user_id)
+        select = fields + ['$updatedAt']
+
+        watermark, snapshot = yield LocalCall(self.load_snapshot, (user_id, collection_id))
+        if watermark:
+            changed = yield from self.list_all_documents_steps(
+                collection_id, [user_query, self.changed_since(watermark)], select=select
+            )
+            # Counted after the changes are read, so a document deleted in
+            # between cannot slip through as verified
+            total = yield from self.count_documents_steps(collection_id, [user_query])
+            documents = yield LocalCall(
+                self.merge_snapshot, (user_id, collection_id, snapshot, changed, total, watermark)
+            )
+            if documents is not None:
+                return documents
+
+        documents = yield from self.list_all_documents_steps(collection_id, [user_query], select=select)
+        return (yield LocalCall(self.replace_snapshot, (user_id, collection_id, documents)))
+
+    def load_snapshot(self, user_id: str, collection_id: str) -> Tuple[Optional[str], Dict[str, Dict]]:
+        """The user's snapshot for a collection, or (None, {}) if it must not be used"""
+        if not self.incremental:
+            return None, {}
+        return self.state_store.load_snapshot(user_id, collection_id)
+
+    @staticmethod
+    def changed_since(watermark: str) -> str:
+        """Query for documents updated since a watermark, less the overlap"""
+        since = parse_iso_datetime(watermark) - timedelta(seconds=SNAPSHOT_OVERLAP_SECONDS)
+        return Query.greater_than('$updatedAt', since.isoformat(timespec='milliseconds'))
+
+    def merge_snapshot(
+        self,
+        user_id: str,
+        collection_id: str,
+        snapshot: Dict[str, Dict],
+        changed: List[Dict],
+        total: int,
+        watermark: str
+    ) -> Optional[List[Dict]]:
+        """
+        Merge changed documents into a snapshot and check the result against
+        Appwrite's count. Returns the documents, or None if they must be
+        read in full.
+        """
+        self.increment_stat('documents_read', len(changed))
+        snapshot.update((document['$id'], document) for document in changed)
+
+        # Appwrite caps counts (5000 by default); past that this never
+        # matches and the user is simply read in full every run
+        if total == len(snapshot):
+            self.state_store.save_snapshot(
+                user_id, collection_id, newest_update(snapshot.values()) or watermark, changed
+            )
+            return list(snapshot.values())
+
+        logger.info(
+            f"Snapshot of {collection_id} for user {user_id} is out of date "
+            f"({len(snapshot)} cached, {total} in Appwrite), reading all documents"
+        )
+        self.increment_stat('snapshot_reloads')
+        return None
+
+    def replace_snapshot(self, user_id: str, collection_id: str, documents: List[Dict]) -> List[Dict]:
+        """Store a full read of a user's documents as their snapshot"""
+        self.increment_stat('documents_read', len(documents))
+        self.state_store.save_snapshot(user_id, collection_id, newest_update(documents), documents, replace=True)
+        return documents
+
+    def get_user_courses_steps(self, user_id: str) -> SyncSteps:
+        """Get existing courses for a user"""
+        try:
+            return (yield from self.load_user_documents_steps(user_id, COURSES_COLLECTION, COURSE_MATCH_FIELDS))
+        except Exception as e:
+            logger.error(f"Error fetching courses for user {user_id}: {e}")
+            return []
+
+    def get_user_assignments_steps(self, user_id: str) -> SyncSteps:
+        """Get existing assignments for a user"""
+        try:
+            return (yield from self.load_user_documents_steps(user_id, ASSIGNMENTS_COLLECTION, ASSIGNMENT_MATCH_FIELDS))
+
+        except Exception as e:
+            logger.error(f"Error fetching assignments for user {user_id}: {e}")
+            return []
+
+    def get_user_state(self, user_id: str) -> Tuple[List[Dict], List[Dict]]:
+        """Fetch a user's existing assignments and courses concurrently"""
+        with ThreadPoolExecutor(
+            max_workers=2,
+            thread_name_prefix=f"{threading.current_thread().name}-db"
+        ) as executor:
+            assignments = executor.submit(self.perform, self.get_user_assignments_steps(user_id))
+            courses = executor.submit(self.perform, self.get_user_courses_steps(user_id))
+            return assignments.result(), courses.result()
+
+    def find_similar_assignment(
+        self,
+        index: AssignmentIndex,
+        gs_assignment: GradescopeAssignment
+    ) -> Optional[ExistingAssignment]:
+        """
+        Find a potentially matching manual assignment.
+
+        Matching criteria:
+        1. Title similarity > 80%
+        2. Deadline within 48 hours
+        """
+        return index.find_similar(gs_assignment.title_key, gs_assignment.deadline_ts)
+
+    def find_by_gradescope_id(
+        self,
+        index: AssignmentIndex,
+        gradescope_id: str
+    ) -> Optional[ExistingAssignment]:
+        """Find an assignment by its Gradescope ID"""
+        return index.find_by_gradescope_id(gradescope_id)
+
+    def user_permissions(self, user_id: str) -> List[str]:
+        """Document permissions granting a user full access"""
+        return [
+            Permission.read(Role.user(user_id)),
+            Permission.update(Role.user(user_id)),
+            Permission.delete(Role.user(user_id))
+        ]
+
+    def assignment_document(
+        self,
+        user_id: str,
+        gs_assignment: GradescopeAssignment,
+        internal_course_id: str = ''
+    ) -> Dict:
+        """Document data for a new assignment created from Gradescope data"""
+        return {
+            'title': gs_assignment.title,
+            'courseId': internal_course_id,  # Empty until mapped (automatically or manually)
+            'deadline': gs_assignment.deadline.isoformat(),
+            'status': 'not_started',
+            'category': 'assignment',
+            'userId': user_id,
+            'source': 'gradescope',
+            'gradescopeId': gs_assignment.id,
+            'gradescopeCourseId': gs_assignment.course_id,
+            'gradescopeCourseName': gs_assignment.course_name,
+            'tags': [],
+            'notes': f'Imported from Gradescope ({gs_assignment.course_name})',
+            'attachmentFileId': None,
+            'attachmentFileName': None,
+            'completedAt': None,
+            'googleCalendarEventId': None,
+            'calendarSynced': False
+        }
+
+    def execute_write_steps(self, write: PlannedWrite) -> SyncSteps:
+        """Send one planned write; returns False if it failed"""
+        try:
+            if write.document_id is None:
+                yield AppwriteCall.databases(
+                    'create_document',
+                    DATABASE_ID,
+                    write.collection_id,
+                    ID.unique(),
+                    write.data,
+                    write.permissions
+                )
+            else:
+                yield AppwriteCall.databases(
+                    'update_document',
+                    DATABASE_ID,
+                    write.collection_id,
+                    write.document_id,
+                    write.data
+                )
+        except Exception as e:
+            action = 'creating' if write.document_id is None else f'updating {write.document_id} in'
+            logger.error(f"Error {action} {write.collection_id} ({write.description}): {e}")
+            return False
+
+        self.record_write(write)
+        return True
+
+    def record_write(self, write: PlannedWrite):
+        """Count and log a write that was sent"""
+        if write.stat:
+            self.increment_stat(write.stat)
+        if write.description:
+            logger.info(write.description)
+
+    def apply_write_plan(self, plan: WritePlan) -> set:
+        """
+        Send a user's planned writes, at most `write_workers` at a time.
+        Returns the dependents of every write that failed.
+        """
+        if not plan.writes:
+            return set()
+
+        writes = list(plan.writes.values())
+
+        def send(write: PlannedWrite) -> bool:
+            return self.perform(self.execute_write_steps(write))
+
+        if self.write_workers == 1 or len(writes) == 1:
+            results = [send(write) for write in writes]
+        else:
+            with ThreadPoolExecutor(
+                max_workers=min(self.write_workers, len(writes)),
+                thread_name_prefix=f"{threading.current_thread().name}-write"
+            ) as executor:
+                results = list(executor.map(send, writes))
+
+        return self.write_failures(plan, writes, results)
+
+    def write_failures(self, plan: WritePlan, writes: List[PlannedWrite], results: List[bool]) -> set:
+        """Count a plan's sent writes; returns the dependents of every write that failed"""
+        failed = set()
+        for write, ok in zip(writes, results):
+            if not ok:
+                failed.update(write.dependents)
+
+        self.increment_stat('writes_sent', len(writes))
+        self.increment_stat('writes_saved', plan.naive_writes - len(writes))
+        return failed
+
+    def merge_course_grades(
+        self,
+        course: Dict,
+        grades: Dict[str, Tuple[float, float]]
+    ) -> Tuple[List[Dict], List[str]]:
+        """
+        Merge grades (title -> (score, total)) into a course's gradedItems.
+        Returns the merged items and the titles that changed.
+        """
+        graded_items = []
+        if course.get('gradedItems'):
+            try:
+                graded_items = json.loads(course['gradedItems'])
+            except:
                 graded_items = []
+        
+        if not isinstance(graded_items, list):
+            graded_items = []
 
-            # Check if item exists
-            existing_index = -1
-            for i, item in enumerate(graded_items):
-                if item.get('name') == title:
-                    existing_index = i
-                    break
-            
-            changed = False
-            
-            if existing_index >= 0:
+        # Index existing items by name (first occurrence wins)
+        items_by_name = {}
+        for item in graded_items:
+            items_by_name.setdefault(item.get('name'), item)
+
+        grade_weights = None
+        changed_titles = []
+
+        for title, (score, total) in grades.items():
+            item = items_by_name.get(title)
+
+            if item is not None:
                 # Update if different
-                curr_score = graded_items[existing_index].get('score')
-                curr_total = graded_items[existing_index].get('total')
-                if curr_score != score or curr_total != total:
-                    graded_items[existing_index]['score'] = score
-                    graded_items[existing_index]['total'] = total
-                    changed = True
-            else:
-                # Create
+                if item.get('score') != score or item.get('total') != total:
+                    item['score'] = score
+                    item['total'] = total
+                    changed_titles.append(title)
+                continue
+
+            # Create
+            if grade_weights is None:
                 grade_weights = []
                 if course.get('gradeWeights'):
                     try:
                         grade_weights = json.loads(course['gradeWeights'])
                     except:
                         pass
-                
-                category = "Assignments"
-                if grade_weights:
-                    # Fuzzy match category
-                    found = False
-                    for gw in grade_weights:
-                        cat_name = gw.get('category', '').lower()
-                        if cat_name and (cat_name in title.lower() or title.lower() in cat_name):
-                            category = gw['category']
-                            found = True
-                            break
-                    if not found and grade_weights:
-                        category = grade_weights[0]['category']
-                
-                # Generate simple ID
-                import random, string
-                new_id = ''.join(random.choices(string.ascii_lowercase + string.digits, k=8))
-
-                graded_items.append({
-                    'id': new_id,
-                    'category': category,
-                    'name': title,
-                    'score': score,
-                    'total': total
-                })
-                changed = True
+
+            category = "Assignments"
+            if grade_weights:
+                # Fuzzy match category
+                found = False
+                for gw in grade_weights:
+                    cat_name = gw.get('category', '').lower()
+                    if cat_name and (cat_name in title.lower() or title.lower() in cat_name):
+                        category = gw['category']
+                        found = True
+                        break
+                if not found and grade_weights:
+                    category = grade_weights[0]['category']
+
+            # Generate simple ID
+            new_id = ''.join(random.choices(string.ascii_lowercase + string.digits, k=8))
+
+            item = {
+                'id': new_id,
+                'category': category,
+                'name': title,
+                'score': score,
+                'total': total
+            }
+            graded_items.append(item)
+            items_by_name[title] = item
+            changed_titles.append(title)
+
+        return graded_items, changed_titles
+
+    def grades_change(self, grades: Dict[str, Tuple[float, float]], known_course: Optional[Dict]) -> bool:
+        """Whether grades may change a course; False if the known document already holds them all"""
+        if not grades:
+            return False
+        if known_course is None:
+            return True
+        _, changed_titles = self.merge_course_grades(known_course, grades)
+        return bool(changed_titles)
+
+    def update_course_grades_steps(
+        self,
+        course_id: str,
+        grades: Dict[str, Tuple[float, float]],
+        known_course: Optional[Dict] = None
+    ) -> SyncSteps:
+        """
+        Apply a batch of grades (title -> (score, total)) to a course.
+
+        Performs a single read-modify-write of the course document. If the
+        course document fetched earlier in the run (`known_course`) already
+        holds every grade, the course is neither re-read nor written.
+        """
+        if not self.grades_change(grades, known_course):
+            return True
+
+        try:
+            # Re-fetch course to get latest gradedItems
+            course = yield AppwriteCall.databases(
+                'get_document',
+                DATABASE_ID,
+                COURSES_COLLECTION,
+                course_id
+            )
+
+            graded_items, changed_titles = self.merge_course_grades(course, grades)
             
-            if changed:
-                self.databases.update_document(
+            if changed_titles:
+                yield AppwriteCall.databases(
+                    'update_document',
                     DATABASE_ID,
                     COURSES_COLLECTION,
                     course_id,
                     {'gradedItems': json.dumps(graded_items)}
                 )
-                logger.info(f"Updated grades for course {course_id} - {title}")
+                logger.info(f"Updated {len(changed_titles)} grades for course {course_id}: {', '.join(changed_titles)}")
+            return True
 
         except Exception as e:
             logger.error(f"Error updating course grades {course_id}: {e}")
+            return False
 
-    def create_conflict(
+    def conflict_document(
         self,
         user_id: str,
-        manual_assignment: Dict,
+        manual_assignment: ExistingAssignment,
         gs_assignment: GradescopeAssignment
+    ) -> Dict:
+        """Document data for a conflict record, resolved manually by the user"""
+        return {
+            'userId': user_id,
+            'manualAssignmentId': manual_assignment.id,
+            'gradescopeTitle': gs_assignment.title,
+            'gradescopeDeadline': gs_assignment.deadline.isoformat(),
+            'gradescopeCourseId': gs_assignment.course_id,
+            'gradescopeCourseName': gs_assignment.course_name,
+            'gradescopeData': json.dumps({
+                'id': gs_assignment.id,
+                'title': gs_assignment.title,
+                'courseId': gs_assignment.course_id,
+                'courseName': gs_assignment.course_name,
+                'deadline': gs_assignment.deadline.isoformat(),
+                'pointsPossible': gs_assignment.points_possible
+            }),
+            'resolved': False,
+            'resolution': None,
+            'resolvedAt': None
+        }
+
+    def decrypt_secrets(self, users: List[ConnectedUser]) -> Dict[str, UserSecrets]:
+        """
+        Decrypt session tokens and Gemini keys for a batch of users and
+        memoize them for the run. Failures are logged once per user.
+        """
+        tokens = self.decryptor.decrypt_many([user.encrypted_token for user in users])
+        gemini_keys = self.decryptor.decrypt_many([user.encrypted_gemini_key for user in users])
+
+        decrypted = {}
+        for user, token, gemini_key in zip(users, tokens, gemini_keys):
+            secrets = UserSecrets()
+
+            if isinstance(token, Exception):
+                secrets.error = f"Could not decrypt session token: {token}"
+                logger.error(f"User {user.id}: {secrets.error}")
+                self.record_error(f"User {user.id}: {secrets.error}")
+            else:
+                secrets.session_token = token
+
+            if isinstance(gemini_key, Exception):
+                logger.warning(f"User {user.id}: could not decrypt Gemini key, AI parsing disabled: {gemini_key}")
+            else:
+                secrets.gemini_key = gemini_key
+
+            decrypted[user.id] = secrets
+
+        self._secrets.update(decrypted)
+        return decrypted
+
+    def get_secrets(self, user: ConnectedUser) -> UserSecrets:
+        """Memoized secrets for a user, decrypting on first use"""
+        secrets = self._secrets.get(user.id)
+        if secrets is None:
+            secrets = self.decrypt_secrets([user])[user.id]
+        return secrets
+
+    def fetch_course_assignments(
+        self,
+        gs_client: GradescopeClient,
+        courses: List[Dict],
+        gemini_key: Optional[str],
+        previous_states: Optional[Dict[str, CourseState]] = None
+    ) -> List[Tuple[Dict, CourseFetch]]:
+        """
+        Fetch and parse assignments for every course of a user.
+
+        Courses are fetched concurrently over the user's shared session,
+        active courses first, then pages that need Gemini are parsed
+        together. Finished courses (past terms) that were checked
+        recently are not fetched at all. Results are returned in the same
+        order as `courses`.
+        """
+        previous_states = previous_states or {}
+        now = time.time()
+
+        def fetch(course: Dict) -> CourseFetch:
+            course_id = str(course.get('id', ''))
+            previous = previous_states.get(course_id)
+            if self.skip_course(previous, now):
+                return self.reuse_course(previous)
+            started = time.perf_counter()
+            result = gs_client.fetch_course(course_id, gemini_key, previous, defer_ai=True)
+            self.tracer.record_course(gs_client.client_id, course_id, time.perf_counter() - started)
+            return result
+
+        if self.course_workers == 1 or len(courses) <= 1:
+            results = [(course, fetch(course)) for course in courses]
+        else:
+            with ThreadPoolExecutor(
+                max_workers=min(self.course_workers, len(courses)),
+                thread_name_prefix=f"{threading.current_thread().name}-course"
+            ) as executor:
+                futures = {
+                    position: executor.submit(fetch, courses[position])
+                    for position in self.fetch_order(courses, previous_states, now)
+                }
+                results = [(course, futures[position].result()) for position, course in enumerate(courses)]
+
+        self.parse_pending_pages(gs_client, results, gemini_key)
+        return results
+
+    @staticmethod
+    def skip_course(previous: Optional[CourseState], now: float) -> bool:
+        """A finished course (past term) checked recently is not fetched at all"""
+        return bool(previous and previous.is_finished(now) and previous.recently_checked(now))
+
+    @staticmethod
+    def reuse_course(previous: CourseState) -> CourseFetch:
+        """The result of a course that was not fetched, from its previous state"""
+        return CourseFetch(
+            assignments=previous.assignments,
+            fingerprint=previous.fingerprint,
+            etag=previous.etag,
+            last_modified=previous.last_modified,
+            unchanged=True,
+            skipped=True
+        )
+
+    @staticmethod
+    def fetch_order(courses: List[Dict], previous_states: Dict[str, CourseState], now: float) -> List[int]:
+        """Positions of `courses` in fetch order: active courses first"""
+        def priority(position: int) -> Tuple[bool, int]:
+            previous = previous_states.get(str(courses[position].get('id', '')))
+            return (bool(previous and previous.is_finished(now)), position)
+
+        return sorted(range(len(courses)), key=priority)
+
+    def parse_pending_pages(
+        self,
+        gs_client: GradescopeClient,
+        results: List[Tuple[Dict, CourseFetch]],
+        gemini_key: Optional[str]
     ):
-        """Create a conflict record for manual resolution"""
-        try:
-            self.databases.create_document(
-                DATABASE_ID,
-                CONFLICTS_COLLECTION,
-                ID.unique(),
-                {
-                    'userId': user_id,
-                    'manualAssignmentId': manual_assignment['$id'],
-                    'gradescopeTitle': gs_assignment.title,
-                    'gradescopeDeadline': gs_assignment.deadline.isoformat(),
-                    'gradescopeCourseId': gs_assignment.course_id,
-                    'gradescopeCourseName': gs_assignment.course_name,
-                    'gradescopeData': json.dumps({
-                        'id': gs_assignment.id,
-                        'title': gs_assignment.title,
-                        'courseId': gs_assignment.course_id,
-                        'courseName': gs_assignment.course_name,
-                        'deadline': gs_assignment.deadline.isoformat(),
-                        'pointsPossible': gs_assignment.points_possible
-                    }),
-                    'resolved': False,
-                    'resolution': None,
-                    'resolvedAt': None
-                },
-                [
-                    Permission.read(Role.user(user_id)),
-                    Permission.update(Role.user(user_id)),
-                    Permission.delete(Role.user(user_id))
-                ]
-            )
-            self.stats['conflicts_created'] += 1
-            logger.info(f"Created conflict for user {user_id}: {gs_assignment.title}")
-        except Exception as e:
-            logger.error(f"Error creating conflict: {e}")
+        """Parse every course page left for Gemini in batched requests"""
+        pending = self.pending_pages(results)
+        if not pending:
+            return
+
+        parsed = gs_client.parse_pages_with_ai(
+            {course_id: result.pending_page for course_id, result in pending.items()},
+            gemini_key
+        )
+        self.complete_pending_pages(gs_client, pending, parsed, gemini_key)
+
+    @staticmethod
+    def pending_pages(results: List[Tuple[Dict, CourseFetch]]) -> Dict[str, CourseFetch]:
+        """Fetches left for Gemini, by course id"""
+        return {
+            str(course.get('id', '')): result
+            for course, result in results
+            if result.pending_page is not None
+        }
+
+    @staticmethod
+    def complete_pending_pages(
+        gs_client: BaseGradescopeClient,
+        pending: Dict[str, CourseFetch],
+        parsed: Dict[str, Optional[List[Dict]]],
+        gemini_key: Optional[str]
+    ):
+        """Fill in fetches left for Gemini from its parses"""
+        for course_id, result in pending.items():
+            gs_client.complete_fetch(course_id, result, parsed.get(course_id), gemini_key)
 
     def sync_user(self, user: ConnectedUser):
         """Sync assignments for a single user"""
         logger.info(f"Syncing user {user.id} ({user.email})")
 
         try:
-            # Decrypt session token
-            session_token = self.decryptor.decrypt(user.encrypted_token)
+            with self.tracer.phase('plan'):
+                user_plan = self.plan_user(user)
+            if user_plan is None:
+                self.increment_stat('users_skipped')
+                return
+
+            if self.dry_run:
+                self.record_plan(user_plan)
+            else:
+                with self.tracer.phase('apply'):
+                    self.apply_user_plan(user_plan)
 
-            # Create Gradescope client
-            gs_client = GradescopeClient(session_token)
+            self.increment_stat('users_processed')
 
-            # Verify session is still valid
-            if not gs_client.verify_session():
-                logger.warning(f"Session expired for user {user.id}")
-                self.mark_token_expired(user.id)
-                self.stats['users_skipped'] += 1
-                return
+        except Exception as e:
+            logger.error(f"Error syncing user {user.id}: {e}")
+            self.record_error(f"User {user.id}: {e}")
+            self.increment_stat('users_skipped')
+
+    def plan_user(self, user: ConnectedUser) -> Optional[UserPlan]:
+        """
+        Fetch, parse and match a user's Gradescope courses and work out every
+        write the sync needs, without sending any. Returns None if the user
+        has to be skipped.
+        """
+        # Decrypted session token and Gemini key (memoized for the run)
+        secrets = self.get_secrets(user)
+        if secrets.session_token is None:
+            # Already reported by decrypt_secrets
+            return None
 
-            # Get user's existing assignments and courses
-            existing_assignments = self.get_user_assignments(user.id)
-            internal_courses = self.get_user_courses(user.id)
+        # Create Gradescope client
+        gs_client = GradescopeClient(
+            secrets.session_token,
+            self.parse_cache,
+            self.http_pool,
+            self.rate_limiter,
+            client_id=user.id,
+            courses_api=self.courses_api
+        )
 
-            # Fetch courses and assignments from Gradescope
-            courses = gs_client.get_courses()
-            logger.info(f"Found {len(courses)} courses for user {user.id}")
+        # Verify session is still valid
+        if not gs_client.verify_session():
+            logger.warning(f"Session expired for user {user.id}")
+            self.perform(self.mark_token_expired_steps(user.id, user.labels))
+            return None
+
+        # State from the previous sync (empty for a full sync)
+        previous_states = self.load_previous_states(user)
+
+        # Get user's existing assignments and courses
+        assignment_index, course_resolver, internal_courses = self.build_matchers(
+            user.id, *self.get_user_state(user.id)
+        )
+
+        # Fetch courses and assignments from Gradescope
+        courses = gs_client.get_courses()
+        logger.info(f"Found {len(courses)} courses for user {user.id}")
+
+        gemini_key = secrets.gemini_key
+
+        # Fetch and parse all courses concurrently, then plan the results
+        # in the original course order
+        course_results = self.fetch_course_assignments(
+            gs_client, courses, gemini_key, previous_states
+        )
 
-            for course in courses:
-                course_id = str(course.get('id', ''))
-                course_name = course.get('name', course.get('shortname', 'Unknown'))
+        return self.plan_courses(
+            user, course_results, previous_states, assignment_index, course_resolver, internal_courses
+        )
+
+    def load_previous_states(self, user: ConnectedUser) -> Dict[str, CourseState]:
+        """Course states from the user's previous sync; empty for a full sync"""
+        if not self.incremental:
+            return {}
+        previous_states = self.state_store.load_user(user.id, user.last_sync)
+        if not previous_states:
+            logger.info(f"No usable sync state for user {user.id}, running full sync")
+        return previous_states
+
+    def build_matchers(
+        self,
+        user_id: str,
+        existing_assignments: List[Dict],
+        course_documents: List[Dict]
+    ) -> Tuple[AssignmentIndex, CourseResolver, List[InternalCourse]]:
+        """
+        Index a user's existing documents for matching. Assignments are kept
+        only as the index's compact records; each InternalCourse keeps its
+        course document (just the COURSE_MATCH_FIELDS read), which grade
+        merging needs.
+        """
+        assignment_index = AssignmentIndex(existing_assignments)
+        # Course codes and names normalized once for matching
+        internal_courses = [InternalCourse.from_document(doc) for doc in course_documents]
+        course_resolver = CourseResolver(internal_courses, self.state_store.load_links(user_id))
+        return assignment_index, course_resolver, internal_courses
+
+    def plan_courses(
+        self,
+        user: ConnectedUser,
+        course_results: List[Tuple[Dict, CourseFetch]],
+        previous_states: Dict[str, CourseState],
+        assignment_index: AssignmentIndex,
+        course_resolver: CourseResolver,
+        internal_courses: List[InternalCourse]
+    ) -> UserPlan:
+        """Match a user's fetched courses against their documents and plan every write"""
+        # Grades collected per internal course, written once per course when applied
+        grade_updates: Dict[str, Dict[str, Tuple[float, float]]] = {}
+        # State to record for this run, and which courses feed each internal course
+        new_states: Dict[str, CourseState] = {}
+        courses_by_internal_id: Dict[str, List[str]] = {}
+        # Assignment and conflict writes, applied after every course is planned
+        plan = WritePlan()
+        now = time.time()
+
+        for course, fetch in course_results:
+            course_id = str(course.get('id', ''))
+            course_name = course.get('name', course.get('shortname', 'Unknown'))
+            previous = previous_states.get(course_id)
+
+            if fetch.failed:
+                # Keep what we knew so the course is retried next time
+                if previous:
+                    new_states[course_id] = previous
+                continue
+            if fetch.unchanged:
+                self.increment_stat('courses_unchanged')
+            
+            # Attempt to match with internal course
+            internal_course_id = course_resolver.resolve(
+                course_id, course_name, course.get('shortname', '')
+            )
+
+            if internal_course_id:
+                courses_by_internal_id.setdefault(internal_course_id, []).append(course_id)
+
+            assignments = fetch.assignments
+            logger.info(f"Found {len(assignments)} assignments in {course_name}")
+
+            already_processed = set(previous.processed) if previous else set()
+            processed = []
+
+            for assignment_data in assignments:
+                fingerprint = assignment_fingerprint(assignment_data, internal_course_id)
+                if fingerprint in already_processed:
+                    # Identical to what the last sync applied; nothing to do
+                    processed.append(fingerprint)
+                    self.increment_stat('assignments_unchanged')
+                    continue
+
+                if self.sync_assignment(
+                    user,
+                    assignment_data,
+                    course_id,
+                    course_name,
+                    internal_course_id,
+                    assignment_index,
+                    grade_updates,
+                    plan,
+                    fingerprint
+                ):
+                    processed.append(fingerprint)
+
+            new_states[course_id] = CourseState(
+                fingerprint=fetch.fingerprint,
+                assignments=assignments,
+                processed=processed,
+                checked_at=previous.checked_at if (fetch.skipped and previous) else now,
+                latest_deadline=latest_deadline(assignments),
+                etag=fetch.etag,
+                last_modified=fetch.last_modified
+            )
+
+        return UserPlan(
+            user_id=user.id,
+            last_sync=user.last_sync,
+            writes=plan,
+            grades=grade_updates,
+            grade_courses=courses_by_internal_id,
+            states=new_states,
+            course_links=course_resolver.links,
+            known_courses={ic.id: ic.document for ic in internal_courses}
+        )
+
+    def apply_user_plan(self, user_plan: UserPlan):
+        """Send a user's planned writes and grades, then record the sync"""
+        # Send the planned assignment and conflict writes; assignments whose
+        # writes failed are reprocessed next time
+        failed = self.apply_write_plan(user_plan.writes)
+        self.forget_failed_writes(user_plan, failed)
+
+        for internal_course_id in user_plan.grades:
+            self.perform(self.save_grades_steps(user_plan, internal_course_id))
+
+        self.perform(self.record_sync_steps(user_plan))
+
+    def save_grades_steps(self, user_plan: UserPlan, internal_course_id: str) -> SyncSteps:
+        """Write one internal course's planned grades; if that fails its courses are reprocessed next time"""
+        saved = yield from self.update_course_grades_steps(
+            internal_course_id,
+            user_plan.grades[internal_course_id],
+            user_plan.known_courses.get(internal_course_id)
+        )
+        if not saved:
+            self.forget_failed_grades(user_plan, internal_course_id)
+
+    def record_sync_steps(self, user_plan: UserPlan) -> SyncSteps:
+        """Update the user's last sync time, then save the state for the next run"""
+        last_sync = datetime.utcnow().isoformat() + 'Z'
+        yield from self.update_user_prefs_steps(user_plan.user_id, {
+            'gradescopeLastSync': last_sync
+        })
+        yield LocalCall(self.save_user_state, (user_plan, last_sync))
+
+    def forget_failed_writes(self, user_plan: UserPlan, failed: set):
+        """Unmark assignments whose writes failed, so they are reprocessed next time"""
+        if not failed:
+            return
+        for course_id, state in user_plan.states.items():
+            state.processed = [
+                fingerprint for fingerprint in state.processed
+                if (course_id, fingerprint) not in failed
+            ]
+
+    def forget_failed_grades(self, user_plan: UserPlan, internal_course_id: str):
+        """Grades were not saved: reprocess the courses feeding them next time"""
+        for course_id in user_plan.grade_courses.get(internal_course_id, []):
+            if course_id in user_plan.states:
+                user_plan.states[course_id].processed = []
+
+    def save_user_state(self, user_plan: UserPlan, last_sync: str):
+        """Record a user's applied sync for the next incremental run"""
+        self.state_store.save_user(user_plan.user_id, last_sync, user_plan.states)
+        self.state_store.save_links(user_plan.user_id, user_plan.course_links)
+
+    def sync_assignment(
+        self,
+        user: ConnectedUser,
+        assignment_data: Dict,
+        course_id: str,
+        course_name: str,
+        internal_course_id: str,
+        assignment_index: AssignmentIndex,
+        grade_updates: Dict[str, Dict[str, Tuple[float, float]]],
+        plan: WritePlan,
+        fingerprint: str = ''
+    ) -> bool:
+        """
+        Plan the writes for one parsed Gradescope assignment of a user.
+        Nothing is sent here; `plan` is applied once the whole user is planned.
+        Returns False if the assignment could not be processed.
+        """
+        try:
+            # Parse deadline (handle different formats from AI or API)
+            deadline_str = assignment_data.get('due_date') or assignment_data.get('due_at')
+            
+            # Fallback for graded assignments without deadline (using dummy past date to allow grade processing)
+            if not deadline_str and assignment_data.get('status') == 'Graded':
+                deadline_str = f"{datetime.now().year}-01-01T00:00:00+00:00"
+
+            if not deadline_str:
+                logger.warning(f"Skipping {assignment_data.get('title')} - No deadline found")
+                return True
+
+            # Clean up ISO string from AI (might have Z or offset)
+            deadline_str = deadline_str.replace('Z', '+00:00')
+            try:
+                deadline = datetime.fromisoformat(deadline_str)
+            except:
+                # Fallback parsing
+                return True
+            
+            points_possible = assignment_data.get('total_points')
+            if points_possible is None:
+                points_possible = assignment_data.get('points')
+            
+            # Parse score
+            score = assignment_data.get('score')
+            if score is None and 'submission' in assignment_data:
+                 score = assignment_data['submission'].get('score')
+
+            gs_assignment = GradescopeAssignment(
+                id=str(assignment_data.get('id', '')),
+                title=assignment_data.get('title', assignment_data.get('name', 'Untitled')),
+                course_id=course_id,
+                course_name=course_name,
+                deadline=deadline,
+                points_possible=float(points_possible) if points_possible is not None else None,
+                score=float(score) if score is not None else None
+            )
+            
+            # Update course grades if score exists and course matched
+            if gs_assignment.score is not None:
+                if internal_course_id:
+                    total = gs_assignment.points_possible if gs_assignment.points_possible else 100.0
+                    logger.info(f"Updating grade for {gs_assignment.title}: {gs_assignment.score}/{total}")
+                    grade_updates.setdefault(internal_course_id, {})[gs_assignment.title] = (gs_assignment.score, total)
+                else:
+                    logger.warning(f"Could not link course '{course_name}' to any internal course. Grade for '{gs_assignment.title}' not saved.")
+            else:
+                logger.info(f"No score found for {gs_assignment.title}")
+
+            # Check if already tracked by gradescopeId
+            existing_match = self.find_by_gradescope_id(
+                assignment_index,
+                gs_assignment.id
+            )
+
+            dependent = (course_id, fingerprint)
+
+            if existing_match:
+                # Update details
+                updates = {}
+                if existing_match.deadline_ts != gs_assignment.deadline_ts:
+                    updates['deadline'] = gs_assignment.deadline.isoformat()
                 
-                # Attempt to match with internal course
-                internal_course_id = ''
-                gs_name_clean = ''.join(e for e in course_name.lower() if e.isalnum())
-                gs_short_clean = ''.join(e for e in course.get('shortname', '').lower() if e.isalnum())
+                # Update courseId if we found a match and it was missing
+                if internal_course_id and not existing_match.course_id:
+                    updates['courseId'] = internal_course_id
                 
-                for ic in internal_courses:
-                    ic_code = ''.join(e for e in ic.get('code', '').lower() if e.isalnum())
-                    ic_name = ''.join(e for e in ic.get('name', '').lower() if e.isalnum())
-                    
-                    if (ic_code and ic_code in gs_short_clean) or \
-                       (gs_short_clean and gs_short_clean in ic_code) or \
-                       (ic_name and ic_name == gs_name_clean):
-                        internal_course_id = ic['$id']
-                        break
+                if updates:
+                    plan.update(
+                        ASSIGNMENTS_COLLECTION,
+                        existing_match.id,
+                        updates,
+                        dependent,
+                        description=f"Updated {gs_assignment.title}"
+                    )
+                return True
 
-                # Decrypt Gemini Key (if available for this user)
-                gemini_key = None
-                if user.encrypted_gemini_key:
-                    try:
-                        gemini_key = self.decryptor.decrypt(user.encrypted_gemini_key)
-                    except:
-                        pass
+            # Check for potential conflict with manual assignment
+            similar_assignment = self.find_similar_assignment(
+                assignment_index,
+                gs_assignment
+            )
 
-                assignments = gs_client.get_assignments(course_id, gemini_key)
-                logger.info(f"Found {len(assignments)} assignments in {course_name}")
+            if similar_assignment:
+                # Create conflict for manual resolution
+                plan.create(
+                    ('conflict', similar_assignment.id, gs_assignment.id),
+                    CONFLICTS_COLLECTION,
+                    self.conflict_document(user.id, similar_assignment, gs_assignment),
+                    self.user_permissions(user.id),
+                    dependent,
+                    stat='conflicts_created',
+                    description=f"Created conflict for user {user.id}: {gs_assignment.title}"
+                )
+                return True
 
-                for assignment_data in assignments:
-                    try:
-                        # Parse deadline (handle different formats from AI or API)
-                        deadline_str = assignment_data.get('due_date') or assignment_data.get('due_at')
-                        
-                        # Fallback for graded assignments without deadline (using dummy past date to allow grade processing)
-                        if not deadline_str and assignment_data.get('status') == 'Graded':
-                            deadline_str = f"{datetime.now().year}-01-01T00:00:00+00:00"
-
-                        if not deadline_str:
-                            logger.warning(f"Skipping {assignment_data.get('title')} - No deadline found")
-                            continue
-
-                        # Clean up ISO string from AI (might have Z or offset)
-                        deadline_str = deadline_str.replace('Z', '+00:00')
-                        try:
-                            deadline = datetime.fromisoformat(deadline_str)
-                        except:
-                            # Fallback parsing
-                            continue
-                        
-                        points_possible = assignment_data.get('total_points')
-                        if points_possible is None:
-                            points_possible = assignment_data.get('points')
-                        
-                        # Parse score
-                        score = assignment_data.get('score')
-                        if score is None and 'submission' in assignment_data:
-                             score = assignment_data['submission'].get('score')
-
-                        gs_assignment = GradescopeAssignment(
-                            id=str(assignment_data.get('id', '')),
-                            title=assignment_data.get('title', assignment_data.get('name', 'Untitled')),
-                            course_id=course_id,
-                            course_name=course_name,
-                            deadline=deadline,
-                            points_possible=float(points_possible) if points_possible is not None else None,
-                            score=float(score) if score is not None else None
-                        )
-                        
-                        # Update course grades if score exists and course matched
-                        if gs_assignment.score is not None:
-                            if internal_course_id:
-                                total = gs_assignment.points_possible if gs_assignment.points_possible else 100.0
-                                logger.info(f"Updating grade for {gs_assignment.title}: {gs_assignment.score}/{total}")
-                                self.update_course_grades(internal_course_id, gs_assignment.title, gs_assignment.score, total)
-                            else:
-                                logger.warning(f"Could not link course '{course_name}' to any internal course. Grade for '{gs_assignment.title}' not saved.")
-                        else:
-                            logger.info(f"No score found for {gs_assignment.title}")
-
-                        # Check if already tracked by gradescopeId
-                        existing_match = self.find_by_gradescope_id(
-                            existing_assignments,
-                            gs_assignment.id
-                        )
+            # Skip task creation if assignment is in the past (completed/old)
+            # But we still processed the grade above!
+            if gs_assignment.deadline_ts < time.time():
+                return True
 
-                        if existing_match:
-                            # Update details
-                            updates = {}
-                            existing_deadline = datetime.fromisoformat(
-                                existing_match['deadline'].replace('Z', '+00:00')
-                            )
-                            if existing_deadline != gs_assignment.deadline:
-                                updates['deadline'] = gs_assignment.deadline.isoformat()
-                            
-                            # Update courseId if we found a match and it was missing
-                            if internal_course_id and not existing_match.get('courseId'):
-                                updates['courseId'] = internal_course_id
-                            
-                            if updates:
-                                self.update_assignment(existing_match['$id'], updates)
-                                logger.info(f"Updated {gs_assignment.title}")
-                            continue
-
-                        # Check for potential conflict with manual assignment
-                        similar_assignment = self.find_similar_assignment(
-                            existing_assignments,
-                            gs_assignment
-                        )
+            # Create new assignment, already linked to the internal course
+            # (previously a create followed by an update setting courseId)
+            plan.create(
+                ('assignment', gs_assignment.id),
+                ASSIGNMENTS_COLLECTION,
+                self.assignment_document(user.id, gs_assignment, internal_course_id),
+                self.user_permissions(user.id),
+                dependent,
+                stat='assignments_synced',
+                description=f"Created assignment: {gs_assignment.title}",
+                naive_writes=2 if internal_course_id else 1
+            )
+            return True
 
-                        if similar_assignment:
-                            # Create conflict for manual resolution
-                            self.create_conflict(user.id, similar_assignment, gs_assignment)
-                        else:
-                            # Skip task creation if assignment is in the past (completed/old)
-                            # But we still processed the grade above!
-                            if gs_assignment.deadline.timestamp() < datetime.now().timestamp():
-                                continue
-
-                            # Create new assignment
-                            # Inject internal_course_id into creation logic. 
-                            # But create_assignment method doesn't take it currently.
-                            # I'll modify create_assignment now as well or just update it after creation if simpler. 
-                            # Or better: modify create_assignment to take optional course_id.
-                            
-                            # Since I can't easily modify create_assignment signature without replacing it too,
-                            # I'll just override the courseId in the method if I pass it, 
-                            # but create_assignment is separate.
-                            # Let's just create it, then update it if needed? No, create correctly is better.
-                            
-                            # I'll temporarily update the create_assignment call to handle it if I modify create_assignment.
-                            # But I didn't modify create_assignment yet.
-                            # Let's update create_assignment later. For now, create then update if needed.
-                            # Actually, I'll invoke create_assignment then update.
-                            
-                            new_id = self.create_assignment(user.id, gs_assignment)
-                            if new_id:
-                                if internal_course_id:
-                                    self.update_assignment(new_id, {'courseId': internal_course_id})
-                                self.stats['assignments_synced'] += 1
-                                logger.info(f"Created assignment: {gs_assignment.title}")
-
-                    except Exception as e:
-                        logger.error(f"Error processing assignment: {e}")
-
-            # Update last sync time
-            self.users_service.update_prefs(user.id, {
-                'gradescopeLastSync': datetime.utcnow().isoformat() + 'Z'
-            })
+        except Exception as e:
+            logger.error(f"Error processing assignment: {e}")
+            return False
+
+    def record_plan(self, user_plan: UserPlan):
+        """Append a user's plan to the plan file (plan mode)"""
+        # Only grades that differ from the course documents read while planning
+        for internal_course_id, grades in list(user_plan.grades.items()):
+            known_course = user_plan.known_courses.get(internal_course_id)
+            if known_course is not None:
+                _, changed_titles = self.merge_course_grades(known_course, grades)
+                grades = {title: grades[title] for title in changed_titles}
+            if grades:
+                user_plan.grades[internal_course_id] = grades
+            else:
+                del user_plan.grades[internal_course_id]
+
+        # Counted as planned: nothing is written until the plan is replayed
+        for write in user_plan.writes.writes.values():
+            if write.stat:
+                self.increment_stat(PLANNED_STATS[write.stat])
+        self.increment_stat(PLANNED_STATS['writes_sent'], len(user_plan.writes))
+        self.increment_stat('writes_saved', user_plan.writes.naive_writes - len(user_plan.writes))
+
+        self._plan_states.save_user(user_plan.user_id, user_plan.last_sync or '', user_plan.states)
+        line = json.dumps(user_plan.to_json(), separators=(',', ':'))
+        with self._plan_lock:
+            self._plan_file.write(line + '\n')
+
+    def replay_user_plan(self, user_plan: UserPlan):
+        """Apply one user's saved plan, unless the user was synced after it was made"""
+        started = time.perf_counter()
+        try:
+            prefs = self.users_service.get_prefs(user_plan.user_id)
+            if prefs.get('gradescopeLastSync') != user_plan.last_sync:
+                logger.warning(f"Plan for user {user_plan.user_id} is stale (synced since), skipping")
+                self.increment_stat('users_skipped')
+                return
+
+            if self._plan_states:
+                user_plan.states = self._plan_states.load_states(user_plan.user_id)
+            with self.tracer.phase('apply'):
+                self.apply_user_plan(user_plan)
+            self.increment_stat('users_processed')
+        except Exception as e:
+            logger.error(f"Error applying plan for user {user_plan.user_id}: {e}")
+            self.record_error(f"User {user_plan.user_id}: {e}")
+            self.increment_stat('users_skipped')
+        finally:
+            self.tracer.record_user(user_plan.user_id, time.perf_counter() - started)
 
-            self.stats['users_processed'] += 1
+    def sync_user_isolated(self, user: ConnectedUser):
+        """Sync a single user, containing any failure to that user"""
+        with self.isolated_user(user):
+            self.sync_user(user)
 
+    @contextmanager
+    def isolated_user(self, user: ConnectedUser):
+        """Contain any failure of a user's sync to that user, and time it"""
+        started = time.perf_counter()
+        try:
+            yield
         except Exception as e:
-            logger.error(f"Error syncing user {user.id}: {e}")
-            self.stats['errors'].append(f"User {user.id}: {e}")
-            self.stats['users_skipped'] += 1
+            logger.error(f"Unhandled error for user {user.id}: {e}")
+            self.record_error(f"User {user.id}: {e}")
+        finally:
+            # Release the user's plaintext credentials as soon as they are done
+            self._secrets.pop(user.id, None)
+            self.tracer.record_user(user.id, time.perf_counter() - started)
+
+    @property
+    def mode(self) -> str:
+        if self.dry_run:
+            return 'plan'
+        return 'incremental' if self.incremental else 'full'
+
+    @property
+    def report_path(self) -> str:
+        """Where this run's report goes; shards each write their own"""
+        if self.shard is None:
+            return RUN_REPORT_PATH
+        root, ext = os.path.splitext(RUN_REPORT_PATH)
+        return f"{root}.shard-{self.shard[0]}-of-{self.shard[1]}{ext}"
+
+    def write_run_report(
+        self,
+        started_at: datetime,
+        duration: float,
+        path: Optional[str] = None,
+        mode: Optional[str] = None
+    ) -> Dict[str, Any]:
+        """Write the machine-readable summary of this run next to sync.log and return it"""
+        path = path or self.report_path
+        with self._stats_lock:
+            stats = {key: value for key, value in self.stats.items() if key != 'errors'}
+            errors = list(self.stats['errors'])
+
+        report = {
+            'started_at': started_at.isoformat() + 'Z',
+            'duration_seconds': round(duration, 3),
+            'mode': mode or self.mode,
+            'engine': self.engine,
+            'shard': f"{self.shard[0]}/{self.shard[1]}" if self.shard else None,
+            'workers': self.workers,
+            'course_workers': self.course_workers,
+            'write_workers': self.write_workers,
+            'stats': stats,
+            'errors': errors,
+            'parse_cache': {'hits': self.parse_cache.hits, 'misses': self.parse_cache.misses},
+            'rate_limits': self.rate_limiter.metrics(),
+            **self.tracer.summary(),
+        }
+
+        try:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(path, 'w') as f:
+                json.dump(report, f, indent=2)
+            logger.info(f"Wrote run report to {path}")
+        except Exception as e:
+            logger.error(f"Failed to write run report: {e}")
+        return report
 
     def run(self):
         """Main sync loop"""
+        started_at, run_started = self.start_run()
+
+        user_count = 0
+        try:
+            # Users are streamed: syncing starts with the first page, and each
+            # page's credentials are decrypted once, as it is enumerated
+            if self.workers == 1:
+                for batch in self.iter_user_batches():
+                    user_count += len(batch)
+                    for user in batch:
+                        self.sync_user_isolated(user)
+            else:
+                logger.info(f"Syncing with {self.workers} workers")
+                # The pool size caps how many users are in flight at once, and
+                # `slots` how many are waiting, so enumeration stays just ahead
+                slots = threading.BoundedSemaphore(self.workers * USER_QUEUE_DEPTH)
+                with ThreadPoolExecutor(
+                    max_workers=self.workers,
+                    thread_name_prefix='sync'
+                ) as executor:
+                    for batch in self.iter_user_batches():
+                        user_count += len(batch)
+                        for user in batch:
+                            slots.acquire()
+                            future = executor.submit(self.sync_user_isolated, user)
+                            future.add_done_callback(lambda _: slots.release())
+        finally:
+            self.stop_run()
+
+        self.finish_run(started_at, run_started, user_count)
+
+    def start_run(self) -> Tuple[datetime, float]:
+        """Log the start of a run and open the plan file; returns the start (UTC, perf counter)"""
         logger.info("=" * 50)
-        logger.info("Starting Gradescope sync")
+        logger.info(f"Starting Gradescope sync ({self.mode}, {self.engine} engine)")
+        if self.dry_run:
+            logger.info(f"Plan mode: writing planned changes to {self.plan_path}, nothing is applied")
         logger.info("=" * 50)
 
-        # Get all connected users
-        users = self.get_connected_users()
-        logger.info(f"Found {len(users)} connected users")
+        if self.dry_run:
+            self._plan_file = open(self.plan_path, 'w')
+            # Like the plan file, the sidecar only holds this run's plans
+            states_path = plan_states_path(self.plan_path)
+            if os.path.exists(states_path):
+                os.remove(states_path)
+            self._plan_states = SyncStateStore(states_path)
+        return datetime.utcnow(), time.perf_counter()
 
-        # Sync each user
-        for user in users:
-            try:
-                self.sync_user(user)
-            except Exception as e:
-                logger.error(f"Unhandled error for user {user.id}: {e}")
-                self.stats['errors'].append(f"User {user.id}: {e}")
+    def stop_run(self):
+        """Drop the run's credentials and close the plan file, however the run ended"""
+        # Do not keep plaintext credentials beyond the run
+        self._secrets.clear()
+        if self._plan_file:
+            self._plan_file.close()
+        if self._plan_states:
+            self._plan_states.close()
+
+    def finish_run(self, started_at: datetime, run_started: float, user_count: int):
+        """Close the run's caches and pools, then write and log the run report"""
+        self.parse_cache.close()
+        self.state_store.close()
+        self.http_pool.close()
+
+        logger.info(f"Found {user_count} connected users")
+        report = self.write_run_report(started_at, time.perf_counter() - run_started)
+        log_run_summary(report)
 
-        # Log summary
+    def replay(self, path: str):
+        """Apply a plan file written by plan mode"""
         logger.info("=" * 50)
-        logger.info("Sync complete")
-        logger.info(f"Users processed: {self.stats['users_processed']}")
-        logger.info(f"Users skipped: {self.stats['users_skipped']}")
-        logger.info(f"Assignments synced: {self.stats['assignments_synced']}")
-        logger.info(f"Conflicts created: {self.stats['conflicts_created']}")
-        if self.stats['errors']:
-            logger.warning(f"Errors: {len(self.stats['errors'])}")
-            for error in self.stats['errors'][:10]:  # Log first 10 errors
-                logger.warning(f"  - {error}")
+        logger.info(f"Replaying sync plan {path}")
         logger.info("=" * 50)
 
+        started_at = datetime.utcnow()
+        run_started = time.perf_counter()
+
+        states_path = plan_states_path(path)
+        if os.path.exists(states_path):
+            self._plan_states = SyncStateStore(states_path)
+        else:
+            # Still safe: the next run just reprocesses these users in full
+            logger.warning(f"No course states next to the plan ({states_path}), none will be recorded")
+
+        with open(path) as f:
+            user_plans = (UserPlan.from_json(json.loads(line)) for line in f if line.strip())
+            if self.workers == 1:
+                for user_plan in user_plans:
+                    self.replay_user_plan(user_plan)
+            else:
+                with ThreadPoolExecutor(
+                    max_workers=self.workers,
+                    thread_name_prefix='replay'
+                ) as executor:
+                    for _ in executor.map(self.replay_user_plan, user_plans):
+                        pass
+
+        if self._plan_states:
+            self._plan_states.close()
+        self.parse_cache.close()
+        self.state_store.close()
+        self.http_pool.close()
+
+        report = self.write_run_report(started_at, time.perf_counter() - run_started, mode='replay')
+        log_run_summary(report)
+
+
+class AsyncGradescopeSyncer(GradescopeSyncer):
+    """
+    Sync orchestrator on asyncio (--engine asyncio).
+
+    Gradescope and Gemini go through aiohttp and Appwrite through its REST
+    API, so a single thread keeps thousands of requests in flight. Users,
+    their courses and their writes run as task groups, bounded by the same
+    worker settings as the threaded engine (which is kept for comparison).
+    Planning a user is cancelled after ASYNC_USER_PLAN_TIMEOUT. Everything
+    but the requests and their concurrency is GradescopeSyncer's: Appwrite
+    operations are its `*_steps` generators, run here by perform_async.
+    Blocking work (the SQLite caches, page cleaning and parsing, matching)
+    runs on worker threads so it never stalls the event loop. Replaying a
+    plan and backfilling labels still run on threads.
+    """
+
+    engine = 'asyncio'
+
+    def __init__(self, *args, **kwargs):
+        if aiohttp is None:
+            raise RuntimeError("The asyncio engine needs aiohttp (pip install aiohttp)")
+        super().__init__(*args, **kwargs)
+        self.rate_limiter = AsyncRateLimiter(shard_rate_limits(self.shard))
+        # Created by run_async, inside the event loop
+        self.async_pool: Optional[AsyncHttpPool] = None
+        self.async_databases: Optional[AsyncDatabases] = None
+        self.async_users: Optional[AsyncUsers] = None
+
+    def run(self):
+        """Main sync loop, on a new event loop"""
+        asyncio.run(self.run_async())
+
+    async def run_async(self):
+        started_at, run_started = self.start_run()
+
+        self.async_pool = AsyncHttpPool(tracer=self.tracer)
+        appwrite = AsyncAppwriteClient(os.environ['APPWRITE_ENDPOINT'], self.client, self.async_pool)
+        self.async_databases = AsyncDatabases(appwrite)
+        self.async_users = AsyncUsers(appwrite)
+
+        user_count = 0
+        try:
+            logger.info(f"Syncing up to {self.workers} users at a time")
+            # Enumeration waits for a free slot, so it stays just ahead of the syncs
+            slots = asyncio.Semaphore(self.workers)
+            async with asyncio.TaskGroup() as syncs:
+                async for batch in self.iter_user_batches_async():
+                    user_count += len(batch)
+                    for user in batch:
+                        await slots.acquire()
+                        task = syncs.create_task(self.sync_user_isolated_async(user))
+                        task.add_done_callback(lambda _: slots.release())
+        finally:
+            self.stop_run()
+            await self.async_pool.close()
+
+        self.finish_run(started_at, run_started, user_count)
+
+    async def perform_async(self, steps: SyncSteps) -> Any:
+        """Run sync steps (see perform) on the Appwrite REST client, and LocalCalls on a worker thread"""
+        services = {'databases': self.async_databases, 'users': self.async_users}
+        response, error = None, None
+        while True:
+            try:
+                call = steps.send(response) if error is None else steps.throw(error)
+            except StopIteration as done:
+                return done.value
+            try:
+                if isinstance(call, LocalCall):
+                    response = await asyncio.to_thread(call.function, *call.args)
+                else:
+                    response = await getattr(services[call.service], call.method)(*call.args, **call.kwargs)
+                error = None
+            except Exception as e:
+                response, error = None, e
+
+    async def iter_user_batches_async(self):
+        """Like iter_user_batches"""
+        cursor = None
+        try:
+            while True:
+                with self.tracer.phase('enumerate_users'):
+                    batch, cursor = await self.perform_async(self.connected_users_page_steps(cursor))
+                if batch:
+                    with self.tracer.phase('decrypt'):
+                        await asyncio.to_thread(self.decrypt_secrets, batch)
+                    yield batch
+                if cursor is None:
+                    return
+
+        except Exception as e:
+            logger.error(f"Error fetching connected users: {e}")
+            self.record_error(f"Failed to fetch users: {e}")
+
+    async def sync_user_isolated_async(self, user: ConnectedUser):
+        with self.isolated_user(user):
+            await self.sync_user_async(user)
+
+    async def sync_user_async(self, user: ConnectedUser):
+        logger.info(f"Syncing user {user.id} ({user.email})")
+
+        try:
+            # Only planning is cancelled on timeout: it writes nothing to the
+            # user's documents, so no sync is ever left half-applied
+            try:
+                with self.tracer.phase('plan'):
+                    async with asyncio.timeout(ASYNC_USER_PLAN_TIMEOUT):
+                        user_plan = await self.plan_user_async(user)
+            except TimeoutError:
+                raise RuntimeError(f"planning took over {ASYNC_USER_PLAN_TIMEOUT}s and was cancelled") from None
+            if user_plan is None:
+                self.increment_stat('users_skipped')
+                return
+
+            if self.dry_run:
+                await asyncio.to_thread(self.record_plan, user_plan)
+            else:
+                with self.tracer.phase('apply'):
+                    await self.apply_user_plan_async(user_plan)
+
+            self.increment_stat('users_processed')
+
+        except Exception as e:
+            logger.error(f"Error syncing user {user.id}: {e}")
+            self.record_error(f"User {user.id}: {e}")
+            self.increment_stat('users_skipped')
+
+    async def plan_user_async(self, user: ConnectedUser) -> Optional[UserPlan]:
+        """Like plan_user, reading the user's documents while their course list is fetched"""
+        secrets = self.get_secrets(user)
+        if secrets.session_token is None:
+            # Already reported by decrypt_secrets
+            return None
+
+        gs_client = AsyncGradescopeClient(
+            secrets.session_token,
+            self.parse_cache,
+            self.async_pool,
+            self.rate_limiter,
+            client_id=user.id,
+            courses_api=self.courses_api
+        )
+        try:
+            if not await gs_client.verify_session():
+                logger.warning(f"Session expired for user {user.id}")
+                await self.perform_async(self.mark_token_expired_steps(user.id, user.labels))
+                return None
+
+            previous_states = await asyncio.to_thread(self.load_previous_states, user)
+
+            async with asyncio.TaskGroup() as reads:
+                existing_assignments = reads.create_task(self.perform_async(self.get_user_assignments_steps(user.id)))
+                course_documents = reads.create_task(self.perform_async(self.get_user_courses_steps(user.id)))
+                gradescope_courses = reads.create_task(gs_client.get_courses())
+
+            assignment_index, course_resolver, internal_courses = await asyncio.to_thread(
+                self.build_matchers, user.id, existing_assignments.result(), course_documents.result()
+            )
+            courses = gradescope_courses.result()
+            logger.info(f"Found {len(courses)} courses for user {user.id}")
+
+            course_results = await self.fetch_course_assignments_async(
+                gs_client, courses, secrets.gemini_key, previous_states
+            )
+        finally:
+            await gs_client.close()
+
+        return await asyncio.to_thread(
+            self.plan_courses,
+            user, course_results, previous_states, assignment_index, course_resolver, internal_courses
+        )
+
+    async def fetch_course_assignments_async(
+        self,
+        gs_client: AsyncGradescopeClient,
+        courses: List[Dict],
+        gemini_key: Optional[str],
+        previous_states: Optional[Dict[str, CourseState]] = None
+    ) -> List[Tuple[Dict, CourseFetch]]:
+        """Like fetch_course_assignments, with at most `course_workers` pages in flight"""
+        previous_states = previous_states or {}
+        now = time.time()
+        slots = asyncio.Semaphore(self.course_workers)
+
+        async def fetch(course: Dict) -> CourseFetch:
+            course_id = str(course.get('id', ''))
+            previous = previous_states.get(course_id)
+            if self.skip_course(previous, now):
+                return self.reuse_course(previous)
+            async with slots:
+                started = time.perf_counter()
+                result = await gs_client.fetch_course(course_id, gemini_key, previous, defer_ai=True)
+                self.tracer.record_course(gs_client.client_id, course_id, time.perf_counter() - started)
+            return result
+
+        # Tasks take the slots in creation order: active courses first
+        async with asyncio.TaskGroup() as fetches:
+            tasks = {
+                position: fetches.create_task(fetch(courses[position]))
+                for position in self.fetch_order(courses, previous_states, now)
+            }
+        results = [(course, tasks[position].result()) for position, course in enumerate(courses)]
+
+        pending = self.pending_pages(results)
+        if pending:
+            parsed = await gs_client.parse_pages_with_ai(
+                {course_id: result.pending_page for course_id, result in pending.items()},
+                gemini_key
+            )
+            self.complete_pending_pages(gs_client, pending, parsed, gemini_key)
+        return results
+
+    async def apply_write_plan_async(self, plan: WritePlan) -> set:
+        """Like apply_write_plan, with at most `write_workers` writes in flight"""
+        if not plan.writes:
+            return set()
+
+        writes = list(plan.writes.values())
+        slots = asyncio.Semaphore(self.write_workers)
+
+        async def send(write: PlannedWrite) -> bool:
+            async with slots:
+                return await self.perform_async(self.execute_write_steps(write))
+
+        results = await asyncio.gather(*(send(write) for write in writes))
+        return self.write_failures(plan, writes, results)
+
+    async def apply_user_plan_async(self, user_plan: UserPlan):
+        """Like apply_user_plan; each course's grades are written concurrently"""
+        failed = await self.apply_write_plan_async(user_plan.writes)
+        self.forget_failed_writes(user_plan, failed)
+
+        # Every internal course is its own document, so none can race
+        slots = asyncio.Semaphore(self.write_workers)
+
+        async def save_grades(internal_course_id: str):
+            async with slots:
+                await self.perform_async(self.save_grades_steps(user_plan, internal_course_id))
+
+        await asyncio.gather(*(save_grades(course_id) for course_id in list(user_plan.grades)))
+        await self.perform_async(self.record_sync_steps(user_plan))
+
+
+def log_run_summary(report: Dict[str, Any]):
+    """Log the human-readable summary of a run report"""
+    stats = report['stats']
+    dry_run = report['mode'] == 'plan'
+
+    logger.info("=" * 50)
+    logger.info("Sync complete" if not dry_run else "Plan complete (nothing was written)")
+    if report.get('shards'):
+        logger.info(f"Shards reported: {', '.join(str(shard['shard']) for shard in report['shards'])}")
+        if report.get('missing_shards'):
+            logger.warning(f"Shards missing a report: {', '.join(report['missing_shards'])}")
+    logger.info(f"Users processed: {stats['users_processed']}")
+    logger.info(f"Users skipped: {stats['users_skipped']}")
+    if dry_run:
+        logger.info(f"Assignments planned: {stats['planned_assignments']}")
+        logger.info(f"Conflicts planned: {stats['planned_conflicts']}")
+    else:
+        logger.info(f"Assignments synced: {stats['assignments_synced']}")
+        logger.info(f"Conflicts created: {stats['conflicts_created']}")
+    logger.info(f"Unchanged: {stats['courses_unchanged']} courses, {stats['assignments_unchanged']} assignments")
+    logger.info(
+        f"Writes: {stats['planned_writes'] if dry_run else stats['writes_sent']} "
+        f"{'planned' if dry_run else 'sent'}, {stats['writes_saved']} saved by batching"
+    )
+    logger.info(
+        f"Appwrite documents read: {stats['documents_read']} "
+        f"({stats['snapshot_reloads']} snapshot reloads)"
+    )
+    logger.info(f"Parse cache: {report['parse_cache']['hits']} hits, {report['parse_cache']['misses']} misses")
+    for key, metrics in report['rate_limits'].items():
+        logger.info(
+            f"Rate limit {key}: {metrics['requests']} requests, "
+            f"avg wait {metrics['avg_wait']:.2f}s, max wait {metrics['max_wait']:.2f}s, "
+            f"max queue {metrics['max_queue_depth']}"
+        )
+    if report['errors']:
+        logger.warning(f"Errors: {len(report['errors'])}")
+        for error in report['errors'][:10]:  # Log first 10 errors
+            logger.warning(f"  - {error}")
+    logger.info("=" * 50)
+
+
+def merge_run_reports(reports: List[Dict[str, Any]], slowest: int = 10) -> Dict[str, Any]:
+    """
+    Combine the run reports of the shards of one sync into a single report.
+
+    Counters are summed and errors concatenated (tagged with their shard).
+    The duration is the slowest shard's, since shards run side by side.
+    Phase p50/p95 cannot be recombined from summaries, so the merged
+    values are the largest shard value (an upper bound).
+    """
+    stats: Dict[str, int] = {}
+    errors: List[str] = []
+    phases: Dict[str, Dict[str, float]] = {}
+    rate_limits: Dict[str, Dict[str, float]] = {}
+    parse_cache = {'hits': 0, 'misses': 0}
+    shards = []
+
+    for report in reports:
+        shard = report.get('shard')
+        shards.append({
+            'shard': shard,
+            'duration_seconds': report['duration_seconds'],
+            'users_processed': report['stats'].get('users_processed', 0),
+            'errors': len(report['errors']),
+        })
+        for key, value in report['stats'].items():
+            stats[key] = stats.get(key, 0) + value
+        errors.extend(f"[shard {shard}] {error}" if shard else error for error in report['errors'])
+        for key in parse_cache:
+            parse_cache[key] += report['parse_cache'].get(key, 0)
+
+        for name, timing in report['phases'].items():
+            merged = phases.setdefault(name, {'count': 0, 'total': 0.0, 'p50': 0.0, 'p95': 0.0, 'max': 0.0})
+            merged['count'] += timing['count']
+            merged['total'] = round(merged['total'] + timing['total'], 4)
+            for key in ('p50', 'p95', 'max'):
+                merged[key] = max(merged[key], timing[key])
+
+        for key, metrics in report['rate_limits'].items():
+            merged = rate_limits.setdefault(key, {
+                'requests': 0, 'avg_wait': 0.0, 'max_wait': 0.0, 'queue_depth': 0, 'max_queue_depth': 0
+            })
+            requests_before = merged['requests']
+            merged['requests'] += metrics['requests']
+            if merged['requests']:
+                merged['avg_wait'] = round(
+                    (merged['avg_wait'] * requests_before + metrics['avg_wait'] * metrics['requests'])
+                    / merged['requests'], 4
+                )
+            merged['max_wait'] = max(merged['max_wait'], metrics['max_wait'])
+            merged['queue_depth'] += metrics.get('queue_depth', 0)
+            merged['max_queue_depth'] = max(merged['max_queue_depth'], metrics['max_queue_depth'])
+
+    # Shards expected from the "i/N" labels that produced no report
+    missing_shards = []
+    counts = {int(shard['shard'].split('/')[1]) for shard in shards if shard['shard']}
+    if len(counts) == 1:
+        shard_count = counts.pop()
+        reported = {int(shard['shard'].split('/')[0]) for shard in shards if shard['shard']}
+        missing_shards = [f"{index}/{shard_count}" for index in range(shard_count) if index not in reported]
+
+    first = reports[0]
+    return {
+        'started_at': min(report['started_at'] for report in reports),
+        'duration_seconds': max(report['duration_seconds'] for report in reports),
+        'mode': first['mode'],
+        'engine': first.get('engine'),
+        'workers': first['workers'],
+        'course_workers': first['course_workers'],
+        'write_workers': first.get('write_workers'),
+        'shards': shards,
+        'missing_shards': missing_shards,
+        'stats': stats,
+        'errors': errors,
+        'parse_cache': parse_cache,
+        'rate_limits': rate_limits,
+        'phases': phases,
+        'slowest_users': sorted(
+            (user for report in reports for user in report['slowest_users']),
+            key=lambda user: user['seconds'], reverse=True
+        )[:slowest],
+        'slowest_courses': sorted(
+            (course for report in reports for course in report['slowest_courses']),
+            key=lambda course: course['seconds'], reverse=True
+        )[:slowest],
+    }
+
+
+def parse_shard(value: str) -> Tuple[int, int]:
+    """argparse type for --shard: 'i/N' with 0 <= i < N"""
+    match = re.fullmatch(r'\s*(\d+)\s*/\s*(\d+)\s*', value or '')
+    if not match:
+        raise argparse.ArgumentTypeError(f"expected i/N, got {value!r}")
+    index, count = int(match.group(1)), int(match.group(2))
+    if count < 1 or index >= count:
+        raise argparse.ArgumentTypeError(f"shard index must be in 0..{count - 1}, got {value!r}")
+    return index, count
+
+
+def shard_rate_limits(shard: Optional[Tuple[int, int]]) -> Dict[str, Tuple[float, int]]:
+    """
+    Host rate limits for one shard. Shards run side by side with their own
+    limiters, so each gets 1/N of every host's rate and burst (at least 1)
+    to keep the run as a whole within RATE_LIMITS. The per-key Gemini limit
+    is not split: each user, and so each key, belongs to a single shard.
+    """
+    if shard is None or shard[1] == 1:
+        return RATE_LIMITS
+    count = shard[1]
+    return {host: (rate / count, max(1, burst // count)) for host, (rate, burst) in RATE_LIMITS.items()}
+
+
+def shard_of(user_id: str, shard_count: int) -> int:
+    """Stable shard of a user id: the same on every runner and every run"""
+    digest = hashlib.sha256(user_id.encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') % shard_count
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Sync Gradescope assignments to Appwrite")
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=int(os.environ.get('SYNC_WORKERS', DEFAULT_SYNC_WORKERS)),
+        help="Number of users to sync concurrently (1 = sequential)"
+    )
+    parser.add_argument(
+        '--course-workers',
+        type=int,
+        default=int(os.environ.get('SYNC_COURSE_WORKERS', DEFAULT_COURSE_WORKERS)),
+        help="Number of courses fetched concurrently per user (1 = sequential)"
+    )
+    parser.add_argument(
+        '--write-workers',
+        type=int,
+        default=int(os.environ.get('SYNC_WRITE_WORKERS', DEFAULT_WRITE_WORKERS)),
+        help="Number of database writes sent concurrently per user (1 = sequential)"
+    )
+    plan_mode = parser.add_mutually_exclusive_group()
+    plan_mode.add_argument(
+        '--plan',
+        metavar='PATH',
+        help="Plan mode: fetch, parse and match as usual, but write the planned changes "
+             "to PATH (JSONL) instead of applying them"
+    )
+    plan_mode.add_argument(
+        '--replay',
+        metavar='PATH',
+        help="Apply a plan file written by --plan instead of syncing"
+    )
+    parser.add_argument(
+        '--full',
+        action='store_true',
+        help="Ignore stored sync state and re-process every course and assignment"
+    )
+    parser.add_argument(
+        '--shard',
+        type=parse_shard,
+        default=parse_shard(os.environ['SYNC_SHARD']) if os.environ.get('SYNC_SHARD') else None,
+        metavar='i/N',
+        help="Only sync users whose id hashes to shard i of N (0-based), e.g. 0/4"
+    )
+    parser.add_argument(
+        '--merge-reports',
+        nargs='+',
+        metavar='REPORT',
+        help=f"Merge per-shard run reports into {RUN_REPORT_PATH}, log the summary and exit"
+    )
+    parser.add_argument(
+        '--engine',
+        choices=['threads', 'asyncio'],
+        default=os.environ.get('SYNC_ENGINE', 'threads'),
+        help="Run on worker threads, or on one asyncio event loop (needs aiohttp); "
+             "the worker options bound users, courses and writes in flight either way"
+    )
+    parser.add_argument(
+        '--backfill-labels',
+        action='store_true',
+        help=f"Scan all users and add the '{GRADESCOPE_USER_LABEL}' label to connected users before syncing"
+    )
+    return parser.parse_args(argv)
+
 
 def main():
+    args = parse_args()
+
+    if args.merge_reports:
+        reports = []
+        for path in args.merge_reports:
+            try:
+                with open(path) as f:
+                    reports.append(json.load(f))
+            except Exception as e:
+                logger.error(f"Could not read run report {path}: {e}")
+        if not reports:
+            logger.error("No run reports to merge")
+            sys.exit(1)
+        merged = merge_run_reports(reports)
+        os.makedirs(os.path.dirname(RUN_REPORT_PATH), exist_ok=True)
+        with open(RUN_REPORT_PATH, 'w') as f:
+            json.dump(merged, f, indent=2)
+        log_run_summary(merged)
+        return
+
     # Verify required environment variables
     required_vars = [
         'APPWRITE_ENDPOINT',
@@ -856,11 +4531,28 @@ def main():
         logger.error(f"Missing required environment variables: {', '.join(missing_vars)}")
         sys.exit(1)
 
+    if args.engine == 'asyncio' and aiohttp is None:
+        logger.error("The asyncio engine needs aiohttp: pip install aiohttp")
+        sys.exit(1)
+
     # Create logs directory if it doesn't exist
     os.makedirs('logs', exist_ok=True)
 
     # Run the sync
-    syncer = GradescopeSyncer()
+    syncer_class = AsyncGradescopeSyncer if args.engine == 'asyncio' else GradescopeSyncer
+    syncer = syncer_class(
+        workers=args.workers,
+        course_workers=args.course_workers,
+        incremental=not args.full,
+        write_workers=args.write_workers,
+        plan_path=args.plan,
+        shard=args.shard
+    )
+    if args.replay:
+        syncer.replay(args.replay)
+        return
+    if args.backfill_labels and not args.plan:
+        syncer.backfill_connected_labels()
     syncer.run()
 
 
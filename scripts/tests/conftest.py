@@ -0,0 +1,83 @@
+import base64
+import os
+import shutil
+import sys
+import tempfile
+
+import pytest
+
+SCRIPTS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SCRIPTS_DIR)
+# The benchmark's stand-ins (StubServer, fake Appwrite services) double as test fakes
+sys.path.insert(0, os.path.join(SCRIPTS_DIR, 'benchmarks'))
+
+# sync_gradescope logs to logs/ under the working directory at import time;
+# keep that (and any cache files) out of the source tree
+os.chdir(tempfile.mkdtemp(prefix='sync-tests-'))
+os.makedirs('logs', exist_ok=True)
+
+
+class OfflineSync:
+    """
+    A population served by the benchmark's stand-ins: Gradescope by a local
+    StubServer, Appwrite by in-memory fakes. `syncer` builds a syncer
+    wired to them; state and caches live in the test's own directory.
+    """
+
+    def __init__(self, population, stub, key: bytes):
+        self.population = population
+        self.stub = stub
+        self.key = key
+        self.reset_appwrite()
+
+    def reset_appwrite(self):
+        """Start over from freshly seeded Appwrite services and no local state"""
+        import sync_gradescope
+        from fakes import FakeDatabases, FakeUsers
+
+        self.databases, self.users = FakeDatabases(), FakeUsers()
+        self.population.seed(
+            self.databases, self.users, self.key,
+            sync_gradescope.ASSIGNMENTS_COLLECTION, sync_gradescope.COURSES_COLLECTION,
+            with_gemini_key=False
+        )
+        shutil.rmtree('cache', ignore_errors=True)
+
+    def syncer(self, **kwargs):
+        import sync_gradescope
+        syncer = sync_gradescope.GradescopeSyncer(
+            workers=1, databases=self.databases, users_service=self.users, **kwargs
+        )
+        syncer.rate_limiter.enabled = False
+        return syncer
+
+    def run(self, **kwargs):
+        """One sync run from fresh call counts; returns the syncer"""
+        self.databases.reset()
+        self.users.reset()
+        self.stub.requests.reset()
+        syncer = self.syncer(**kwargs)
+        syncer.run()
+        return syncer
+
+
+@pytest.fixture
+def offline_sync(monkeypatch, tmp_path):
+    import sync_gradescope
+    from fakes import Population, StubServer
+
+    population = Population(users=2, courses=2, assignments=3, manual=1)
+    stub = StubServer(population)
+    stub.start()
+
+    monkeypatch.chdir(tmp_path)
+    os.makedirs('logs', exist_ok=True)
+    key = os.urandom(32)
+    monkeypatch.setenv('APPWRITE_ENDPOINT', stub.base_url + '/v1')
+    monkeypatch.setenv('APPWRITE_PROJECT_ID', 'test')
+    monkeypatch.setenv('APPWRITE_API_KEY', 'test')
+    monkeypatch.setenv('GRADESCOPE_ENCRYPTION_KEY', base64.b64encode(key).decode('ascii'))
+    monkeypatch.setattr(sync_gradescope, 'GRADESCOPE_BASE_URL', stub.base_url)
+
+    yield OfflineSync(population, stub, key)
+    stub.stop()
@@ -0,0 +1,54 @@
+"""Resolving Gradescope courses to internal courses, with remembered links"""
+
+from sync_gradescope import CourseResolver, InternalCourse
+
+
+def course(course_id: str, code: str, name: str) -> InternalCourse:
+    return InternalCourse.from_document({'$id': course_id, 'code': code, 'name': name})
+
+
+def test_exact_code_beats_exact_name():
+    resolver = CourseResolver([
+        course('by-name', 'MATH 200', 'Computer Programming I'),
+        course('by-code', 'CSE 142', 'Intro'),
+    ])
+    assert resolver.resolve('1', 'Computer Programming I', 'CSE 142') == 'by-code'
+    assert resolver.links == {'1': 'by-code'}
+
+
+def test_cached_link_reused_while_it_matches():
+    # A containment match is kept even if another course would tie on it
+    resolver = CourseResolver(
+        [course('a', 'CSE 142 A', 'Section A'), course('b', 'CSE 142 B', 'Section B')],
+        cached_links={'1': 'b'}
+    )
+    assert resolver.resolve('1', 'Computer Programming I', 'CSE 142') == 'b'
+
+
+def test_cached_link_dropped_after_rename():
+    resolver = CourseResolver(
+        [course('old', 'PHYS 121', 'Mechanics'), course('new', 'CSE 142', 'Programming')],
+        cached_links={'1': 'old'}
+    )
+    assert resolver.resolve('1', 'Computer Programming I', 'CSE 142') == 'new'
+    assert resolver.links == {'1': 'new'}
+
+
+def test_cached_link_dropped_for_a_better_exact_match():
+    # Linked by containment, then an exactly matching course is created
+    resolver = CourseResolver(
+        [course('partial', 'CSE 142 AB', 'Programming'), course('exact', 'CSE 142', 'Programming')],
+        cached_links={'1': 'partial'}
+    )
+    assert resolver.resolve('1', 'Computer Programming I', 'CSE 142') == 'exact'
+
+
+def test_cached_link_to_deleted_course_is_dropped():
+    resolver = CourseResolver([course('a', 'CSE 142', 'Programming')], cached_links={'1': 'gone'})
+    assert resolver.resolve('1', 'Programming', 'CSE 142') == 'a'
+
+
+def test_no_match():
+    resolver = CourseResolver([course('a', 'CSE 142', 'Programming')], cached_links={'1': 'a'})
+    assert resolver.resolve('1', 'Art History', 'ARTH 201') == ''
+    assert resolver.links == {}
@@ -0,0 +1,125 @@
+"""Batched Gemini parsing: packing pages into requests and reading the responses"""
+
+import json
+import logging
+
+import pytest
+
+import sync_gradescope
+from sync_gradescope import CourseFetch, GradescopeClient, GradescopeSyncer, HttpPool
+
+
+def test_api_key_is_sent_in_a_header_not_the_url(monkeypatch, caplog):
+    # Nothing listens on port 9: the request fails and its error is logged
+    monkeypatch.setattr(sync_gradescope, 'GEMINI_API_BASE', 'http://127.0.0.1:9')
+    client = GradescopeClient('test-session-token', http_pool=HttpPool(max_retries=0))
+    assert 'secret-gemini-key' not in client.gemini_url()
+    assert client.gemini_headers('secret-gemini-key')['x-goog-api-key'] == 'secret-gemini-key'
+
+    with caplog.at_level(logging.ERROR, logger=sync_gradescope.logger.name):
+        assert client.request_ai_batch({'1': 'page'}, 'secret-gemini-key', 'prompt') == {}
+    assert 'AI Parse Error' in caplog.text
+    assert 'secret-gemini-key' not in caplog.text
+
+
+class GeminiResponse:
+    """A generateContent response as read by read_ai_batch"""
+
+    def __init__(self, text: str, status_code: int = 200):
+        self.status_code = status_code
+        self.text = text
+
+    def json(self):
+        return json.loads(self.text)
+
+
+def batch_response(courses) -> GeminiResponse:
+    """A 200 response whose candidate text is the batch JSON for `courses`"""
+    return candidate_response(json.dumps({'courses': courses}))
+
+
+def candidate_response(text: str) -> GeminiResponse:
+    return GeminiResponse(json.dumps({'candidates': [{'content': {'parts': [{'text': text}]}}]}))
+
+
+ASSIGNMENT = {'title': 'Homework 1', 'due_date': '2024-01-20T23:59:00-08:00', 'status': 'Submitted'}
+
+
+def test_batches_hold_at_most_the_course_limit_in_order(monkeypatch):
+    monkeypatch.setattr(sync_gradescope, 'GEMINI_BATCH_MAX_COURSES', 3)
+    pages = {str(course_id): 'page' for course_id in range(7)}
+    batches = GradescopeClient.pack_ai_batches(pages)
+    assert [list(batch) for batch in batches] == [['0', '1', '2'], ['3', '4', '5'], ['6']]
+
+
+def test_batches_stay_within_the_input_size(monkeypatch):
+    monkeypatch.setattr(sync_gradescope, 'GEMINI_MAX_INPUT_CHARS', 100)
+    pages = {'1': 'a' * 40, '2': 'b' * 40, '3': 'c' * 40, '4': 'd' * 150, '5': 'e' * 10}
+    batches = GradescopeClient.pack_ai_batches(pages)
+    # A page over the limit on its own still gets a request, alone
+    assert [list(batch) for batch in batches] == [['1', '2'], ['3'], ['4'], ['5']]
+    assert all(sum(map(len, batch.values())) <= 100 for batch in batches if len(batch) > 1)
+
+
+def test_no_pages_no_batches():
+    assert GradescopeClient.pack_ai_batches({}) == []
+
+
+def test_batch_results_are_mapped_back_by_course_id():
+    client = GradescopeClient('test-session-token')
+    pages = {'101': 'page one', '102': 'page two', '103': 'page three'}
+    response = batch_response([
+        # Out of order, numeric ids, a course not asked for and one missing
+        {'course_id': 102, 'assignments': [dict(ASSIGNMENT, title='Lab 2')]},
+        {'course_id': '101', 'assignments': [ASSIGNMENT]},
+        {'course_id': '999', 'assignments': [ASSIGNMENT]},
+    ])
+    parsed = client.read_ai_batch(pages, response)
+    assert parsed == {'101': [ASSIGNMENT], '102': [dict(ASSIGNMENT, title='Lab 2')]}
+
+
+def test_course_without_an_assignment_list_is_left_out():
+    client = GradescopeClient('test-session-token')
+    response = batch_response([{'course_id': '101', 'assignments': None}, {'course_id': '102', 'assignments': []}])
+    assert client.read_ai_batch({'101': 'page', '102': 'page'}, response) == {'102': []}
+
+
+@pytest.mark.parametrize('response', [
+    GeminiResponse('{"error": {"message": "quota"}}', status_code=429),
+    GeminiResponse(json.dumps({'candidates': []})),
+    GeminiResponse('{"candidates": [{"content": {"parts": [{"te'),
+    candidate_response('{"courses": [{"course_id": "101", "assignments": [{"title": "Home'),
+    candidate_response('not json at all'),
+], ids=['error-status', 'no-candidates', 'truncated-envelope', 'truncated-batch', 'not-json'])
+def test_unreadable_batch_response_parses_nothing(response):
+    client = GradescopeClient('test-session-token')
+    assert client.read_ai_batch({'101': 'page', '102': 'page'}, response) == {}
+
+
+def test_failed_batch_falls_back_per_course(monkeypatch):
+    monkeypatch.setattr(sync_gradescope, 'GEMINI_BATCH_MAX_COURSES', 2)
+    client = GradescopeClient('test-session-token')
+    responses = iter([
+        batch_response([{'course_id': '101', 'assignments': [ASSIGNMENT]}, {'course_id': '102', 'assignments': []}]),
+        candidate_response('{"courses": [{"course_id": "103", "assi'),
+    ])
+    monkeypatch.setattr(
+        client, 'request_ai_batch',
+        lambda pages, api_key, course_prompt: client.read_ai_batch(pages, next(responses))
+    )
+    pages = {
+        '101': '<html>one</html>',
+        '102': '<html>two</html>',
+        '103': '<html>three</html>',
+        # Not HTML: the JSON fallback can still read it
+        '104': json.dumps({'assignments': [ASSIGNMENT]}),
+    }
+    parsed = client.parse_pages_with_ai(pages, 'gemini-key')
+    # The truncated second batch parses neither of its courses
+    assert parsed == {'101': [ASSIGNMENT], '102': [], '103': None, '104': None}
+
+    pending = {course_id: CourseFetch(assignments=[], pending_page=page) for course_id, page in pages.items()}
+    GradescopeSyncer.complete_pending_pages(client, pending, parsed, 'gemini-key')
+    assert [pending[course_id].failed for course_id in pages] == [False, False, True, False]
+    assert pending['104'].assignments == [ASSIGNMENT]
+    assert all(result.pending_page is None for result in pending.values())
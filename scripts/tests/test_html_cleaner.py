@@ -0,0 +1,68 @@
+"""HTMLCleaner: reducing course pages before they are sent to Gemini"""
+
+from sync_gradescope import clean_html
+
+
+def test_whitespace_between_elements_keeps_words_apart():
+    assert clean_html('<span>Due</span> <span>Jan 5</span>') == '<span>Due</span> <span>Jan 5</span>'
+    assert clean_html('<td>Homework 1</td>\n    <td>10.0 / 10.0</td>') == '<td>Homework 1</td> <td>10.0 / 10.0</td>'
+
+
+def test_whitespace_is_collapsed_to_one_space():
+    assert clean_html('<p>  Homework \n\t 1  </p>') == '<p> Homework 1 </p>'
+    # Nothing emitted between the space and the next text: still one space
+    assert clean_html('<p>Due </p>\n  <!-- note -->\n  <p>Jan 5</p>') == '<p>Due </p> <p>Jan 5</p>'
+    assert clean_html('\n\n<div>x</div>') == '<div>x</div>'
+
+
+def test_dropped_elements_take_their_content():
+    page = (
+        '<html><head><title>Course</title><style>td { color: red }</style></head>'
+        '<body><script>var rows = "<tr>";</script>'
+        '<svg viewBox="0 0 24 24"><path d="M9 16"/></svg>'
+        '<table id="assignments-student-table"><tr><td>Homework 1</td></tr></table></body></html>'
+    )
+    assert clean_html(page) == (
+        '<html><body><table id="assignments-student-table"><tr><td>Homework 1</td></tr></table></body></html>'
+    )
+
+
+def test_only_useful_attributes_are_kept():
+    page = (
+        '<a class="link" aria-label="View Homework 1" href="/courses/1/assignments/2" '
+        'data-react-props=\'{"x": 1}\' onclick="go()">Homework 1</a>'
+    )
+    assert clean_html(page) == '<a aria-label="View Homework 1" href="/courses/1/assignments/2">Homework 1</a>'
+
+
+def test_comments_and_doctype_are_dropped():
+    assert clean_html('<!DOCTYPE html><!-- <td>old</td> --><p>kept</p>') == '<p>kept</p>'
+
+
+def test_angle_bracket_inside_a_quoted_attribute_value():
+    page = '<a aria-label="Score > 5" href="/a?b=1&c>2">Homework 1</a><td>Jan 5</td>'
+    assert clean_html(page) == '<a aria-label="Score > 5" href="/a?b=1&c>2">Homework 1</a><td>Jan 5</td>'
+    single = "<time datetime='2024-01-20 23:59' title='a > b'>Jan 20</time>"
+    assert clean_html(single) == '<time datetime="2024-01-20 23:59">Jan 20</time>'
+
+
+def test_stray_quote_falls_back_to_the_first_angle_bracket():
+    assert clean_html('<div data-x=it\'s>Homework 1</div>') == '<div>Homework 1</div>'
+
+
+def test_kept_value_with_a_double_quote_stays_well_formed():
+    assert clean_html('<a aria-label=\'Read "Hamlet"\'>Essay</a>') == '<a aria-label="Read &quot;Hamlet&quot;">Essay</a>'
+
+
+def test_unclosed_dropped_element_drops_the_rest():
+    assert clean_html('<p>kept</p><script>never closed <td>x</td>') == '<p>kept</p>'
+
+
+def test_lone_angle_bracket_is_text():
+    assert clean_html('<p>1 < 2</p>') == '<p>1 < 2</p>'
+
+
+def test_output_stops_at_max_chars():
+    page = '<p>' + 'x' * 100 + '</p>' + '<p>more</p>' * 100
+    cleaned = clean_html(page, max_chars=50)
+    assert cleaned == '<p>' + 'x' * 47
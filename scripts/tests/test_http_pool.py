@@ -0,0 +1,161 @@
+"""Retries, Retry-After and timeouts of the outbound HTTP pools, against the local stub server"""
+
+import asyncio
+import socket
+import time
+
+import pytest
+import requests
+
+from fakes import CallCounter, Population, StubServer
+from sync_gradescope import AsyncHttpPool, HttpPool, JitteredRetry
+
+# Short enough to keep the suite fast, long enough not to flake
+TIMEOUTS = {'127.0.0.1': (0.3, 0.3)}
+
+
+@pytest.fixture(scope='module')
+def server():
+    server = StubServer(Population(users=1, courses=1, assignments=1))
+    server.start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def stub(server):
+    """The shared stub server, with fresh request counts and no faults left over"""
+    server.requests = CallCounter()
+    server.faults.clear()
+    return server
+
+
+def get_account(pool: HttpPool, stub: StubServer) -> requests.Response:
+    session = pool.new_session()
+    session.cookies.set('_gradescope_session', stub.population.session_token('user0'))
+    return session.get(f"{stub.base_url}/account")
+
+
+@pytest.mark.parametrize('status', [429, 500, 502, 503, 504])
+def test_retry_statuses_are_retried_until_success(stub, status):
+    pool = HttpPool(timeouts=TIMEOUTS, backoff_factor=0.01)
+    stub.fail_next(status, count=2)
+    response = get_account(pool, stub)
+    assert response.status_code == 200
+    assert stub.requests.calls['gradescope'] == 3
+
+
+def test_last_retry_response_is_returned_whatever_its_status(stub):
+    pool = HttpPool(timeouts=TIMEOUTS, max_retries=2, backoff_factor=0.01)
+    stub.fail_next(503, count=5)
+    response = get_account(pool, stub)
+    assert response.status_code == 503
+    assert stub.requests.calls['gradescope'] == 3
+
+
+def test_other_errors_are_not_retried(stub):
+    pool = HttpPool(timeouts=TIMEOUTS, backoff_factor=0.01)
+    stub.fail_next(404)
+    assert get_account(pool, stub).status_code == 404
+    assert stub.requests.calls['gradescope'] == 1
+
+
+def test_retry_after_is_waited_for(stub):
+    # No backoff of its own: any wait comes from the server's Retry-After
+    pool = HttpPool(timeouts=TIMEOUTS, backoff_factor=0)
+    stub.fail_next(429, retry_after='1')
+    started = time.perf_counter()
+    assert get_account(pool, stub).status_code == 200
+    assert time.perf_counter() - started >= 1.0
+    assert stub.requests.calls['gradescope'] == 2
+
+
+def test_read_timeout_is_retried(stub):
+    pool = HttpPool(timeouts=TIMEOUTS, backoff_factor=0.01)
+    stub.fail_next(None, delay=1.0)
+    assert get_account(pool, stub).status_code == 200
+    assert stub.requests.calls['gradescope'] == 2
+
+
+def test_read_timeout_after_the_last_retry_raises(stub):
+    pool = HttpPool(timeouts=TIMEOUTS, max_retries=1, backoff_factor=0.01)
+    stub.fail_next(None, count=2, delay=1.0)
+    with pytest.raises(requests.exceptions.ConnectionError):
+        get_account(pool, stub)
+    assert stub.requests.calls['gradescope'] == 2
+
+
+@pytest.fixture
+def unanswered_port():
+    """A port whose accept queue is full, so new connections never complete"""
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(0)
+    port = listener.getsockname()[1]
+    fillers = []
+    for _ in range(3):
+        filler = socket.socket()
+        filler.setblocking(False)
+        try:
+            filler.connect(('127.0.0.1', port))
+        except BlockingIOError:
+            pass
+        fillers.append(filler)
+    yield port
+    for sock in fillers + [listener]:
+        sock.close()
+
+
+def test_connect_timeout_comes_from_the_host_timeouts(unanswered_port):
+    pool = HttpPool(timeouts=TIMEOUTS, max_retries=0)
+    started = time.perf_counter()
+    with pytest.raises(requests.exceptions.ConnectTimeout):
+        pool.new_session().get(f"http://127.0.0.1:{unanswered_port}/")
+    assert time.perf_counter() - started < 5
+
+
+def test_jittered_backoff_stays_under_the_exponential_cap():
+    retry = JitteredRetry(total=10, backoff_factor=1.0, backoff_max=120)
+    for _ in range(3):
+        retry = retry.increment(method='GET', url='/')
+    # urllib3 backs off factor * 2 ** (retries - 1) seconds: 4s after the third
+    waits = [retry.get_backoff_time() for _ in range(200)]
+    assert all(0 <= wait <= 4 for wait in waits)
+    assert len(set(waits)) > 1
+
+
+def test_async_pool_retries_and_honours_retry_after(stub):
+    async def fetch():
+        pool = AsyncHttpPool(timeouts=TIMEOUTS, backoff_factor=0.01)
+        try:
+            session = pool.new_session()
+            try:
+                session.cookie_jar.update_cookies({'_gradescope_session': stub.population.session_token('user0')})
+                started = time.perf_counter()
+                response = await pool.request(session, 'GET', f"{stub.base_url}/account")
+                return response, time.perf_counter() - started
+            finally:
+                await session.close()
+        finally:
+            await pool.close()
+
+    stub.fail_next(503)
+    stub.fail_next(429, retry_after='1')
+    response, elapsed = asyncio.run(fetch())
+    assert response.status_code == 200
+    assert elapsed >= 1.0
+    assert stub.requests.calls['gradescope'] == 3
+
+
+def test_async_backoff_caps_retry_after():
+    async def backoffs():
+        pool = AsyncHttpPool(backoff_factor=0.5)
+        try:
+            return pool.backoff(0, '3'), pool.backoff(0, '86400'), pool.backoff(2, 'soon')
+        finally:
+            await pool.close()
+
+    given, capped, unreadable = asyncio.run(backoffs())
+    assert given == 3.0
+    assert capped == 120
+    assert 0 <= unreadable <= 2.0
@@ -0,0 +1,100 @@
+"""Incremental syncs: SyncStateStore and skipping what the last sync applied"""
+
+from sync_gradescope import ASSIGNMENTS_COLLECTION, COURSES_COLLECTION, CourseState, SyncStateStore
+
+# 2 users x 2 courses x 3 assignments (see the offline_sync fixture)
+COURSES = 4
+ASSIGNMENTS = 12
+
+
+def state(**kwargs) -> CourseState:
+    return CourseState(**{'fingerprint': 'page', 'assignments': [], 'processed': [], 'checked_at': 0.0, **kwargs})
+
+
+def test_state_is_only_trusted_with_the_last_sync_it_was_saved_with(tmp_path):
+    store = SyncStateStore(str(tmp_path / 'sync_state.db'))
+    store.save_user('user1', '2024-01-01T00:00:00Z', {'101': state(processed=['a', 'b'])})
+
+    assert store.load_user('user1', '2024-01-01T00:00:00Z') == {'101': state(processed=['a', 'b'])}
+    # Synced since from elsewhere, never synced, or an unknown user: full sync
+    assert store.load_user('user1', '2024-02-01T00:00:00Z') == {}
+    assert store.load_user('user1', None) == {}
+    assert store.load_user('user2', '2024-01-01T00:00:00Z') == {}
+
+
+def test_saving_replaces_the_users_course_states(tmp_path):
+    store = SyncStateStore(str(tmp_path / 'sync_state.db'))
+    store.save_user('user1', 'first', {'101': state(), '102': state()})
+    store.save_user('user1', 'second', {'102': state(fingerprint='new page')})
+    assert store.load_user('user1', 'second') == {'102': state(fingerprint='new page')}
+
+
+def test_state_survives_reopening(tmp_path):
+    path = str(tmp_path / 'sync_state.db')
+    store = SyncStateStore(path)
+    store.save_user('user1', 'last', {'101': state(etag='"v1"')})
+    store.save_links('user1', {'101': 'internal-1'})
+    store.close()
+
+    store = SyncStateStore(path)
+    assert store.load_user('user1', 'last')['101'].etag == '"v1"'
+    assert store.load_links('user1') == {'101': 'internal-1'}
+
+
+def test_unchanged_pages_are_skipped(offline_sync):
+    first = offline_sync.run()
+    assert first.stats['assignments_unchanged'] == 0
+    assert first.stats['writes_sent'] > 0
+
+    second = offline_sync.run()
+    assert second.stats['courses_unchanged'] == COURSES
+    assert second.stats['assignments_unchanged'] == ASSIGNMENTS
+    assert second.stats['assignments_synced'] == 0
+    assert second.stats['writes_sent'] == 0
+    assert 'create_document' not in offline_sync.databases.calls
+    assert 'update_document' not in offline_sync.databases.calls
+
+
+def test_changed_assignment_is_resynced(offline_sync, monkeypatch):
+    offline_sync.run()
+
+    population = offline_sync.population
+    assignments_for = population.assignments_for
+    # Linked to an internal course, so its grades are written
+    changed_course = population.courses_for(0)[0]['id']
+
+    def regraded(course_id):
+        assignments = assignments_for(course_id)
+        if course_id == changed_course:
+            assignments[0]['score'] = 10.0
+        return assignments
+
+    monkeypatch.setattr(population, 'assignments_for', regraded)
+    second = offline_sync.run()
+    # Only the regraded assignment; its course's other assignments are still skipped
+    assert second.stats['courses_unchanged'] == COURSES - 1
+    assert second.stats['assignments_unchanged'] == ASSIGNMENTS - 1
+    # The new grade is written to the internal course
+    assert offline_sync.databases.calls.get('update_document') == 1
+    assert second.stats['assignments_synced'] == 0
+
+    third = offline_sync.run()
+    assert third.stats['assignments_unchanged'] == ASSIGNMENTS
+    assert 'update_document' not in offline_sync.databases.calls
+
+
+def test_full_sync_bypasses_the_state(offline_sync):
+    offline_sync.run()
+
+    full = offline_sync.run(incremental=False)
+    assert full.mode == 'full'
+    assert full.stats['courses_unchanged'] == 0
+    assert full.stats['assignments_unchanged'] == 0
+    assert full.stats['assignments_synced'] == 0
+    # Every document is read in full rather than through the snapshots
+    collections = offline_sync.databases.collections
+    assert full.stats['documents_read'] == len(collections[ASSIGNMENTS_COLLECTION]) + len(collections[COURSES_COLLECTION])
+
+    # It still refreshes the state for the next incremental run
+    after = offline_sync.run()
+    assert after.stats['assignments_unchanged'] == ASSIGNMENTS
@@ -0,0 +1,96 @@
+"""ParseCache: Gemini parses kept between runs, with a TTL and LRU eviction"""
+
+import time
+
+import pytest
+
+import sync_gradescope
+from sync_gradescope import ParseCache
+
+ASSIGNMENTS = [{'title': 'Homework 1', 'due_date': '2024-01-20T23:59:00-08:00'}]
+# A quarter of a second, in days
+SHORT_TTL_DAYS = 0.25 / (24 * 60 * 60)
+
+
+@pytest.fixture
+def cache_path(tmp_path):
+    return str(tmp_path / 'cache' / 'parse_cache.sqlite')
+
+
+def keys(cache: ParseCache) -> set:
+    return {row[0] for row in cache._conn.execute("SELECT key FROM parse_cache")}
+
+
+def test_hit_and_miss_are_counted(cache_path):
+    cache = ParseCache(cache_path)
+    assert cache.get('page-a') is None
+    cache.put('page-a', ASSIGNMENTS)
+    assert cache.get('page-a') == ASSIGNMENTS
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_entries_persist_between_runs(cache_path):
+    cache = ParseCache(cache_path)
+    cache.put('page-a', ASSIGNMENTS)
+    cache.close()
+    assert ParseCache(cache_path).get('page-a') == ASSIGNMENTS
+
+
+def test_expired_entry_is_a_miss(cache_path):
+    cache = ParseCache(cache_path, ttl_days=SHORT_TTL_DAYS)
+    cache.put('page-a', ASSIGNMENTS)
+    assert cache.get('page-a') == ASSIGNMENTS
+    time.sleep(0.3)
+    assert cache.get('page-a') is None
+    assert cache.misses == 1
+
+
+def test_use_does_not_extend_the_ttl(cache_path):
+    # Parses are refreshed at least every TTL even for pages read every run
+    cache = ParseCache(cache_path, ttl_days=SHORT_TTL_DAYS)
+    cache.put('page-a', ASSIGNMENTS)
+    for _ in range(3):
+        time.sleep(0.1)
+        cache.get('page-a')
+    assert cache.get('page-a') is None
+
+
+def test_prune_drops_expired_entries(cache_path):
+    cache = ParseCache(cache_path, ttl_days=SHORT_TTL_DAYS)
+    cache.put('page-a', ASSIGNMENTS)
+    time.sleep(0.3)
+    cache.put('page-b', ASSIGNMENTS)
+    cache.prune()
+    assert keys(cache) == {'page-b'}
+
+
+def test_prune_evicts_the_least_recently_used_beyond_max_entries(cache_path):
+    cache = ParseCache(cache_path, max_entries=2)
+    for key in ('page-a', 'page-b', 'page-c'):
+        cache.put(key, ASSIGNMENTS)
+        time.sleep(0.01)
+    # Reading page-a makes page-b the least recently used
+    assert cache.get('page-a') == ASSIGNMENTS
+    cache.prune()
+    assert keys(cache) == {'page-a', 'page-c'}
+
+
+def test_close_prunes(cache_path):
+    cache = ParseCache(cache_path, max_entries=1)
+    cache.put('page-a', ASSIGNMENTS)
+    time.sleep(0.01)
+    cache.put('page-b', ASSIGNMENTS)
+    cache.close()
+    reopened = ParseCache(cache_path)
+    assert keys(reopened) == {'page-b'}
+
+
+def test_key_depends_on_prompt_version_and_content(monkeypatch):
+    key = ParseCache.make_key('prompt', 'page')
+    assert key == ParseCache.make_key('prompt', 'page')
+    assert key != ParseCache.make_key('prompt', 'page 2')
+    assert key != ParseCache.make_key('prompt 2', 'page')
+    # The separator keeps prompt and content from running into each other
+    assert ParseCache.make_key('ab', 'c') != ParseCache.make_key('a', 'bc')
+    monkeypatch.setattr(sync_gradescope, 'GEMINI_PROMPT_VERSION', sync_gradescope.GEMINI_PROMPT_VERSION + 1)
+    assert key != ParseCache.make_key('prompt', 'page')
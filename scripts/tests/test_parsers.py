@@ -0,0 +1,129 @@
+"""Parsers for saved Gradescope pages (tests/fixtures)"""
+
+import os
+
+import pytest
+
+from sync_gradescope import AccountCoursesParser, CourseDashboardParser, GradescopeClient
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+def load_fixture(name: str) -> str:
+    with open(os.path.join(FIXTURES_DIR, name), encoding='utf-8') as f:
+        return f.read()
+
+
+@pytest.fixture(scope='module')
+def client():
+    return GradescopeClient('test-session-token')
+
+
+@pytest.fixture(scope='module')
+def course_assignments(client):
+    assignments = client.parse_html(load_fixture('course_page.html'))
+    assert assignments is not None
+    return {assignment['id']: assignment for assignment in assignments}
+
+
+def test_course_page_rows(course_assignments):
+    # The header row and the closed, unlinked row are not assignments
+    assert list(course_assignments) == ['2000001', '2000002', '2000003', '2000005']
+
+
+def test_graded_row(course_assignments):
+    assert course_assignments['2000001'] == {
+        'id': '2000001',
+        'title': 'Homework 1: Static Methods',
+        'due_date': '2024-01-20T23:59:00-08:00',
+        'score': 9.5,
+        'total_points': 10.0,
+        'status': 'Graded',
+    }
+
+
+def test_unsubmitted_button_row(course_assignments):
+    assignment = course_assignments['2000002']
+    assert assignment['title'] == 'Homework 2: Loops & Conditionals'
+    assert assignment['status'] == 'No Submission'
+    assert assignment['score'] is None
+    assert assignment['total_points'] is None
+
+
+def test_late_due_date_keeps_regular_due_date(course_assignments):
+    assignment = course_assignments['2000003']
+    assert assignment['due_date'] == '2024-02-03T23:59:00-08:00'
+    assert assignment['status'] == 'Submitted'
+
+
+def test_zero_point_score(course_assignments):
+    assignment = course_assignments['2000005']
+    assert (assignment['score'], assignment['total_points']) == (1.0, 0.0)
+
+
+def test_unlinked_row_is_skipped(course_assignments):
+    assert all('Quiz 0' not in assignment['title'] for assignment in course_assignments.values())
+
+
+def test_page_without_table(client):
+    assert client.parse_html(load_fixture('course_page_no_table.html')) is None
+
+
+def test_unreadable_due_date_fails_the_parse(client):
+    page = load_fixture('course_page.html').replace('2024-01-20 23:59:00 -0800', 'next Friday')
+    assert client.parse_html(page) is None
+
+
+class SavedResponse:
+    """A course page response as read by read_course_page"""
+
+    def __init__(self, text: str):
+        self.status_code = 200
+        self.headers = {}
+        self.text = text
+
+
+def test_course_page_needing_gemini_is_left_pending(client):
+    page = load_fixture('course_page_no_table.html')
+    result = client.read_course_page('123456', SavedResponse(page), 'gemini-key', None)
+    assert result.pending_page == page
+    assert not result.failed
+
+
+def test_course_page_without_table_or_gemini_key_fails(client):
+    result = client.read_course_page('123456', SavedResponse(load_fixture('course_page_no_table.html')), None, None)
+    assert result.failed
+    assert result.pending_page is None
+
+
+def test_row_with_id_but_no_title_fails_the_parse():
+    parser = CourseDashboardParser()
+    parser.feed(
+        '<table id="assignments-student-table"><tr>'
+        '<td><a href="/courses/1/assignments/2/submissions">Homework</a></td>'
+        '</tr></table>'
+    )
+    parser.close()
+    assert parser.found_table
+    assert parser.malformed
+
+
+def test_account_page_courses(client):
+    courses = client.parse_account_courses(load_fixture('account_page.html'))
+    assert courses == [
+        {'id': 123456, 'term': 'Winter 2024', 'shortname': 'CSE 142', 'name': 'Computer Programming I'},
+        {'id': 123457, 'term': 'Winter 2024', 'shortname': 'MATH 126',
+         'name': 'Calculus with Analytic Geometry III'},
+        {'id': 98765, 'term': 'Fall 2023', 'shortname': 'CSE 121',
+         'name': 'Introduction to Computer Programming I'},
+        # No name on the box: the short name stands in
+        {'id': 98766, 'term': 'Fall 2023', 'shortname': 'ENGL 131', 'name': 'ENGL 131'},
+    ]
+
+
+def test_account_page_skips_add_course_box():
+    parser = AccountCoursesParser()
+    parser.feed(load_fixture('account_page.html'))
+    parser.close()
+    assert all('Add a course' not in course['shortname'] for course in parser.courses)
+    assert len(parser.courses) == 4
@@ -0,0 +1,151 @@
+"""Plan mode (--plan) and replaying saved plans (--replay)"""
+
+import json
+import os
+
+from sync_gradescope import UserPlan, WritePlan, plan_states_path
+
+# 2 users x 2 courses x 3 assignments (see the offline_sync fixture)
+ASSIGNMENTS = 12
+
+
+def test_plan_mode_counts_writes_as_planned(offline_sync):
+    planner = offline_sync.run(plan_path='plan.jsonl')
+    stats = planner.stats
+    assert stats['planned_writes'] == stats['planned_assignments'] + stats['planned_conflicts'] > 0
+    assert stats['assignments_synced'] == stats['conflicts_created'] == stats['writes_sent'] == 0
+    assert 'create_document' not in offline_sync.databases.calls
+
+
+def test_course_states_are_kept_out_of_plan_lines(offline_sync):
+    offline_sync.run(plan_path='plan.jsonl')
+    with open('plan.jsonl') as f:
+        lines = [json.loads(line) for line in f]
+    assert len(lines) == 2
+    assert all('states' not in line for line in lines)
+    assert os.path.exists(plan_states_path('plan.jsonl'))
+
+
+def test_replay_records_the_planned_course_states(offline_sync):
+    offline_sync.run(plan_path='plan.jsonl')
+    offline_sync.syncer().replay('plan.jsonl')
+
+    after = offline_sync.run()
+    assert after.stats['assignments_unchanged'] == ASSIGNMENTS
+    assert after.stats['writes_sent'] == 0
+
+
+def test_replay_without_the_states_file_reprocesses_next_time(offline_sync):
+    offline_sync.run(plan_path='plan.jsonl')
+    os.remove(plan_states_path('plan.jsonl'))
+    replayer = offline_sync.syncer()
+    replayer.replay('plan.jsonl')
+    assert replayer.stats['users_processed'] == 2
+
+    after = offline_sync.run()
+    assert after.stats['assignments_unchanged'] == 0
+
+
+def planned_writes() -> WritePlan:
+    plan = WritePlan()
+    # The same Gradescope assignment listed twice: one create, both dependents
+    plan.create(('assignment', 'gs1'), 'assignment', {'title': 'Homework 1'}, ['read("user:u1")'],
+                ('101', 'fp-a'), stat='assignments_synced', naive_writes=2)
+    plan.create(('assignment', 'gs1'), 'assignment', {'courseId': 'course-1'}, ['read("user:u1")'],
+                ('102', 'fp-b'), stat='assignments_synced', naive_writes=2)
+    # Two changes to one document: one update carrying both fields
+    plan.update('assignment', 'doc1', {'deadline': '2024-01-20T23:59:00-08:00'}, ('101', 'fp-c'))
+    plan.update('assignment', 'doc1', {'courseId': 'course-1'}, ('101', 'fp-d'))
+    plan.create(('conflict', 'doc2', 'gs3'), 'conflicts', {'status': 'pending'}, [], ('101', 'fp-e'),
+                stat='conflicts_created')
+    return plan
+
+
+def test_write_plan_merges_repeated_writes():
+    plan = planned_writes()
+    assert len(plan) == 3
+    assert plan.naive_writes == 2 + 2 + 1 + 1 + 1
+    create, update, conflict = plan.writes.values()
+    assert create.data == {'title': 'Homework 1', 'courseId': 'course-1'}
+    assert create.dependents == [('101', 'fp-a'), ('102', 'fp-b')]
+    assert update.document_id == 'doc1'
+    assert update.data == {'deadline': '2024-01-20T23:59:00-08:00', 'courseId': 'course-1'}
+    assert update.dependents == [('101', 'fp-c'), ('101', 'fp-d')]
+    assert conflict.stat == 'conflicts_created'
+
+
+def test_user_plan_survives_a_plan_file_round_trip():
+    user_plan = UserPlan(
+        user_id='u1',
+        last_sync='2024-01-01T00:00:00Z',
+        writes=planned_writes(),
+        grades={'course-1': {'Homework 1': (9.5, 10.0)}},
+        grade_courses={'course-1': ['101', '102']},
+        course_links={'101': 'course-1'},
+        known_courses={'course-1': {'$id': 'course-1'}},
+    )
+    line = json.dumps(user_plan.to_json(), separators=(',', ':'))
+    restored = UserPlan.from_json(json.loads(line))
+
+    assert list(restored.writes.writes.values()) == list(user_plan.writes.writes.values())
+    assert [write.dependents for write in restored.writes.writes.values()] == [
+        [('101', 'fp-a'), ('102', 'fp-b')],
+        [('101', 'fp-c'), ('101', 'fp-d')],
+        [('101', 'fp-e')],
+    ]
+    assert restored.writes.naive_writes == user_plan.writes.naive_writes
+    assert len(restored.writes) == len(user_plan.writes)
+    # Grades come back as (score, total) tuples, as merge_course_grades expects
+    assert restored.grades == {'course-1': {'Homework 1': (9.5, 10.0)}}
+    assert (restored.user_id, restored.last_sync) == ('u1', '2024-01-01T00:00:00Z')
+    assert restored.grade_courses == user_plan.grade_courses
+    assert restored.course_links == user_plan.course_links
+    # Read again from Appwrite when the plan is applied
+    assert restored.known_courses == {}
+
+
+def test_plan_without_writes_round_trips():
+    restored = UserPlan.from_json(json.loads(json.dumps(UserPlan(user_id='u1').to_json())))
+    assert len(restored.writes) == 0
+    assert restored.writes.naive_writes == 0
+
+
+def appwrite_contents(offline_sync) -> dict:
+    """Every document's fields, minus Appwrite's own and generated ids, per collection"""
+    def fields(document):
+        fields = {key: value for key, value in document.items() if not key.startswith('$')}
+        if fields.get('gradedItems'):
+            fields['gradedItems'] = [
+                {key: value for key, value in item.items() if key != 'id'}
+                for item in json.loads(fields['gradedItems'])
+            ]
+        return json.dumps(fields, sort_keys=True)
+
+    return {
+        collection_id: sorted(fields(document) for document in documents.values())
+        for collection_id, documents in offline_sync.databases.collections.items()
+    }
+
+
+def write_calls(offline_sync) -> dict:
+    """Appwrite calls other than the reads made while planning"""
+    calls = {f"databases.{method}": count for method, count in offline_sync.databases.calls.items()}
+    calls.update({f"users.{method}": count for method, count in offline_sync.users.calls.items()})
+    for read in ('databases.list_documents', 'users.list', 'users.get_prefs'):
+        calls.pop(read, None)
+    return calls
+
+
+def test_replay_makes_the_same_appwrite_calls_as_a_direct_run(offline_sync):
+    offline_sync.run()
+    direct_calls, direct_contents = write_calls(offline_sync), appwrite_contents(offline_sync)
+    assert direct_calls['databases.create_document'] > 0
+
+    offline_sync.reset_appwrite()
+    offline_sync.run(plan_path='plan.jsonl')
+    offline_sync.databases.reset()
+    offline_sync.users.reset()
+    offline_sync.syncer().replay('plan.jsonl')
+
+    assert write_calls(offline_sync) == direct_calls
+    assert appwrite_contents(offline_sync) == direct_contents
@@ -0,0 +1,179 @@
+"""Token buckets and round-robin admission (RateLimiter, AsyncRateLimiter) on a controlled clock"""
+
+import asyncio
+import threading
+import time
+
+import pytest
+
+from sync_gradescope import AsyncRateLimiter, RateLimiter, TokenBucket
+
+# The head waiter re-checks the clock every 1/RATE seconds of real time; each
+# TICK the test moves the clock admits one request. A power of two keeps
+# the clock arithmetic exact.
+RATE = 128.0
+TICK = 1 / RATE
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+        self._lock = threading.Lock()
+
+    def __call__(self) -> float:
+        with self._lock:
+            return self.now
+
+    def advance(self, seconds: float):
+        with self._lock:
+            self.now += seconds
+
+
+def wait_until(condition, timeout: float = 5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.001)
+
+
+def queue_depth(limiter, key='host') -> int:
+    return limiter.metrics().get(key, {}).get('queue_depth', 0)
+
+
+def test_bucket_refills_at_its_rate_up_to_the_burst():
+    bucket = TokenBucket(rate=2.0, burst=4, now=0.0)
+    bucket.tokens = 0.0
+    bucket.refill(1.0)
+    assert bucket.tokens == 2.0
+    bucket.refill(60.0)
+    assert bucket.tokens == 4.0
+
+
+def test_burst_is_admitted_without_waiting():
+    clock = FakeClock()
+    limiter = RateLimiter({'host': (RATE, 3)}, clock=clock)
+    assert [limiter.acquire('host', 'user1') for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert limiter.metrics()['host']['requests'] == 3
+
+
+def test_unlimited_keys_and_disabled_limiter_never_wait():
+    limiter = RateLimiter({'host': (RATE, 1)}, clock=FakeClock())
+    assert limiter.acquire('other-host', 'user1') == 0.0
+    limiter.enabled = False
+    assert all(limiter.acquire('host', 'user1') == 0.0 for _ in range(5))
+
+
+def test_waiters_are_served_round_robin_across_clients():
+    clock = FakeClock()
+    limiter = RateLimiter({'host': (RATE, 1)}, clock=clock)
+    limiter.acquire('host', 'setup')
+    granted = []
+    waits = {}
+
+    def request(client_id, number):
+        waits[(client_id, number)] = limiter.acquire('host', client_id)
+        granted.append(client_id)
+
+    # user1 queues three requests before user2 queues one
+    threads = []
+    for client_id, number in [('user1', 1), ('user1', 2), ('user1', 3), ('user2', 1)]:
+        thread = threading.Thread(target=request, args=(client_id, number), daemon=True)
+        thread.start()
+        threads.append(thread)
+        wait_until(lambda: queue_depth(limiter) == len(threads))
+
+    for count in range(1, 5):
+        clock.advance(TICK)
+        wait_until(lambda: len(granted) == count)
+    for thread in threads:
+        thread.join(5)
+
+    assert granted == ['user1', 'user2', 'user1', 'user1']
+    # Waits are measured on the limiter's clock
+    assert waits[('user1', 1)] == pytest.approx(TICK)
+    assert waits[('user2', 1)] == pytest.approx(2 * TICK)
+    assert limiter.metrics()['host']['max_queue_depth'] == 4
+
+
+def test_a_token_is_not_granted_before_it_is_due():
+    clock = FakeClock()
+    limiter = RateLimiter({'host': (RATE, 1)}, clock=clock)
+    limiter.acquire('host', 'setup')
+    granted = []
+    thread = threading.Thread(target=lambda: granted.append(limiter.acquire('host', 'user1')), daemon=True)
+    thread.start()
+    wait_until(lambda: queue_depth(limiter) == 1)
+
+    # Half a token is not enough, however long the waiter polls
+    clock.advance(TICK / 2)
+    time.sleep(5 * TICK)
+    assert granted == []
+
+    clock.advance(TICK / 2)
+    thread.join(5)
+    assert granted == [pytest.approx(TICK)]
+
+
+def run_async(limiter_test):
+    return asyncio.run(asyncio.wait_for(limiter_test(), 10))
+
+
+def test_async_waiters_are_served_round_robin():
+    async def scenario():
+        clock = FakeClock()
+        limiter = AsyncRateLimiter({'host': (RATE, 1)}, clock=clock)
+        await limiter.acquire('host', 'setup')
+        granted = []
+
+        async def request(client_id):
+            await limiter.acquire('host', client_id)
+            granted.append(client_id)
+
+        tasks = []
+        for client_id in ['user1', 'user1', 'user1', 'user2']:
+            tasks.append(asyncio.create_task(request(client_id)))
+            await asyncio.sleep(0)
+        assert queue_depth(limiter) == 4
+
+        for count in range(1, 5):
+            clock.advance(TICK)
+            while len(granted) < count:
+                await asyncio.sleep(0.001)
+        await asyncio.gather(*tasks)
+        return granted
+
+    assert run_async(scenario) == ['user1', 'user2', 'user1', 'user1']
+
+
+def test_cancelled_async_waiter_is_withdrawn():
+    async def scenario():
+        clock = FakeClock()
+        limiter = AsyncRateLimiter({'host': (RATE, 1)}, clock=clock)
+        await limiter.acquire('host', 'setup')
+        granted = []
+
+        async def request(client_id):
+            await limiter.acquire('host', client_id)
+            granted.append(client_id)
+
+        # user1 is at the head of the queue, user2 behind it
+        head = asyncio.create_task(request('user1'))
+        await asyncio.sleep(0)
+        behind = asyncio.create_task(request('user2'))
+        await asyncio.sleep(0)
+        assert queue_depth(limiter) == 2
+
+        head.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await head
+        assert queue_depth(limiter) == 1
+
+        # The next token goes to user2 instead of being held for user1
+        clock.advance(TICK)
+        await behind
+        return granted, limiter.metrics()['host']
+
+    granted, metrics = run_async(scenario)
+    assert granted == ['user2']
+    assert metrics['queue_depth'] == 0
+    assert metrics['requests'] == 2
@@ -0,0 +1,105 @@
+"""Splitting users across runners (--shard) and merging their reports"""
+
+import argparse
+import hashlib
+import json
+
+import pytest
+
+import sync_gradescope
+from sync_gradescope import merge_run_reports, parse_shard, shard_of, shard_rate_limits
+
+USER_IDS = [f"user{number:06d}" for number in range(2000)] + ['64f0c2a1e3b5d7f9a1c3', 'x']
+
+
+def test_shard_of_is_stable():
+    # A fixed digest, not Python's salted hash(): the same on every runner and run
+    assert shard_of('user000000', 4) == int.from_bytes(hashlib.sha256(b'user000000').digest()[:8], 'big') % 4
+
+
+@pytest.mark.parametrize('count', [1, 2, 3, 4, 7])
+def test_every_user_lands_on_exactly_one_shard(count):
+    shards = {index: {user_id for user_id in USER_IDS if shard_of(user_id, count) == index} for index in range(count)}
+    assert sum(len(users) for users in shards.values()) == len(USER_IDS)
+    assert set().union(*shards.values()) == set(USER_IDS)
+    # Roughly even: no shard gets less than half its share
+    assert min(len(users) for users in shards.values()) > len(USER_IDS) / count / 2
+
+
+@pytest.mark.parametrize('value, expected', [('0/4', (0, 4)), ('3/4', (3, 4)), (' 1 / 2 ', (1, 2)), ('0/1', (0, 1))])
+def test_parse_shard(value, expected):
+    assert parse_shard(value) == expected
+
+
+@pytest.mark.parametrize('value', ['4/4', 'x/2', '0/0', '1', '-1/4', '', '1/2/3'])
+def test_parse_shard_rejects(value):
+    with pytest.raises(argparse.ArgumentTypeError):
+        parse_shard(value)
+
+
+def test_shard_rate_limits_split_the_host_rates(monkeypatch):
+    monkeypatch.setattr(sync_gradescope, 'RATE_LIMITS', {'gradescope': (5.0, 10), 'gemini': (10.0, 20)})
+    assert shard_rate_limits(None) == {'gradescope': (5.0, 10), 'gemini': (10.0, 20)}
+    assert shard_rate_limits((0, 1)) == {'gradescope': (5.0, 10), 'gemini': (10.0, 20)}
+    assert shard_rate_limits((1, 4)) == {'gradescope': (1.25, 2), 'gemini': (2.5, 5)}
+
+
+@pytest.mark.parametrize('count', [2, 4, 11, 25, 100])
+def test_shard_burst_is_never_zero(count):
+    for host, (rate, burst) in shard_rate_limits((0, count)).items():
+        assert burst >= 1
+        assert rate == sync_gradescope.RATE_LIMITS[host][0] / count
+
+
+def shard_report(shard: str, duration: float, stats: dict, errors: list) -> dict:
+    return {
+        'started_at': f"2024-01-01T08:00:0{shard[0]}",
+        'duration_seconds': duration,
+        'mode': 'incremental',
+        'engine': 'threads',
+        'workers': 8,
+        'course_workers': 4,
+        'write_workers': 4,
+        'shard': shard,
+        'stats': stats,
+        'errors': errors,
+        'parse_cache': {'hits': 1, 'misses': 2},
+        'rate_limits': {},
+        'phases': {'user': {'count': 2, 'total': 1.5, 'p50': 0.5, 'p95': 1.0, 'max': 1.0}},
+        'slowest_users': [],
+        'slowest_courses': [],
+    }
+
+
+def test_merge_run_reports_sums_counters_and_concatenates_errors():
+    merged = merge_run_reports([
+        shard_report('0/2', 30.0, {'users_processed': 3, 'writes_sent': 10}, ['User a: boom']),
+        shard_report('1/2', 45.0, {'users_processed': 2, 'writes_sent': 5, 'snapshot_reloads': 1}, ['User b: bang']),
+    ])
+    assert merged['stats'] == {'users_processed': 5, 'writes_sent': 15, 'snapshot_reloads': 1}
+    assert merged['errors'] == ['[shard 0/2] User a: boom', '[shard 1/2] User b: bang']
+    assert merged['duration_seconds'] == 45.0
+    assert merged['started_at'] == '2024-01-01T08:00:00'
+    assert merged['parse_cache'] == {'hits': 2, 'misses': 4}
+    assert merged['phases']['user'] == {'count': 4, 'total': 3.0, 'p50': 0.5, 'p95': 1.0, 'max': 1.0}
+    assert merged['missing_shards'] == []
+
+
+def test_merge_run_reports_lists_missing_shards():
+    merged = merge_run_reports([shard_report('2/4', 1.0, {}, []), shard_report('0/4', 1.0, {}, [])])
+    assert merged['missing_shards'] == ['1/4', '3/4']
+
+
+def test_shards_together_sync_every_user_once(offline_sync):
+    reports = []
+    for index in range(2):
+        syncer = offline_sync.run(shard=(index, 2))
+        with open(syncer.report_path) as f:
+            reports.append(json.load(f))
+
+    merged = merge_run_reports(reports)
+    assert merged['stats']['users_processed'] == offline_sync.population.user_count
+    assert merged['missing_shards'] == []
+    # A second pass finds every user's state in place: each was synced by one shard only
+    unchanged = sum(offline_sync.run(shard=(index, 2)).stats['assignments_unchanged'] for index in range(2))
+    assert unchanged == offline_sync.population.user_count * 2 * 3
@@ -0,0 +1,123 @@
+"""Reading a user's documents through the local snapshot (load_user_documents_steps)"""
+
+import threading
+
+import pytest
+
+from fakes import FakeDatabases
+from sync_gradescope import ASSIGNMENT_MATCH_FIELDS, ASSIGNMENTS_COLLECTION, GradescopeSyncer, SyncStateStore
+
+DAY_STAMPS = [f"2024-01-0{day}T12:00:00.000+00:00" for day in range(1, 5)]
+
+
+@pytest.fixture
+def databases():
+    databases = FakeDatabases()
+    for number, stamp in enumerate(DAY_STAMPS[:3]):
+        databases.seed(
+            ASSIGNMENTS_COLLECTION, f"assignment{number}",
+            {'userId': 'user1', 'title': f"Homework {number}", 'source': 'gradescope'},
+            timestamp=stamp
+        )
+    return databases
+
+
+@pytest.fixture
+def syncer(databases, tmp_path):
+    # Only what the snapshot steps use; no Appwrite client
+    syncer = GradescopeSyncer.__new__(GradescopeSyncer)
+    syncer.databases = databases
+    syncer.users_service = None
+    syncer.dry_run = False
+    syncer.incremental = True
+    syncer.state_store = SyncStateStore(str(tmp_path / 'sync_state.db'))
+    syncer.stats = {'documents_read': 0, 'snapshot_reloads': 0}
+    syncer._stats_lock = threading.Lock()
+    yield syncer
+    syncer.state_store.close()
+
+
+def load(syncer, user_id='user1'):
+    documents = syncer.perform(syncer.load_user_documents_steps(user_id, ASSIGNMENTS_COLLECTION, ASSIGNMENT_MATCH_FIELDS))
+    return {document['$id']: document['title'] for document in documents}
+
+
+def reads(syncer, databases):
+    """Documents transferred and list calls made since the last call, then reset"""
+    counts = (syncer.stats['documents_read'], databases.calls.get('list_documents', 0))
+    syncer.stats['documents_read'] = 0
+    databases.calls.clear()
+    return counts
+
+
+def test_unchanged_documents_come_from_the_snapshot(syncer, databases):
+    first = load(syncer)
+    assert reads(syncer, databases) == (3, 1)
+
+    assert load(syncer) == first
+    # A changes page and the count; only the newest document, within the
+    # overlap before the watermark, is transferred again
+    assert reads(syncer, databases) == (1, 2)
+    assert syncer.stats['snapshot_reloads'] == 0
+
+
+def test_changed_document_is_merged_in(syncer, databases):
+    load(syncer)
+    reads(syncer, databases)
+
+    databases.update_document('db', ASSIGNMENTS_COLLECTION, 'assignment1', {'title': 'Homework 1 (revised)'})
+    assert load(syncer) == {
+        'assignment0': 'Homework 0',
+        'assignment1': 'Homework 1 (revised)',
+        'assignment2': 'Homework 2',
+    }
+    # The revision and the overlap document, not the whole collection
+    assert reads(syncer, databases) == (2, 2)
+    assert syncer.stats['snapshot_reloads'] == 0
+
+    # The merge was stored and the watermark moved up to the revision
+    assert load(syncer)['assignment1'] == 'Homework 1 (revised)'
+    assert reads(syncer, databases) == (1, 2)
+
+
+def test_deleted_document_makes_the_count_mismatch_and_reloads(syncer, databases):
+    load(syncer)
+    reads(syncer, databases)
+
+    databases.delete_document('db', ASSIGNMENTS_COLLECTION, 'assignment0')
+    assert load(syncer) == {'assignment1': 'Homework 1', 'assignment2': 'Homework 2'}
+    # Changes page (the overlap document), count, then the full read
+    assert reads(syncer, databases) == (1 + 2, 3)
+    assert syncer.stats['snapshot_reloads'] == 1
+
+    # The reload replaced the snapshot, so the deleted document is gone from it too
+    assert load(syncer) == {'assignment1': 'Homework 1', 'assignment2': 'Homework 2'}
+    assert reads(syncer, databases) == (1, 2)
+    assert syncer.stats['snapshot_reloads'] == 1
+
+
+def test_user_without_documents_is_read_in_full(syncer, databases):
+    assert load(syncer, 'user2') == {}
+    # An empty snapshot has no watermark to read changes from
+    assert load(syncer, 'user2') == {}
+    assert reads(syncer, databases) == (0, 2)
+
+    databases.seed(ASSIGNMENTS_COLLECTION, 'assignment9', {'userId': 'user2', 'title': 'Lab 1'}, timestamp=DAY_STAMPS[3])
+    assert load(syncer, 'user2') == {'assignment9': 'Lab 1'}
+    assert syncer.stats['snapshot_reloads'] == 0
+
+
+def test_merge_into_an_empty_snapshot(syncer):
+    changed = [{'$id': 'assignment0', 'title': 'Homework 0', '$updatedAt': DAY_STAMPS[0]}]
+    assert syncer.merge_snapshot('user3', ASSIGNMENTS_COLLECTION, {}, changed, 1, DAY_STAMPS[0]) == changed
+    assert syncer.merge_snapshot('user3', ASSIGNMENTS_COLLECTION, {}, [], 1, DAY_STAMPS[0]) is None
+    assert syncer.stats['snapshot_reloads'] == 1
+
+
+def test_full_sync_ignores_the_snapshot(syncer, databases):
+    load(syncer)
+    reads(syncer, databases)
+
+    syncer.incremental = False
+    assert len(load(syncer)) == 3
+    assert reads(syncer, databases) == (3, 1)
@@ -0,0 +1,181 @@
+"""Appwrite operations written once as steps, run by GradescopeSyncer.perform"""
+
+import json
+
+from sync_gradescope import AppwriteCall, GradescopeSyncer, PlannedWrite
+
+
+class FailingDatabases:
+    def create_document(self, *args, **kwargs):
+        raise RuntimeError('Appwrite is down')
+
+
+class PagedDatabases:
+    """list_documents over numbered documents, honouring limit and cursor"""
+
+    def __init__(self, count: int):
+        self.documents = [{'$id': f"doc{number:03d}"} for number in range(count)]
+        self.calls = []
+
+    def list_documents(self, database_id, collection_id, queries=None):
+        self.calls.append(queries)
+        limit, start = len(self.documents), 0
+        for query in queries:
+            if '"limit"' in query:
+                limit = int(query.split('[')[1].split(']')[0])
+            if '"cursorAfter"' in query:
+                cursor = query.split('["')[1].split('"]')[0]
+                start = next(i for i, document in enumerate(self.documents) if document['$id'] == cursor) + 1
+        return {'documents': self.documents[start:start + limit], 'total': len(self.documents)}
+
+
+def syncer(databases=None, users_service=None) -> GradescopeSyncer:
+    # Only what perform and the steps under test use; no Appwrite client
+    syncer = GradescopeSyncer.__new__(GradescopeSyncer)
+    syncer.databases = databases
+    syncer.users_service = users_service
+    syncer.dry_run = False
+    return syncer
+
+
+def test_perform_sends_responses_back():
+    def steps():
+        first = yield AppwriteCall.users('get_prefs', 'user1')
+        second = yield AppwriteCall.users('get_prefs', 'user2')
+        return first['name'] + second['name']
+
+    class Users:
+        def get_prefs(self, user_id):
+            return {'name': user_id}
+
+    assert syncer(users_service=Users()).perform(steps()) == 'user1user2'
+
+
+def test_failed_call_is_raised_into_the_steps():
+    write = PlannedWrite(collection_id='assignments', data={'title': 'Homework 1'})
+    assert syncer(databases=FailingDatabases()).perform(syncer().execute_write_steps(write)) is False
+
+
+def test_list_all_documents_pages_with_a_cursor():
+    databases = PagedDatabases(5)
+    documents = syncer(databases=databases).perform(
+        syncer().list_all_documents_steps('assignments', [], page_size=2)
+    )
+    assert [document['$id'] for document in documents] == [f"doc{number:03d}" for number in range(5)]
+    assert len(databases.calls) == 3
+
+
+class PrefsUsers:
+    """Users service keeping prefs like Appwrite: update replaces the whole object"""
+
+    def __init__(self, prefs):
+        self.prefs = dict(prefs)
+        self.calls = []
+
+    def get_prefs(self, user_id):
+        self.calls.append('get_prefs')
+        return dict(self.prefs)
+
+    def update_prefs(self, user_id, prefs):
+        self.calls.append('update_prefs')
+        self.prefs = dict(prefs)
+
+
+def test_prefs_update_keeps_changes_made_during_the_sync():
+    users = PrefsUsers({'gradescopeConnected': True, 'gradescopeSessionToken': 'old-token'})
+    # The user disconnects in the web app while their sync is running
+    users.prefs = {'gradescopeConnected': False, 'moodleUrl': 'https://moodle.example.edu'}
+
+    syncer(users_service=users).perform(
+        syncer().update_user_prefs_steps('user1', {'gradescopeLastSync': '2024-01-01T00:00:00Z'})
+    )
+    assert users.calls == ['get_prefs', 'update_prefs']
+    assert users.prefs == {
+        'gradescopeConnected': False,
+        'moodleUrl': 'https://moodle.example.edu',
+        'gradescopeLastSync': '2024-01-01T00:00:00Z',
+    }
+
+
+def test_connected_user_is_hashable_and_keeps_its_labels():
+    listed = {
+        '$id': 'user1',
+        'labels': ['beta', 'gradescope'],
+        'prefs': {'gradescopeConnected': True, 'gradescopeSessionToken': 'encrypted'},
+    }
+    user, follow_up = syncer().check_connection(listed)
+    assert follow_up is None
+    assert user.labels == ('beta', 'gradescope')
+    assert len({user, user}) == 1
+
+    assert GradescopeSyncer.connected_labels(user.labels, False) == ['beta']
+    assert GradescopeSyncer.connected_labels(('beta',), True) == ['beta', 'gradescope']
+    assert user.labels == ('beta', 'gradescope')
+
+
+def graded_course(**fields):
+    items = [
+        {'id': 'item0001', 'category': 'Homework', 'name': 'Homework 1', 'score': 9.0, 'total': 10.0},
+        {'id': 'item0002', 'category': 'Homework', 'name': 'Homework 2', 'score': 7.0, 'total': 10.0},
+    ]
+    return {'$id': 'course1', 'gradedItems': json.dumps(items), **fields}
+
+
+def test_merge_course_grades_reports_only_changed_titles():
+    items, changed = syncer().merge_course_grades(
+        graded_course(),
+        {'Homework 1': (9.0, 10.0), 'Homework 2': (8.5, 10.0)}
+    )
+    assert changed == ['Homework 2']
+    assert items == [
+        {'id': 'item0001', 'category': 'Homework', 'name': 'Homework 1', 'score': 9.0, 'total': 10.0},
+        {'id': 'item0002', 'category': 'Homework', 'name': 'Homework 2', 'score': 8.5, 'total': 10.0},
+    ]
+
+
+def test_merge_course_grades_adds_new_titles_under_a_matching_category():
+    course = graded_course(gradeWeights=json.dumps([
+        {'category': 'Exams', 'weight': 60},
+        {'category': 'Quiz', 'weight': 40},
+    ]))
+    items, changed = syncer().merge_course_grades(course, {'Quiz 3': (4.0, 5.0), 'Lab 1': (1.0, 1.0)})
+    assert changed == ['Quiz 3', 'Lab 1']
+    added = {item['name']: item for item in items[2:]}
+    assert added['Quiz 3']['category'] == 'Quiz'
+    # No category matches: the first one
+    assert added['Lab 1']['category'] == 'Exams'
+    assert (added['Lab 1']['score'], added['Lab 1']['total']) == (1.0, 1.0)
+
+
+class CourseDatabases:
+    def __init__(self, course):
+        self.course = course
+        self.calls = []
+
+    def get_document(self, database_id, collection_id, document_id):
+        self.calls.append('get_document')
+        return dict(self.course)
+
+    def update_document(self, database_id, collection_id, document_id, data):
+        self.calls.append('update_document')
+        self.course.update(data)
+
+
+def test_unchanged_grades_are_neither_read_nor_written():
+    databases = CourseDatabases(graded_course())
+    assert syncer(databases=databases).perform(
+        syncer().update_course_grades_steps('course1', {'Homework 1': (9.0, 10.0)}, graded_course())
+    )
+    assert databases.calls == []
+
+
+def test_changed_grade_is_written_in_one_read_modify_write():
+    databases = CourseDatabases(graded_course())
+    assert syncer(databases=databases).perform(
+        syncer().update_course_grades_steps(
+            'course1', {'Homework 1': (9.0, 10.0), 'Homework 2': (10.0, 10.0)}, graded_course()
+        )
+    )
+    assert databases.calls == ['get_document', 'update_document']
+    scores = {item['name']: item['score'] for item in json.loads(databases.course['gradedItems'])}
+    assert scores == {'Homework 1': 9.0, 'Homework 2': 10.0}
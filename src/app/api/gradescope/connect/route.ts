@@ -3,6 +3,9 @@ import { getCurrentUser, createAdminClient } from '@/lib/appwrite/server'
 import { encryptToken, isEncryptionKeyConfigured } from '@/lib/gradescope/encryption'
 import { ConnectRequest, ConnectResponse } from '@/types/gradescope'
 
+// Must match GRADESCOPE_USER_LABEL in scripts/sync_gradescope.py
+const GRADESCOPE_USER_LABEL = 'gradescope'
+
 export async function POST(request: NextRequest): Promise<NextResponse<ConnectResponse>> {
   try {
     // Check encryption key is configured
@@ -167,6 +170,12 @@ export async function POST(request: NextRequest): Promise<NextResponse<ConnectRe
       gradescopeLastSync: null
     })
 
+    // Label the user so the nightly sync can list connected users directly
+    await users.updateLabels(
+      user.$id,
+      Array.from(new Set([...(user.labels ?? []), GRADESCOPE_USER_LABEL]))
+    )
+
     return NextResponse.json({
       success: true,
       email: email
@@ -2,6 +2,9 @@ import { NextRequest, NextResponse } from 'next/server'
 import { getCurrentUser, createAdminClient } from '@/lib/appwrite/server'
 import { DisconnectResponse } from '@/types/gradescope'
 
+// Must match GRADESCOPE_USER_LABEL in scripts/sync_gradescope.py
+const GRADESCOPE_USER_LABEL = 'gradescope'
+
 export async function POST(request: NextRequest): Promise<NextResponse<DisconnectResponse>> {
   try {
     // Get current user
@@ -26,6 +29,12 @@ export async function POST(request: NextRequest): Promise<NextResponse<Disconnec
 
     await users.updatePrefs(user.$id, updatedPrefs)
 
+    // Remove the label used by the nightly sync to find connected users
+    await users.updateLabels(
+      user.$id,
+      (user.labels ?? []).filter((label) => label !== GRADESCOPE_USER_LABEL)
+    )
+
     return NextResponse.json({ success: true })
 
   } catch (error) {